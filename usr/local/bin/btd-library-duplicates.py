@@ -6,19 +6,298 @@ output unless directed otherwise with the command line option
 write an Excel-compatible spreadsheet file using the '--excel'
 option. Run with --help for all the options.
 
+With '--audio' it compares the audio of the Cuts rather than the
+Artist, Album and Title of the Carts, to find the same recording
+under different names. Each Cut gets a compact fingerprint: one bit
+for each tenth of a second, set when the audio is louder than it was
+a little earlier (see RISE_FRAMES). Fingerprints
+are computed on all CPUs and cached (see '--fingerprint-cache'), so a
+rerun only decodes new or changed audio files.
+
 '''
 
 import sys
+import os
 import re
 import argparse
 import csv
+import datetime
+import shutil
+import sqlite3
+import subprocess
+import wave
+from array import array
+from concurrent.futures import ProcessPoolExecutor
 import mysql.connector
 import openpyxl
 
+DEFAULT_AUDIO_DIR = '/var/snd'
+DEFAULT_FINGERPRINT_CACHE = '/var/cache/btd/audio_fingerprints.db'
+# One fingerprint bit per frame of this many seconds.
+FRAME_SECONDS = 0.1
+# Set the bit for a frame when it is louder than this many frames
+# earlier (comparing with the previous frame is more sensitive to
+# noise and to recordings that start part way through a frame).
+RISE_FRAMES = 3
+# Measure the loudness of every Nth sample (odd, so that we sample all
+# the channels).
+DECIMATION = 7
+# Index a window of WINDOW_BITS bits every INDEX_STEP bits in the
+# first INDEX_BITS bits of each fingerprint, and look up the windows at
+# every bit in the first INDEX_BITS + INDEX_STEP bits: this finds
+# recordings that start up to about INDEX_BITS tenths of a second
+# apart. Shorter windows find more noisy copies, and more candidates
+# to compare.
+WINDOW_BITS = 24
+WINDOW_MASK = (1 << WINDOW_BITS) - 1
+INDEX_BITS = 256
+INDEX_STEP = 8
+# Ignore windows shared by more Cuts than this (silence, steady tones).
+MAX_INDEX_BUCKET = 500
+# The fraction of bits that may differ between two fingerprints of
+# the same recording (different encodings, levels, etc.).
+MAX_BIT_ERROR_RATE = 0.25
+# The fraction of the shorter fingerprint that must overlap the longer one.
+MIN_OVERLAP = 0.9
+FFMPEG = shutil.which('ffmpeg')
+
 def my_print(*p_args, **p_kwargs):
     '''my_print sends its outptuto STDERR.'''
     print(*p_args, **p_kwargs, file=sys.stderr)
 
+def seconds(length):
+    '''seconds converts a length (a datetime.timedelta, or None) to seconds.'''
+    return length.seconds + length.microseconds/1000000 if length is not None else 0
+
+def wav_loudness(path):
+    '''wav_loudness returns the loudness of each frame of a PCM WAV file
+    (as read by the wave module: 16- or 32-bit samples).'''
+    with wave.open(path, 'rb') as wav_file:
+        typecode = {2: 'h', 4: 'i'}.get(wav_file.getsampwidth())
+        if typecode is None:
+            raise wave.Error('unsupported sample width: {w}'.format(w=wav_file.getsampwidth()))
+        frame_length = int(wav_file.getframerate() * FRAME_SECONDS)
+        frame_bytes = frame_length * wav_file.getsampwidth() * wav_file.getnchannels()
+        loudness = []
+        while True:
+            data = wav_file.readframes(frame_length)
+            if len(data) < frame_bytes:
+                break
+            samples = array(typecode, data)
+            if sys.byteorder == 'big':
+                samples.byteswap()
+            loudness.append(sum(map(abs, samples[::DECIMATION])))
+    return loudness
+
+def ffmpeg_loudness(path):
+    '''ffmpeg_loudness returns the loudness of each frame of any audio
+    file that ffmpeg can decode, or None if it cannot.'''
+    rate = 11025
+    result = subprocess.run([FFMPEG, '-v', 'quiet', '-i', path, '-ac', '1', '-ar', str(rate), '-f', 's16le', '-'],
+                            stdout=subprocess.PIPE, check=False)
+    if result.returncode != 0:
+        return None
+    samples = array('h', result.stdout[:len(result.stdout) // 2 * 2])
+    if sys.byteorder == 'big':
+        samples.byteswap()
+    frame_length = int(rate * FRAME_SECONDS)
+    return [sum(map(abs, samples[start:start + frame_length:DECIMATION]))
+            for start in range(0, len(samples) - frame_length + 1, frame_length)]
+
+def audio_fingerprint(path):
+    '''audio_fingerprint computes the fingerprint of the audio file at
+    path. It runs in the worker processes. It returns the fingerprint as
+    bytes (see fingerprint_bits()), or empty bytes if the file cannot
+    be decoded.'''
+    try:
+        loudness = wav_loudness(path)
+    except (wave.Error, EOFError, OSError) as e:
+        loudness = ffmpeg_loudness(path) if FFMPEG else None
+        if loudness is None:
+            my_print("Unable to decode '{f}' ({e}).".format(f=path, e=e))
+            return b''
+
+    bits = 1
+    for earlier, this in zip(loudness, loudness[RISE_FRAMES:]):
+        bits = (bits << 1) | (this > earlier)
+    return bits.to_bytes((bits.bit_length() + 7) // 8, 'big')
+
+def fingerprint_bits(fingerprint):
+    '''fingerprint_bits returns the number of bits and the bits (as an
+    int, the first frame in the most significant bit) of a fingerprint
+    from audio_fingerprint(). The bytes hold the bits after a leading
+    1 bit, so that leading zero bits are kept.'''
+    bits = int.from_bytes(fingerprint, 'big')
+    length = bits.bit_length() - 1
+    return length, bits & ((1 << length) - 1)
+
+def load_fingerprints(paths, cache_file, jobs):
+    '''load_fingerprints returns a dict of fingerprints (see
+    fingerprint_bits()) indexed by Cut name, for the audio files in the
+    dict paths (indexed by Cut name). Fingerprints are read from the
+    cache when the size and modification time of the file are
+    unchanged, computed in jobs worker processes otherwise, and saved
+    in the cache (which is created if need be).'''
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(cache_file)), exist_ok=True)
+        cache = sqlite3.connect(cache_file)
+        cache.execute("CREATE TABLE IF NOT EXISTS FINGERPRINTS "
+                      "(PATH TEXT PRIMARY KEY, SIZE INTEGER, MTIME REAL, FINGERPRINT BLOB)")
+    except (OSError, sqlite3.Error) as err:
+        print("Error opening the fingerprint cache '{f}' ({e})".format(f=cache_file, e=err), file=sys.stderr)
+        sys.exit(1)
+    cached = {row[0]: row[1:] for row in cache.execute("SELECT path, size, mtime, fingerprint FROM FINGERPRINTS")}
+
+    fingerprints = {}
+    todo = []
+    for cut_name, path in paths.items():
+        stat = os.stat(path)
+        entry = cached.get(path)
+        if entry is not None and entry[0] == stat.st_size and entry[1] == stat.st_mtime:
+            fingerprints[cut_name] = entry[2]
+        else:
+            todo.append((cut_name, path, stat))
+
+    if todo:
+        my_print("Computing {n} fingerprints ({c} cached).".format(n=len(todo), c=len(fingerprints)))
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            results = pool.map(audio_fingerprint, [path for _, path, _ in todo],
+                               chunksize=max(1, len(todo) // (16 * (jobs or os.cpu_count() or 1))))
+            for count, ((cut_name, path, stat), fingerprint) in enumerate(zip(todo, results), start=1):
+                # Undecodable files are cached too, so we do not try again.
+                fingerprints[cut_name] = fingerprint
+                cache.execute("REPLACE INTO FINGERPRINTS (path, size, mtime, fingerprint) VALUES (?, ?, ?, ?)",
+                              (path, stat.st_size, stat.st_mtime, fingerprint))
+                if count % 1000 == 0:
+                    cache.commit()
+        cache.commit()
+    cache.close()
+
+    return {cut_name: fingerprint_bits(fingerprint)
+            for cut_name, fingerprint in fingerprints.items() if fingerprint}
+
+def bit_error_rate(first, second, offset):
+    '''bit_error_rate returns the fraction of bits that differ between
+    two fingerprints (see fingerprint_bits()) when bit N of second is
+    aligned with bit N + offset of first, or 1.0 if they do not overlap
+    enough.'''
+    (first_length, first_bits), (second_length, second_bits) = first, second
+    first_start = max(0, offset)
+    second_start = max(0, -offset)
+    overlap = min(first_length - first_start, second_length - second_start)
+    if overlap < 32 or overlap < MIN_OVERLAP * min(first_length, second_length):
+        return 1.0
+
+    mask = (1 << overlap) - 1
+    first_bits = (first_bits >> (first_length - first_start - overlap)) & mask
+    second_bits = (second_bits >> (second_length - second_start - overlap)) & mask
+    return bin(first_bits ^ second_bits).count('1') / overlap
+
+def match_fingerprints(fingerprints):
+    '''match_fingerprints returns a list of pairs of Cut names whose
+    fingerprints (see load_fingerprints()) match. Candidates are found
+    with a hash index of 24-bit windows (WINDOW_BITS) near the start of
+    each fingerprint (any window in common makes a candidate), and then
+    compared bit by bit.'''
+    cut_names = sorted(fingerprints)
+    heads = []
+    index = {}
+    for number, cut_name in enumerate(cut_names):
+        length, bits = fingerprints[cut_name]
+        head_length = min(length, INDEX_BITS + INDEX_STEP + WINDOW_BITS)
+        head = bits >> (length - head_length)
+        heads.append((head_length, head))
+        for position in range(0, min(INDEX_BITS, head_length - WINDOW_BITS + 1), INDEX_STEP):
+            window = (head >> (head_length - position - WINDOW_BITS)) & WINDOW_MASK
+            if window not in (0, WINDOW_MASK):
+                index.setdefault(window, []).append((number, position))
+
+    for window in [window for window, entries in index.items() if len(entries) > MAX_INDEX_BUCKET]:
+        del index[window]
+
+    # Look up every window of every Cut in the index, noting the
+    # alignment of the two Cuts.
+    candidates = set()
+    for number, (head_length, head) in enumerate(heads):
+        for position in range(0, head_length - WINDOW_BITS + 1):
+            window = (head >> (head_length - position - WINDOW_BITS)) & WINDOW_MASK
+            for other, other_position in index.get(window, ()):
+                if other > number:
+                    candidates.add((number, other, position - other_position))
+
+    matches = set()
+    for number, other, offset in candidates:
+        if (number, other) in matches:
+            continue
+        if bit_error_rate(fingerprints[cut_names[number]], fingerprints[cut_names[other]],
+                          offset) <= MAX_BIT_ERROR_RATE:
+            matches.add((number, other))
+
+    return sorted((cut_names[number], cut_names[other]) for number, other in matches)
+
+def audio_duplicates(rows, audio_dir, cache_file, jobs, verbose_print):
+    '''audio_duplicates yields (duplicate, original) pairs of rows (one
+    per Cut, see main()) of different Carts whose Cuts hold the same
+    audio. Matching Cuts are grouped (a Cut matching a Cut that matches
+    a third is in the same group as the third), and each Cart in a
+    group is reported once, against the Cart with the lowest number.'''
+    rows_by_cut = {d_row['cut_name']: d_row for d_row in rows}
+    paths = {}
+    for cut_name in rows_by_cut:
+        path = os.path.join(audio_dir, cut_name + '.wav')
+        if os.path.isfile(path):
+            paths[cut_name] = path
+    verbose_print("audio files: {n} of {c} Cuts".format(n=len(paths), c=len(rows_by_cut)))
+
+    fingerprints = load_fingerprints(paths, cache_file, jobs)
+    matches = match_fingerprints(fingerprints)
+    verbose_print("matching Cuts: {n}".format(n=len(matches)))
+
+    # Union-find of the Carts, each group's root being its lowest
+    # numbered Cart (with the row of its first Cut).
+    parents = {}
+    first_rows = {}
+
+    def find(number):
+        while parents[number] != number:
+            parents[number] = parents[parents[number]]
+            number = parents[number]
+        return number
+
+    for first, second in matches:
+        for d_row in (rows_by_cut[first], rows_by_cut[second]):
+            parents.setdefault(d_row['number'], d_row['number'])
+            first_rows.setdefault(d_row['number'], d_row)
+        first_root = find(rows_by_cut[first]['number'])
+        second_root = find(rows_by_cut[second]['number'])
+        if first_root != second_root:
+            parents[max(first_root, second_root)] = min(first_root, second_root)
+
+    for number in sorted(parents):
+        original = find(number)
+        if original != number:
+            yield first_rows[number], first_rows[original]
+
+def metadata_duplicates(rows):
+    '''metadata_duplicates yields (duplicate, original) pairs of
+    neighbouring rows (sorted by their keys) of different Carts with the
+    same Artist, Album and Title keys (k_artist, k_album and k_title:
+    trimmed, with no Album the same as an empty one).'''
+    last_row = {'number': 0, 'k_artist': "", 'k_album': "", 'k_title': "", 'length': None}
+    for d_row in rows:
+        # This is the test for duplicity:
+        if (
+                d_row['number'] != last_row['number'] and
+                d_row['k_title'] is not None and
+                d_row['k_artist'] is not None and
+                d_row['k_album'] == last_row['k_album'] and
+                d_row['k_artist'] == last_row['k_artist'] and
+                d_row['k_title'] == last_row['k_title']
+        ):
+            yield d_row, last_row
+
+        last_row = d_row
+
 def main():
     '''main is the primary entry point for the script.'''
 
@@ -29,6 +308,13 @@ def main():
         prog="btd-library-duplicates",
         description='Identify potential duplicate tracks in the Rivendell Library.')
 
+    parser.add_argument('-a', '--audio',
+                        help='Compare the audio of the Cuts (rather than the Artist, Album and Title of the Carts).',
+                        action='store_true')
+    parser.add_argument('-A', '--audio-dir',
+                        help='The Rivendell audio store (default: {d}).'.format(d=DEFAULT_AUDIO_DIR),
+                        default=DEFAULT_AUDIO_DIR,
+                        action='store')
     parser.add_argument('-c', '--csv',
                         help='Generate a so-called comma-separated-value text file containing the possible duplicates.',
                         action='store_true')
@@ -39,10 +325,21 @@ def main():
     parser.add_argument('-e', '--excel',
                         help='Generate an Excel workbook containing the possible duplicates listing.',
                         action='store_true')
+    parser.add_argument('-f', '--fingerprint-cache',
+                        help='Keep the audio fingerprints in this file (default: {d}).'.format(d=DEFAULT_FINGERPRINT_CACHE),
+                        default=DEFAULT_FINGERPRINT_CACHE,
+                        action='store')
     parser.add_argument('-g', '--groups',
                         help='Specify one or more groups (separated by commas) in which to search for duplicates. \
                         Remember to use quotes if you include spaces between group names.',
                         action='store')
+    parser.add_argument('-j', '--jobs',
+                        type=int,
+                        help='Compute audio fingerprints in this many processes (default: one per CPU).',
+                        action='store')
+    parser.add_argument('-l', '--library',
+                        help='Read the Library from this snapshot (see btd_sched/library.py) instead of the database.',
+                        action='store')
     parser.add_argument('-n', '--hostname',
                         help='Specify the database host name or IP address (default: localhost).',
                         default='localhost',
@@ -51,8 +348,15 @@ def main():
                         help='Name the output file for the list of possible duplicates.',
                         action='store')
     parser.add_argument('-p', '--password',
-                        help='Specify the database user password (no default).',
-                        required=True,
+                        help='Specify the database user password (no default, required unless --library).',
+                        action='store')
+    parser.add_argument('-P', '--pushdown',
+                        help='Find the possible duplicates on the database server, and fetch only their rows \
+                        (rather than every Cart in the Library).',
+                        action='store_true')
+    parser.add_argument('-r', '--replica-host',
+                        help='Read from this replica of the database (host name or IP address) instead of --hostname. \
+                        Falls back to --hostname if the replica is unavailable.',
                         action='store')
     parser.add_argument('-u', '--user',
                         help='Specify the database username (default: rduser).',
@@ -61,7 +365,7 @@ def main():
     parser.add_argument('-V', '--version',
                         help='Display this app version string.',
                         action='version',
-                        version='%(prog)s: 0.1.1')
+                        version='%(prog)s: 0.1.5')
     parser.add_argument('-v', '--verbose',
                         help='Be chatty about progress. Use up to 3 times for more chattiness.',
                         default=0,
@@ -92,6 +396,9 @@ def main():
         parser.print_help()
         sys.exit(1)
 
+    if not args.library and not args.password:
+        parser.error('the following arguments are required: -p/--password (or -l/--library)')
+
     if args.csv and not args.output:
         csvfile = sys.stdout
 
@@ -157,39 +464,103 @@ def main():
             quotechar='^',
             quoting=csv.QUOTE_MINIMAL)
 
-    try:
-        cnx = mysql.connector.connect(
-            host=database_host,
-            user=database_user,
-            passwd=database_passwd,
-            database=database_name)
-    except mysql.connector.Error as err:
-        print("Error connecting to the database. Did you remember to edit this script? ({e})".format(e=err))
+    cnx = None
+    if args.library:
+        # The snapshot has the same tables and columns (see
+        # btd_sched/library.py), but not sec_to_time().
+        try:
+            cnx = sqlite3.connect('file:{f}?mode=ro'.format(f=args.library), uri=True)
+        except sqlite3.Error as err:
+            print("Error opening the Library snapshot '{f}' ({e})".format(f=args.library, e=err))
+            sys.exit(1)
+        cnx.row_factory = sqlite3.Row
+        placeholder = '?'
+        length_column = "u.LENGTH / 1000 as length "
+    else:
+        placeholder = '%s'
+        length_column = "sec_to_time(u.LENGTH div 1000) as length "
+
+    # This report only reads the Library, so it may run on a replica
+    # and keep its (full table) query off the on-air database server.
+    if args.replica_host and not args.library:
+        try:
+            cnx = mysql.connector.connect(
+                host=args.replica_host,
+                user=database_user,
+                passwd=database_passwd,
+                database=database_name)
+            verbose_print("reading from replica: {h}".format(h=args.replica_host))
+        except mysql.connector.Error as err:
+            my_print("Replica '{h}' is unavailable, using '{p}' ({e}).".format(
+                h=args.replica_host, p=database_host, e=err))
+
+    if cnx is None and not args.library:
+        try:
+            cnx = mysql.connector.connect(
+                host=database_host,
+                user=database_user,
+                passwd=database_passwd,
+                database=database_name)
+        except mysql.connector.Error as err:
+            print("Error connecting to the database. Did you remember to edit this script? ({e})".format(e=err))
 
-    cursor = cnx.cursor(dictionary=True)
+    cursor = cnx.cursor() if args.library else cnx.cursor(dictionary=True)
 
     groups_list = []
+    groups_constraint = ""
+    if args.groups is not None:
+        groups_list = re.split(r', *', args.groups)
+        groups_constraint = "and c.GROUP_NAME in ({}) ".format(",".join([placeholder] * len(groups_list)))
+    query_args = groups_list
+
+    # The keys compared by metadata_duplicates(), here and in the
+    # --pushdown query, so that the report is the same either way.
+    key_artist = "TRIM(c.ARTIST)"
+    key_album = "TRIM(COALESCE(c.ALBUM, ''))"
+    key_title = "TRIM(c.TITLE)"
 
     query = "select c.NUMBER as number, "
     query += "c.ARTIST as artist, c.ALBUM as album, c.TITLE as title, "
-    query += "sec_to_time(u.LENGTH div 1000) as length "
+    if args.audio:
+        query += "u.CUT_NAME as cut_name, "
+    else:
+        query += "{a} as k_artist, {b} as k_album, {t} as k_title, ".format(a=key_artist, b=key_album, t=key_title)
+    query += length_column
     query += "from CART c join CUTS u on c.NUMBER = u.CART_NUMBER "
+    if args.pushdown and not args.audio:
+        # Let the server find the (normalized) Artist, Album and Title
+        # shared by more than one Cart, and send us only the rows with
+        # those keys. The test for duplicity below still decides.
+        query += "join (select {a} as k_artist, {b} as k_album, {t} as k_title ".format(
+            a=key_artist, b=key_album, t=key_title)
+        query += "from CART c join CUTS u on c.NUMBER = u.CART_NUMBER "
+        query += "where c.TYPE = 1 and c.ARTIST is not null and c.TITLE is not null "
+        query += groups_constraint
+        query += "group by k_artist, k_album, k_title "
+        query += "having count(distinct c.NUMBER) > 1) d "
+        query += "on {a} = d.k_artist and {b} = d.k_album and {t} = d.k_title ".format(
+            a=key_artist, b=key_album, t=key_title)
+        query_args = groups_list * 2
     # Audio carts only.
     query += "where c.TYPE = 1 "
-    if args.groups is not None:
-        groups_list = re.split(r', *', args.groups)
-        query += "and c.GROUP_NAME in ({}) ".format(",".join(['%s'] * len(groups_list)))
+    query += groups_constraint
 
-    query += "order by c.ARTIST, c.ALBUM, c.TITLE"
+    if args.audio:
+        query += "order by c.NUMBER, u.CUT_NAME"
+    else:
+        query += "order by k_artist, k_album, k_title, c.NUMBER"
     verbose_print("query: {q}".format(q=query))
 
-    cursor.execute(query, groups_list)
+    cursor.execute(query, query_args)
+    if args.library:
+        cursor = ({**dict(d_row),
+                   'length': datetime.timedelta(seconds=d_row['length']) if d_row['length'] is not None else None}
+                  for d_row in cursor)
 
-    last_number = 0
-    last_artist = ""
-    last_album = ""
-    last_title = ""
-    last_length = 0
+    if args.audio:
+        duplicates = audio_duplicates(cursor, args.audio_dir, args.fingerprint_cache, args.jobs, verbose_print)
+    else:
+        duplicates = metadata_duplicates(cursor)
 
     # Output the Header Row.
     if args.excel:
@@ -213,53 +584,35 @@ def main():
             "Dupl Length"))
 
     row = 2
-    d_row = {}
-    for d_row in cursor:
-        # This is the test for duplicity:
-        if (
-                d_row['number'] != last_number and
-                d_row['title'] is not None and
-                d_row['artist'] is not None and
-                d_row['album'] == last_album and
-                d_row['artist'] == last_artist and
-                d_row['title'] == last_title
-        ):
-            row_data = {
-                'dup_num':    d_row['number'],
-                'dup_of':     last_number,
-                'dup_artist': d_row['artist'],
-                'dup_album':  d_row['album'],
-                'dup_title':  d_row['title'],
-                'org_length': last_length,
-                'dup_length': d_row['length'].seconds + \
-                d_row['length'].microseconds/1000000 if d_row['length'] is not None else 0,
-            }
-            very_verbose_print("row:{r}, data:{d}".format(r=row, d=row_data))
-
-            if args.excel:
-                workbook.active.cell(row=row, column=1, value=row_data['dup_num'])
-                workbook.active.cell(row=row, column=2, value=last_number)
-                workbook.active.cell(row=row, column=3, value=row_data['dup_artist'])
-                workbook.active.cell(row=row, column=4, value=row_data['dup_album'])
-                workbook.active.cell(row=row, column=5, value=row_data['dup_title'])
-                workbook.active.cell(row=row, column=6, value=row_data['org_length'])
-                workbook.active.cell(row=row, column=7, value=row_data['dup_length'])
-
-            if args.csv:
-                try:
-                    file_writer.writerow(row_data)
-                except ValueError as e:
-                    print("Error writing track '{title}' to CSV file: {e}".format(title=row_data['dup_title'], e=e),
-                          file=sys.stderr)
-
-            row += 1
-
-        last_number = d_row['number']
-        last_artist = d_row['artist']
-        last_album = d_row['album']
-        last_title = d_row['title']
-        last_length = d_row['length'].seconds + \
-            d_row['length'].microseconds/1000000 if d_row['length'] is not None else 0
+    for d_row, original in duplicates:
+        row_data = {
+            'dup_num':    d_row['number'],
+            'dup_of':     original['number'],
+            'dup_artist': d_row['artist'],
+            'dup_album':  d_row['album'],
+            'dup_title':  d_row['title'],
+            'org_length': seconds(original['length']),
+            'dup_length': seconds(d_row['length']),
+        }
+        very_verbose_print("row:{r}, data:{d}".format(r=row, d=row_data))
+
+        if args.excel:
+            workbook.active.cell(row=row, column=1, value=row_data['dup_num'])
+            workbook.active.cell(row=row, column=2, value=row_data['dup_of'])
+            workbook.active.cell(row=row, column=3, value=row_data['dup_artist'])
+            workbook.active.cell(row=row, column=4, value=row_data['dup_album'])
+            workbook.active.cell(row=row, column=5, value=row_data['dup_title'])
+            workbook.active.cell(row=row, column=6, value=row_data['org_length'])
+            workbook.active.cell(row=row, column=7, value=row_data['dup_length'])
+
+        if args.csv:
+            try:
+                file_writer.writerow(row_data)
+            except ValueError as e:
+                print("Error writing track '{title}' to CSV file: {e}".format(title=row_data['dup_title'], e=e),
+                      file=sys.stderr)
+
+        row += 1
 
     if args.excel:
         try:
@@ -11,22 +11,15 @@ from sqlalchemy import Unicode
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.dialects.mysql import insert as mysql_insert
 
 Base = declarative_base()
 
-class Artist(Base):
-    """An artist.
-
-    Contains a single artist and its related scheduling information,
-    such as the "age" to calculate "artist separation" for
-    the generated merge file. Maintains a persistent list of artists
-    and the number of units ago each was last scheduled.
-
-    """
+# The number of rows in each INSERT ... ON DUPLICATE KEY UPDATE.
+UPSERT_BATCH_SIZE = 1000
 
-    __tablename__ = 'artists'
-    name = Column(Unicode(34), primary_key=True)
-    age = Column(Integer, default=1)
+class ArtistAge():
+    """The age arithmetic shared by Artist and StationArtist."""
 
     def __repr__(self):
         """Represent ourself to the world."""
@@ -56,38 +49,96 @@ class Artist(Base):
         self.age -= value
         return self
 
+class Artist(ArtistAge, Base):
+    """An artist.
+
+    Contains a single artist and its related scheduling information,
+    such as the "age" to calculate "artist separation" for
+    the generated merge file. Maintains a persistent list of artists
+    and the number of units ago each was last scheduled.
+
+    """
+
+    __tablename__ = 'artists'
+    name = Column(Unicode(34), primary_key=True)
+    age = Column(Integer, default=1)
+
+class StationArtist(ArtistAge, Base):
+    """An artist in one station's namespace.
+
+    Like Artist, for a database shared by several stations (and
+    hosts). Each station has its own set of artist ages.
+
+    """
+
+    __tablename__ = 'station_artists'
+    station = Column(Unicode(64), primary_key=True)
+    name = Column(Unicode(255), primary_key=True)
+    age = Column(Integer, default=1)
+
+class RunProgress(Base):
+    """How far a checkpointed scheduler run has got.
+
+    The number of Days of the run whose artist ages have been saved,
+    written in the same transaction as the ages (see Artists.commit()),
+    so that a resumed run can tell whether the ages of its last Day
+    were saved before it stopped.
+
+    """
+
+    __tablename__ = 'run_progress'
+    run = Column(Unicode(64), primary_key=True)
+    days = Column(Integer, default=0)
+
 class Artists():
     """The collection of all artists."""
 
-    def __init__(self, method, location, separation):
+    def __init__(self, method, location, separation, station=None):
         """Make a group of artists.
 
-        :param method: The database backend method (sqlite, mysql,
-        etc.).
-        :param location: The location of the backend database.
+        :param method: The database backend method (sqlite,
+        mysql+mysqlconnector, etc.).
+        :param location: The location of the backend database (e.g.,
+        '//path/to/file.db' for sqlite, or
+        'user:password@host/database' for mysql).
         :param separation: The integer value representing the number
         of "units" that must transpire before an artist may be
         scheduled.
+        :param station: The name of the station's namespace in a
+        database shared by several stations (default: the unshared
+        'artists' table).
 
         """
         self.method = method
         self.location = location
         self.separation = separation
+        self.station = station
+        self.model = StationArtist if station is not None else Artist
+        # The namespace columns for new rows.
+        self.key = {'station': station} if station is not None else {}
 
         self.engine = create_engine(method + '://' + location, echo=False)
         session = sessionmaker(bind=self.engine)
         self.session = session()
         Base.metadata.create_all(self.engine)
 
+    def query(self):
+        """Return a query for the artists in our namespace."""
+        return self.session.query(self.model).filter_by(**self.key)
+
+    def __len__(self):
+        """Return the number of artists in the data source."""
+        return self.query().count()
+
     @property
     def all(self):
         """Read the data source and return all the rows a dictionary."""
-        return {a.name: a.age for a in self.session.query(Artist).all()}
+        return {a.name: a.age for a in self.query().all()}
 
     def add(self, artist):
         """Add this artist to the list."""
         try:
-            new_artist = Artist(name=artist.lower(), age=1)
+            new_artist = self.model(name=artist.lower(), age=1, **self.key)
             self.session.add(new_artist)
             #self.session.commit()
         except:
@@ -103,13 +154,13 @@ class Artists():
         we are scheduling.
 
         """
-        for one_of_all_artists in self.session.query(Artist).all():
+        for one_of_all_artists in self.query().all():
             one_of_all_artists += 1
 
         if artist is None:
             artist = 'xx-missing-artist-xx'
 
-        this_artist = self.session.query(Artist).filter_by(name=artist.lower()).first()
+        this_artist = self.query().filter_by(name=artist.lower()).first()
         if this_artist is None:
             self.add(artist)
         else:
@@ -124,7 +175,7 @@ class Artists():
         if artist is None:
             artist = 'xx-missing-artist-xx'
 
-        a = self.session.query(Artist).filter_by(name=artist.lower()).first()
+        a = self.query().filter_by(name=artist.lower()).first()
 
         if a is None:
             # Apparently we have not yet seen this artist.
@@ -136,3 +187,189 @@ class Artists():
             return False
 
         return True
+
+    def commit(self, progress=None):
+        """Save all changes to the artist ages in the data source.
+
+        :param progress: A tuple of a run identifier and the number of
+        its Days whose ages are now saved (see days_saved()), or None.
+
+        """
+        if progress is not None:
+            run, days = progress
+            self.session.merge(RunProgress(run=run, days=days))
+        self.session.commit()
+
+    def discard(self):
+        """Throw away the changes to the artist ages since the last commit()."""
+        self.session.rollback()
+
+    def days_saved(self, run):
+        """Return the number of Days of run whose ages have been saved (see commit())."""
+        progress = self.session.query(RunProgress).filter_by(run=run).first()
+        return progress.days if progress is not None else 0
+
+    def forget_run(self, run):
+        """Remove the progress of a finished run (see commit())."""
+        self.session.query(RunProgress).filter_by(run=run).delete(synchronize_session=False)
+        self.session.commit()
+
+    def age_all(self, ticks):
+        """Add ticks to the age of every artist (in one statement)."""
+        self.query().update({self.model.age: self.model.age + ticks}, synchronize_session=False)
+
+    def upsert(self, ages):
+        """Insert or replace the ages of the named artists.
+
+        On MySQL/MariaDB this uses batched INSERT ... ON DUPLICATE KEY
+        UPDATE statements, which lock only the affected rows so that
+        several schedulers may save their artist ages at the same time.
+
+        :param ages: A dict of ages indexed by (lowercase) artist name.
+
+        """
+        rows = [dict(name=name, age=age, **self.key) for name, age in ages.items()]
+
+        if self.engine.dialect.name in ('mysql', 'mariadb'):
+            for start in range(0, len(rows), UPSERT_BATCH_SIZE):
+                statement = mysql_insert(self.model.__table__).values(rows[start:start + UPSERT_BATCH_SIZE])
+                self.session.execute(statement.on_duplicate_key_update(age=statement.inserted.age))
+            return
+
+        for row in rows:
+            self.session.merge(self.model(**row))
+
+    def overlay(self, separation=None):
+        """Make an in-memory, copy-on-write view of this collection.
+
+        :param separation: The artist separation for the overlay
+        (default: the separation of this collection).
+
+        :returns: An ArtistsOverlay instance.
+
+        """
+        return ArtistsOverlay(self, separation)
+
+class ArtistsOverlay():
+    """A copy-on-write layer over the persisted artists.
+
+    Reads the persisted artist ages once and keeps all subsequent
+    changes in memory. The changes may be committed to the data
+    source or discarded, and the overlay may be forked to run several
+    trial schedules against the same baseline.
+
+    Rather than incrementing every age on every bump(), we count the
+    bumps ("ticks") and remember the tick at which each changed artist
+    was last reset.
+
+    """
+
+    def __init__(self, artists, separation=None, base=None, changes=None, ticks=0):
+        """Make an overlay.
+
+        :param artists: The Artists instance holding the persisted
+        artist ages.
+        :param separation: The integer value representing the number
+        of "units" that must transpire before an artist may be
+        scheduled (default: the separation of artists).
+        :param base: The persisted artist ages as a dict (default:
+        read them from artists). This is shared, never modified.
+        :param changes: A dict of artists changed in this layer,
+        indexed by name, valued by the tick at which each was reset.
+        :param ticks: The number of bumps in this layer.
+
+        """
+        self.artists = artists
+        self.separation = separation if separation is not None else artists.separation
+        self.base = base if base is not None else artists.all
+        self.changes = dict(changes) if changes else {}
+        self.ticks = ticks
+
+    def age(self, artist):
+        """Return the age of the (lowercase) named artist, or None if we have not seen it."""
+        if artist in self.changes:
+            return 1 + self.ticks - self.changes[artist]
+        if artist in self.base:
+            return self.base[artist] + self.ticks
+        return None
+
+    @property
+    def all(self):
+        """Return all the artists and their ages as a dictionary."""
+        ages = {name: age + self.ticks for name, age in self.base.items()}
+        ages.update({name: 1 + self.ticks - tick for name, tick in self.changes.items()})
+        return ages
+
+    def __len__(self):
+        """Return the number of artists in the overlay."""
+        return len(self.base.keys() | self.changes.keys())
+
+    def add(self, artist):
+        """Add this artist to the list."""
+        self.changes[artist.lower()] = self.ticks
+        return True
+
+    def bump(self, artist):
+        """Increment the age of all artists and reset the age of 'artist' to 1."""
+        if artist is None:
+            artist = 'xx-missing-artist-xx'
+
+        self.ticks += 1
+        self.changes[artist.lower()] = self.ticks
+
+    def ok_to_schedule(self, artist):
+        """Whether it's OK to schedule this artist.
+
+        Has this artist been scheduled more recently than "separation"
+        units?
+        """
+        if artist is None:
+            artist = 'xx-missing-artist-xx'
+
+        age = self.age(artist.lower())
+        if age is None:
+            # Apparently we have not yet seen this artist.
+            return self.add(artist)
+
+        return age >= self.separation
+
+    def fork(self, separation=None):
+        """Make a new overlay starting from the state of this one.
+
+        The persisted ages are shared, only the changes are copied.
+
+        :param separation: The artist separation for the new overlay
+        (default: the separation of this overlay).
+
+        :returns: A new ArtistsOverlay instance.
+
+        """
+        return ArtistsOverlay(self.artists,
+                              separation if separation is not None else self.separation,
+                              self.base, self.changes, self.ticks)
+
+    def discard(self):
+        """Throw away all the changes in this layer."""
+        self.changes = {}
+        self.ticks = 0
+
+    def commit(self, progress=None):
+        """Apply the changes in this layer to the persisted artist ages.
+
+        Ages are applied relative to the data source, so ages changed
+        there since we read them are preserved. The changes are saved
+        in one transaction with one UPDATE and batched upserts (see
+        Artists.upsert()). The overlay then starts over from the newly
+        persisted ages.
+
+        :param progress: The run progress to save in the same
+        transaction (see Artists.commit()), or None.
+
+        """
+        if self.ticks:
+            self.artists.age_all(self.ticks)
+        self.artists.upsert({name: 1 + self.ticks - tick for name, tick in self.changes.items()})
+        self.artists.commit(progress)
+
+        self.base = self.artists.all
+        self.discard()
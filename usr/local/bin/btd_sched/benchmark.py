@@ -0,0 +1,409 @@
+#!/usr/bin/env python3
+"""benchmark.py: time the inner loops of btd_sched without a database.
+
+Each benchmark runs one of the scheduler's hot paths on synthetic data
+of increasing size and prints a scaling curve: the time for each size
+and the growth exponent between consecutive sizes (1.0 is linear,
+2.0 is quadratic). Run this before and after a change to see
+algorithmic regressions, e.g.:
+
+  python3 benchmark.py --check
+  python3 benchmark.py --json before.json artists_overlay pool_sep50
+
+The benchmarks are:
+
+ - artists_overlay: ArtistsOverlay.ok_to_schedule() and bump() with
+   10^3 to 10^6 artists (a fixed number of operations)
+ - artists_sqlite: Artists.ok_to_schedule() and bump() on an
+   in-memory SQLite database (a fixed number of operations)
+ - pool_sep10, pool_sep50, pool_sep90: btd_sched.get_track_from_pool()
+   emptying half a bucket with an artist separation of 10, 50 and 90
+ - values: Batch.values() and Day.values() for a week with 8 to 512
+   Events and Scheduler Codes in each hour
+ - format: ms2HMS() and btd_sched.format_import_line() for a day's
+   worth of lines and more
+ - log_disabled: a debug message (see schedlib.Log) with debugging
+   disabled, as logged for every candidate track
+
+"""
+
+import sys
+import argparse
+import json
+import math
+import random
+import time
+import schedlib
+import btd_sched
+from artist import Artists
+from artist import ArtistsOverlay
+
+__version__ = '0.1.0'
+
+# The maximum time (in seconds) for one measurement. Larger sizes of
+# a benchmark are skipped once they are expected to take longer.
+DEFAULT_BUDGET = 2.0
+# Flag curves whose growth exceeds the expected exponent by this much.
+EXPONENT_TOLERANCE = 0.5
+SEED = 20240101
+
+class SyntheticGrid():
+    """A Reference Service grid that answers the schedlib queries from memory.
+
+    Stands in for RDDatabase when loading a schedlib.Grid (and the
+    Batch built from it). Every hour has the same number of Events;
+    the Events cycle through the Scheduler Codes.
+
+    """
+
+    def __init__(self, events_per_hour=15, codes=('A', 'B', 'C', 'D'), group='music'):
+        """Make a grid.
+
+        :param events_per_hour: The number of Events in each Clock.
+        :param codes: The Scheduler Codes used by the Events.
+        :param group: The Group of all the Events.
+
+        """
+        self.events_per_hour = events_per_hour
+        self.codes = codes
+        self.group = group
+
+    def event_name(self, hour, index):
+        """Return the name of the Event at index in hour."""
+        return "{g}-{c}".format(g=self.group, c=self.codes[(hour + index) % len(self.codes)])
+
+    def fetchall(self, query, query_args, dictionary=False, prepared=False):
+        """Answer the grid and fingerprint queries (see schedlib.Grid)."""
+        length = btd_sched.ONE_HOUR_MS // self.events_per_hour
+        if "ORDER BY sc.hour, cl.start_time" in query:
+            return [{'hour': hour, 'clock_name': "clock-{h}".format(h=hour % 24),
+                     'start_time': index * length, 'length': length,
+                     'event_name': self.event_name(hour, index), 'sched_group': self.group,
+                     'schedcode1': self.event_name(hour, index).split('-')[-1], 'schedcode2': '',
+                     'artist_sep': 0, 'title_sep': 0}
+                    for hour in range(168) for index in range(self.events_per_hour)]
+        if query.startswith("SELECT hour, clock_name"):
+            return [{'hour': hour, 'clock_name': "clock-{h}".format(h=hour % 24)} for hour in range(168)]
+        # The Clock and Event fingerprints.
+        return []
+
+def artist_names(count):
+    """Return count synthetic (lowercase) artist names."""
+    return ["artist {n:07d}".format(n=n) for n in range(count)]
+
+def make_tracks(count, artist_count, rng):
+    """Return a schedlib.PoolBucket of count tracks by artist_count artists.
+
+    The bucket is marked exhausted so that get_track_from_pool() never
+    asks the (absent) Library for more tracks.
+
+    """
+    artists = artist_names(artist_count)
+    bucket = schedlib.PoolBucket(schedlib.Track(100000 + n, rng.choice(artists), "title {n}".format(n=n),
+                                                rng.randint(120000, 420000))
+                                 for n in range(count))
+    bucket.exhausted = True
+    return bucket
+
+def make_import_lines(count, rng):
+    """Return count synthetic schedlib.ImportLine instances."""
+    lines = []
+    start_time = 0
+    for n in range(count):
+        length = rng.randint(120000, 420000)
+        hour = (start_time // 3600000) % 168
+        lines.append(schedlib.ImportLine(hour // 24, hour, start_time % 86400000, 100000 + n,
+                                         "a title that is longer than thirty-four characters {n}".format(n=n),
+                                         length))
+        start_time += length
+    return lines
+
+def init_scheduler():
+    """Set up the module globals that btd_sched expects from its __main__ block.
+
+    Logging is left unconfigured, so the scheduler's diagnostics are
+    disabled (as they are without -v).
+
+    """
+    btd_sched.GLOBAL_STATS = btd_sched.initial_stats()
+
+def bench_artists_overlay(size, rng):
+    """Return (setup, run, operations) for ArtistsOverlay at size artists."""
+    operations = 10000
+
+    def setup():
+        names = artist_names(size)
+        overlay = ArtistsOverlay(None, separation=size // 2, base=dict.fromkeys(names, size))
+        return overlay, [rng.choice(names) for _ in range(operations)]
+
+    def run(state):
+        overlay, picks = state
+        for name in picks:
+            if overlay.ok_to_schedule(name):
+                overlay.bump(name)
+
+    return setup, run, operations
+
+def bench_artists_sqlite(size, rng):
+    """Return (setup, run, operations) for Artists (SQLite) at size artists."""
+    operations = 20
+
+    def setup():
+        names = artist_names(size)
+        artists = Artists('sqlite', '', size // 2)
+        artists.upsert(dict.fromkeys(names, size))
+        artists.commit()
+        return artists, [rng.choice(names) for _ in range(operations)]
+
+    def run(state):
+        artists, picks = state
+        for name in picks:
+            if artists.ok_to_schedule(name):
+                artists.bump(name)
+
+    return setup, run, operations
+
+def bench_pool(separation):
+    """Return a benchmark of get_track_from_pool() at an artist separation.
+
+    Each bucket holds ten tracks per artist, so the separation
+    pressure is highest at the smallest sizes.
+
+    :param separation: The artist separation.
+
+    """
+    def bench(size, rng):
+        """Return (setup, run, operations) for a bucket of size tracks."""
+        artist_count = max(1, size // 10)
+        operations = size // 2
+
+        def setup():
+            init_scheduler()
+            active_pool = {'music': {'A': make_tracks(size, artist_count, rng)}}
+            used_pool = {'music': {'A': []}}
+            overlay = ArtistsOverlay(None, separation=separation,
+                                     base=dict.fromkeys(artist_names(artist_count), artist_count))
+            return active_pool, used_pool, overlay
+
+        def run(state):
+            active_pool, used_pool, overlay = state
+            for _ in range(operations):
+                btd_sched.get_track_from_pool(active_pool, 'music', 'A', used_pool, overlay, None)
+
+        return setup, run, operations
+
+    return bench
+
+def bench_values(size, rng):
+    """Return (setup, run, operations) for Batch.values() and Day.values().
+
+    A week of Days with size Events (and distinct Scheduler Codes) in
+    each hour, so both the number of Events and the number of values
+    grow with size.
+
+    """
+    grid = SyntheticGrid(size, ["code{n}".format(n=n) for n in range(size)])
+
+    def setup():
+        return schedlib.Batch('Production', '2024-01-01', btd_sched.DAYS_PER_WEEK, grid)
+
+    def run(batch):
+        batch.values('schedcode1')
+        for day in batch.days:
+            day.values('schedcode1')
+
+    return setup, run, btd_sched.DAYS_PER_WEEK * 24 * size
+
+def bench_format(size, rng):
+    """Return (setup, run, operations) for formatting size import lines."""
+
+    def setup():
+        return make_import_lines(size, rng)
+
+    def run(lines):
+        for line in lines:
+            btd_sched.format_import_line(line)
+
+    return setup, run, size
+
+def bench_log_disabled(size, rng):
+    """Return (setup, run, operations) for size disabled debug messages.
+
+    The message is the one logged for every candidate track in
+    get_track_from_pool().
+
+    """
+
+    def setup():
+        return schedlib.Track(100000, 'artist', 'title', 180000)
+
+    def run(track):
+        log = btd_sched.LOG
+        for index in range(size):
+            log.debug("get_track_from_pool: index: {i}, track: {c}", i=index, c=track.cart_number)
+
+    return setup, run, size
+
+# Bucket sizes for the pool benchmarks. Beyond these, removing a
+# track from the front of a list (memmove) dominates.
+POOL_SIZES = [1000, 2000, 4000, 8000, 16000, 32000]
+
+# name: (benchmark, sizes, expected growth exponent of the total time)
+BENCHMARKS = {
+    'artists_overlay': (bench_artists_overlay, [10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6], 0.0),
+    'artists_sqlite': (bench_artists_sqlite, [10 ** 2, 10 ** 3, 10 ** 4, 10 ** 5], 1.0),
+    'pool_sep10': (bench_pool(10), POOL_SIZES, 1.0),
+    'pool_sep50': (bench_pool(50), POOL_SIZES, 1.0),
+    'pool_sep90': (bench_pool(90), POOL_SIZES, 1.0),
+    'values': (bench_values, [8, 16, 32, 64, 128, 256, 512], 1.0),
+    'format': (bench_format, [10 ** 2, 10 ** 3, 10 ** 4, 10 ** 5], 1.0),
+    'log_disabled': (bench_log_disabled, [10 ** 4, 10 ** 5, 10 ** 6], 1.0),
+}
+
+def measure(bench, size, repeat):
+    """Time one size of a benchmark.
+
+    :returns: The best time (in seconds) of repeat runs, each with a
+    fresh setup, and the number of operations in each run.
+
+    """
+    setup, run, operations = bench(size, random.Random(SEED))
+    best = math.inf
+    for _ in range(repeat):
+        state = setup()
+        start = time.perf_counter()
+        run(state)
+        best = min(best, time.perf_counter() - start)
+    return best, operations
+
+def size_step(sizes, size):
+    """Return the ratio of the next size after size to size (1 for the last size)."""
+    index = sizes.index(size)
+    return sizes[index + 1] / size if index + 1 < len(sizes) else 1
+
+def scaling_curve(name, budget, repeat, quick=False):
+    """Run a benchmark at increasing sizes.
+
+    :param name: The name of the benchmark in BENCHMARKS.
+    :param budget: Stop before a size that is expected (from the
+    growth so far) to take longer than this (in seconds).
+    :param repeat: The number of runs of each size.
+    :param quick: Run only the three smallest sizes.
+
+    :returns: A dict containing the name, the expected and the fitted
+    exponents (see fitted_exponent()) and a list of points, each a dict containing the size, the time in
+    seconds, the number of operations and the growth exponent from
+    the previous point.
+
+    """
+    bench, sizes, expected = BENCHMARKS[name]
+    points = []
+    for size in sizes[:3] if quick else sizes:
+        seconds, operations = measure(bench, size, repeat)
+        point = {'size': size, 'seconds': seconds, 'operations': operations, 'exponent': None}
+        if points and points[-1]['seconds'] > 0 and seconds > 0:
+            point['exponent'] = (math.log(seconds / points[-1]['seconds']) /
+                                 math.log(size / points[-1]['size']))
+        points.append(point)
+        # Do not start a size that will take longer than the budget.
+        exponent = max(expected, point['exponent'] or expected)
+        if seconds * (size_step(sizes, size) ** exponent) > budget:
+            break
+
+    return {'name': name, 'expected': expected, 'exponent': fitted_exponent(points), 'points': points}
+
+def fitted_exponent(points):
+    """Return the least-squares slope of log(seconds) over log(size), or None.
+
+    Less sensitive to noise in single measurements than the exponent
+    between consecutive points.
+
+    """
+    logs = [(math.log(p['size']), math.log(p['seconds'])) for p in points if p['seconds'] > 0]
+    if len(logs) < 2:
+        return None
+    mean_x = sum(x for x, _ in logs) / len(logs)
+    mean_y = sum(y for _, y in logs) / len(logs)
+    return (sum((x - mean_x) * (y - mean_y) for x, y in logs) /
+            sum((x - mean_x) ** 2 for x, _ in logs))
+
+def regressed(curve):
+    """Whether a curve grows faster than expected."""
+    return curve['exponent'] is not None and curve['exponent'] > curve['expected'] + EXPONENT_TOLERANCE
+
+def print_curve(curve):
+    """Print a scaling curve as a table."""
+    print("{n}: exponent {x} (expected {e:.1f}){f}"
+          .format(n=curve['name'], e=curve['expected'],
+                  x='-' if curve['exponent'] is None else "{x:.2f}".format(x=curve['exponent']),
+                  f=' SLOW' if regressed(curve) else ''))
+    print("  {s:>9} {t:>12} {o:>12} {x:>9}".format(s='size', t='seconds', o='usec/op', x='exponent'))
+    for point in curve['points']:
+        print("  {s:>9} {t:>12.6f} {o:>12.3f} {x:>9}"
+              .format(s=point['size'], t=point['seconds'],
+                      o=point['seconds'] / point['operations'] * 1e6,
+                      x='-' if point['exponent'] is None else "{x:.2f}".format(x=point['exponent'])))
+    print()
+
+def main():
+    """Run the benchmarks named on the command line (default: all of them)."""
+    names = ARGS.benchmarks or list(BENCHMARKS)
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if unknown:
+        print("benchmark: ERROR: unknown benchmark(s) {u}. Try one of {b}."
+              .format(u=', '.join(unknown), b=', '.join(BENCHMARKS)), file=sys.stderr)
+        sys.exit(2)
+
+    init_scheduler()
+    curves = []
+    for name in names:
+        curve = scaling_curve(name, ARGS.budget, ARGS.repeat, ARGS.quick)
+        print_curve(curve)
+        curves.append(curve)
+
+    if ARGS.json:
+        with open(ARGS.json, 'w') as f:
+            json.dump(curves, f, indent=2)
+
+    if ARGS.check and any(regressed(curve) for curve in curves):
+        sys.exit(1)
+
+if __name__ == '__main__':
+
+    PARSER = argparse.ArgumentParser(prog='benchmark',
+                                     description='Time the inner loops of btd_sched on synthetic data.')
+    PARSER.add_argument('benchmarks',
+                        nargs='*',
+                        help='The benchmarks to run (default: all of them): {b}.'.format(b=', '.join(BENCHMARKS)))
+    PARSER.add_argument('-b', '--budget',
+                        type=float,
+                        help='Skip sizes expected to take longer than this (in seconds, default: {d}).'
+                        .format(d=DEFAULT_BUDGET),
+                        default=DEFAULT_BUDGET,
+                        action='store')
+    PARSER.add_argument('-c', '--check',
+                        help='Exit with status 1 if a curve grows faster than expected.',
+                        default=False,
+                        action='store_true')
+    PARSER.add_argument('-j', '--json',
+                        help='Save the curves to this (JSON) file for comparison with other runs.',
+                        action='store')
+    PARSER.add_argument('-q', '--quick',
+                        help='Run only the three smallest sizes of each benchmark.',
+                        default=False,
+                        action='store_true')
+    PARSER.add_argument('-r', '--repeat',
+                        type=int,
+                        help='Run each size this many times and keep the best time (default: 3).',
+                        default=3,
+                        action='store')
+    PARSER.add_argument('-V', '--version',
+                        help='Display this app version string.',
+                        action='version',
+                        version='%(prog)s: ' + __version__)
+
+    ARGS = PARSER.parse_args()
+
+    main()
+
+    sys.exit()
@@ -60,28 +60,74 @@ import sys
 import re
 import time
 import argparse
+import configparser
+import contextlib
+import cProfile
+import json
+import math
+import os
+import pickle
 import pprint
+import pstats
+import tempfile
+import uuid
+from datetime import datetime
+from datetime import timedelta
+from pathlib import Path
+from urllib.parse import quote
 import schedlib
 from artist import Artists
+from artist import ArtistsOverlay
+from library import LibrarySnapshot
+
+LOG = schedlib.Log('btd_sched')
 
 DEFAULT_REFERENCE_SERVICE = 'Production'
 ONE_HOUR_MS = (60 * 60 * 1000)
 ONE_DAY_MS = (24 * 60 * 60 * 1000)
 TOMORROW_FIRST_HOUR = (int(time.strftime("%u")) % 7 * 24)
 DEFAULT_ARTIST_SEPARATION = 200
-__version__ = '0.1.6'
-
-def get_event_sched_codes(timing):
+DEFAULT_ARTIST_DB_METHOD = 'sqlite'
+DEFAULT_ARTIST_DB_LOCATION = '//usr/local/etc/btd/artist_age.db'
+DEFAULT_ARTIST_DB_CONFIG = '/usr/local/etc/btd/artist_db.conf'
+# Overrides the Password in --artist-db-config.
+ARTIST_DB_PASSWORD_VARIABLE = 'BTD_ARTIST_DB_PASSWORD'
+DEFAULT_REFRESH_INTERVAL = 3600
+DAYS_PER_WEEK = 7
+DEFAULT_POOL_HISTORY = '/usr/local/etc/btd/pool_history.json'
+DEFAULT_CHECKPOINT = '/usr/local/etc/btd/btd_sched.checkpoint'
+# Fetch another page for a bucket when it holds this fraction of its
+# pool size (or less).
+POOL_REFILL_FRACTION = 0.25
+DEFAULT_POOL_MARGIN = 0.25
+POOL_HISTORY_RUNS = 10
+METRICS_FORMATS = ['json', 'prometheus']
+PROFILE_MODES = ['cprofile', 'sample']
+DAEMON_POLL_SECONDS = 5
+# A line of a Music Data Import file (see format_import_line()).
+IMPORT_LINE_RE = re.compile(r'^(?P<start>\d{2}:\d{2}:\d{2})  +(?P<cart>\d+)  (?P<title>.{34})  (?P<length>\d{2}:\d{2}:\d{2})$')
+# The number of Cart numbers in each lookup query (see get_cart_artists()).
+CART_LOOKUP_BATCH_SIZE = 500
+# Joins the Scheduler Codes of Events requiring two (see bucket_code()).
+SCHED_CODE_SEPARATOR = '&'
+__version__ = '0.1.9'
+
+# The Scheduler Codes of the Carts for the buckets of Events
+# requiring two Codes (see load_sched_code_index()).
+SCHED_CODE_INDEX = None
+
+def get_event_sched_codes(timing, grid):
     """Get Events and their Scheduler Codes.
 
     Get a count of Events and a list of Scheduler Codes used by Events
     in the Clocks for the chosen days. Returns a dict of dicts of
     lists with the outer dict indexed by Group and each containing
-    dicts indexed by Scheduler Codes of (empty) lists. We use these
-    per-Group Scheduler Codes to select Carts.
+    dicts indexed by Scheduler Codes (see bucket_code()) of (empty)
+    lists. We use these per-Group Scheduler Codes to select Carts.
 
-    :param timing: a data structure containing the first hour and last
-    hour (of the week) for this session.
+    :param timing: a data structure containing the ranges of hours (of
+    the week) for this session (see get_hour_ranges()).
+    :param grid: the schedlib.Grid of the Reference Service.
 
     :returns events_sched_codes, event_count: a list of unique
     Scheduler Codes for each Group used in Events in this session, the
@@ -89,72 +135,22 @@ def get_event_sched_codes(timing):
 
     """
     group_list = re.split(r',\s*', ARGS.groups.lower())
-    db = schedlib.RDDatabase(None)
 
     # A dict of dicts of lists.
     events_sched_codes = {g: {} for g in group_list}
-    codes_re = re.compile(r'^(?P<s1>.*)\|(?P<s2>.*)$')
-
-    query = ("SELECT COUNT(ev.sched_group) "
-             "FROM SERVICE_CLOCKS sc "
-             "LEFT JOIN CLOCK_LINES cl ON (sc.clock_name = cl.clock_name) "
-             "LEFT JOIN EVENTS ev ON (cl.event_name = ev.name) "
-             "WHERE sc.service_name = %s "
-             "AND ev.sched_group IN (")
-    query += ", ".join(["%s" for _ in group_list])
-    query += ") AND "
-    # Handle the cross-Sunday boundary.
-    if timing['first_hour'] > timing['last_hour']:
-        query += "(sc.hour BETWEEN %s AND 167 OR sc.hour BETWEEN 0 AND %s) "
-    else:
-        query += "sc.hour BETWEEN %s AND %s "
-    query_args = [ARGS.reference_service]
-    query_args += group_list
-    query_args += [timing['first_hour'], timing['last_hour']]
-    DEBUG_PRINT("get_event_sched_codes: COUNT query: {q}".format(q=query % tuple(query_args)))
-    # Apparently, this fetchall() returns a list of tuples. We get the
-    # integer inside by using the appropriate subscripts?
-    rows = db.fetchall(query, tuple(query_args))
-    event_count = rows[0][0]
-
-    query = ("SELECT DISTINCT LCASE(ev.sched_group) AS sched_group, "
-             "CONCAT(ev.have_code, '|', ev.have_code2) AS code, "
-             "ev.artist_sep AS artist_sep, ev.title_sep AS title_sep "
-             "FROM SERVICE_CLOCKS sc "
-             "LEFT JOIN CLOCK_LINES cl ON (sc.clock_name = cl.clock_name) "
-             "LEFT JOIN EVENTS ev ON (cl.event_name = ev.name) "
-             "WHERE sc.service_name = %s "
-             "AND ev.sched_group IN (")
-    query += ", ".join(["%s" for _ in group_list])
-    query += ") AND "
-    # Handle the cross-Sunday boundary.
-    if timing['first_hour'] > timing['last_hour']:
-        query += "(sc.hour BETWEEN %s AND 167 OR sc.hour BETWEEN 0 AND %s) "
-    else:
-        query += "sc.hour BETWEEN %s AND %s "
-    query += "ORDER BY sched_group, code"
-    query_args = [ARGS.reference_service]
-    query_args += group_list
-    query_args += [timing['first_hour'], timing['last_hour']]
-    DEBUG_PRINT("get_event_sched_codes: query: {q}".format(q=query % tuple(query_args)))
-    rows = db.fetchall(query, tuple(query_args), dictionary=True)
-
-    for row in rows:
-        if row['code'] == '|':
-            row['code'] = 'NoCode|'
-        matches = codes_re.search(row['code'])
-        if matches is None:
-            # We're looking only for Events with Scheduler Code
-            # constraints.
-            continue
+    event_count = 0
+    codes = set()
 
-        group = row['sched_group']
+    for first_hour, last_hour in timing['hour_ranges']:
+        for slot in grid.slots_between(first_hour, last_hour):
+            if slot.sched_group in events_sched_codes:
+                event_count += 1
+                codes.add((slot.sched_group, slot.schedcode1 or '', slot.schedcode2 or ''))
 
-        codes = matches.groupdict()
-        if codes['s1'] is not None and codes['s1'] != '' and codes['s1'] not in events_sched_codes[group]:
-            events_sched_codes[group][codes['s1']] = []
-        if codes['s2'] is not None and codes['s2'] != '' and codes['s2'] not in events_sched_codes[group]:
-            events_sched_codes[group][codes['s2']] = []
+    for group, schedcode1, schedcode2 in sorted(codes):
+        events_sched_codes[group].setdefault(bucket_code(schedcode1, schedcode2), [])
+
+    LOG.debug("get_event_sched_codes: {n} Events, Scheduler Codes: {c}", n=event_count, c=events_sched_codes)
 
     return events_sched_codes, event_count
 
@@ -172,6 +168,10 @@ def calculate_pool_size(batch, event_count):
     Scheduler Code and adding that to the same calculation for the
     "and code" Scheduler Code.
 
+    The grid repeats every week, so for batches longer than a week we
+    size the pool for one week and top it up after each day (see
+    run_session()).
+
     The pool size value is stored in the global configuration data
     structure `GLOBAL_STATS['pool_size']`
 
@@ -180,12 +180,259 @@ def calculate_pool_size(batch, event_count):
     :returns: An integer representing the the pool size
 
     """
-    VERBOSE_PRINT("calculate_pool_size: Most Primary Scheduler Codes: {m}, Events: {e}"
-                  .format(m=max(batch.values('schedcode1').values()), e=event_count))
+    LOG.verbose("calculate_pool_size: Most Primary Scheduler Codes: {m}, Events: {e}",
+                m=max(batch.values('schedcode1', DAYS_PER_WEEK).values()), e=event_count)
+
+    return (max(batch.values('schedcode1', DAYS_PER_WEEK).values()) +
+            max(batch.values('schedcode2', DAYS_PER_WEEK).values()))
+
+def initial_stats():
+    """Return a new (empty) set of statistics for a scheduling session."""
+    return {
+        'phases': {},
+        'pool_size': 0,
+        'bucket_pool_size': {},
+        'buckets': {},
+        'invalid_length': {},
+        'skipped': {},
+        'dry_pool': 0,
+        'pages': 0,
+    }
+
+@contextlib.contextmanager
+def phase(name):
+    """Time a phase of the pipeline.
+
+    The elapsed time is added to `GLOBAL_STATS['phases'][name]`. The
+    phases are 'grid_load', 'pool_fill', 'generate' and 'save'.
+
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        GLOBAL_STATS['phases'][name] = GLOBAL_STATS['phases'].get(name, 0.0) + time.perf_counter() - start
+
+def bucket_stats(group, schedcode):
+    """Return the usage statistics for one Group and Scheduler Code.
+
+    The statistics are kept in `GLOBAL_STATS['buckets']`, indexed by
+    "group|schedcode". They are saved with the pool history (see
+    save_pool_history()) for sizing the pool in later runs.
+
+    """
+    return GLOBAL_STATS['buckets'].setdefault('{g}|{s}'.format(g=group, s=schedcode),
+                                              {'used': 0, 'skipped': 0, 'dry': 0, 'deepest': 0})
+
+def bucket_code(schedcode1, schedcode2):
+    """Return the Scheduler Code of the pool bucket for an Event.
+
+    :param schedcode1: The Event's "Must have code" Scheduler Code (if any).
+    :param schedcode2: The Event's "and code" Scheduler Code (if any).
+    :returns: 'NoCode' for Events without Scheduler Codes, the Code of
+    Events with one, and both Codes joined by SCHED_CODE_SEPARATOR
+    for Events requiring both (see fetch_pool_page()). Codes are
+    compared without regard to case, so an Event requiring the same
+    Code twice has a one-Code bucket.
+
+    """
+    sched_codes = [code for code in (schedcode1, schedcode2) if code]
+    if len(sched_codes) == 2 and sched_codes[0].strip().lower() == sched_codes[1].strip().lower():
+        del sched_codes[1]
+    if not sched_codes:
+        return 'NoCode'
+
+    return SCHED_CODE_SEPARATOR.join(sched_codes)
+
+def load_sched_code_index(event_sched_codes_by_group, db):
+    """Read the Scheduler Codes of the Carts once for this session.
+
+    Sets SCHED_CODE_INDEX to a schedlib.SchedCodeIndex of the Codes in
+    the buckets of Events requiring two Codes (and of the Groups of
+    those Events), or to None if there are no such Events.
+
+    :param event_sched_codes_by_group: All the Scheduler Codes used by
+    all the Groups in Events for this session.
+    :param db: the RDDatabase (or LibrarySnapshot) of the Library.
+
+    """
+    global SCHED_CODE_INDEX
+
+    groups = set()
+    sched_codes = set()
+    for group in event_sched_codes_by_group:
+        for schedcode in event_sched_codes_by_group[group]:
+            if SCHED_CODE_SEPARATOR in schedcode:
+                groups.add(group)
+                sched_codes.update(schedcode.split(SCHED_CODE_SEPARATOR))
+    SCHED_CODE_INDEX = schedlib.SchedCodeIndex(db, sched_codes, groups) if sched_codes else None
+
+def get_bucket_pool_size(group, schedcode):
+    """Return the number of tracks to fetch for one Group and Scheduler Code.
+
+    :returns: The size from `GLOBAL_STATS['bucket_pool_size']` (see
+    calculate_bucket_demand() and calculate_bucket_pool_sizes()) if
+    there is one, otherwise `GLOBAL_STATS['pool_size']`.
+
+    """
+    return GLOBAL_STATS['bucket_pool_size'].get(group, {}).get(schedcode, GLOBAL_STATS['pool_size'])
+
+def load_pool_history(history_file):
+    """Read the pool statistics saved by previous runs.
+
+    :param history_file: The pathname of the JSON pool history file.
+    :returns: A dict of lists of run statistics indexed by Reference
+    Service name (empty if there is no usable history).
+
+    """
+    try:
+        with open(history_file) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        print("load_pool_history: WARNING: ignoring pool history '{f}' ({e})."
+              .format(f=history_file, e=e), file=sys.stderr)
+        return {}
+
+def save_pool_history(history_file, history):
+    """Add the statistics for this run to the pool history and save it.
+
+    Only the last POOL_HISTORY_RUNS runs for each Reference Service
+    are kept, and only the last run for each scheduled period (start
+    date and number of days), so a period scheduled again (e.g., by
+    repeated daemon requests) is counted once.
+
+    :param history_file: The pathname of the JSON pool history file.
+    :param history: The pool history from load_pool_history().
+
+    """
+    runs = history.setdefault(ARGS.reference_service, [])
+    runs[:] = [run for run in runs if (run['start_date'], run['days']) != (ARGS.start_date, ARGS.days)]
+    runs.append({
+        'start_date': ARGS.start_date,
+        'days': ARGS.days,
+        'buckets': GLOBAL_STATS['buckets'],
+    })
+    del runs[:-POOL_HISTORY_RUNS]
+
+    try:
+        with open(history_file, 'w') as f:
+            json.dump(history, f)
+    except OSError as e:
+        print("save_pool_history: WARNING: unable to save pool history '{f}' ({e})."
+              .format(f=history_file, e=e), file=sys.stderr)
+
+def calculate_bucket_pool_sizes(event_sched_codes_by_group, history):
+    """Size the fetch for each Group and Scheduler Code from previous runs.
+
+    For each bucket with history, we take the highest daily demand
+    (tracks used plus dry slots) seen in recent runs for this Reference
+    Service, scale it to this session (at most one week, see
+    calculate_pool_size()), add --pool-margin and then add the deepest
+    scan into the pool (tracks skipped for artist separation before
+    one was found). Tracks in NoCode buckets are not used up, so only
+    the scan depth counts for those.
+
+    Buckets without history keep the size from calculate_bucket_demand().
+
+    :param event_sched_codes_by_group: All the Scheduler Codes used by
+    all the Groups in Events for this session.
+    :param history: The pool history from load_pool_history().
+    :returns: A dict of dicts of pool sizes indexed by Group and
+    Scheduler Code.
+
+    """
+    runs = history.get(ARGS.reference_service, [])
+    window = min(ARGS.days, DAYS_PER_WEEK)
+    sizes = {}
+
+    for group in event_sched_codes_by_group:
+        for schedcode in event_sched_codes_by_group[group]:
+            key = '{g}|{s}'.format(g=group, s=schedcode)
+            samples = [(run['buckets'][key], run['days']) for run in runs if key in run['buckets']]
+            if not samples:
+                continue
+
+            deepest = max(b['deepest'] for b, _ in samples)
+            if 'NoCode' in schedcode:
+                daily_demand = 0
+            else:
+                daily_demand = max((b['used'] + b['dry']) / max(days, 1) for b, days in samples)
+            sizes.setdefault(group, {})[schedcode] = (
+                math.ceil(daily_demand * window * (1 + ARGS.pool_margin)) + deepest + 1)
+
+    LOG.verbose("calculate_bucket_pool_sizes: {s}", s=sizes)
+
+    return sizes
+
+def calculate_bucket_demand(batch, event_sched_codes_by_group, db):
+    """Size the fetch for each Group and Scheduler Code from the grid.
+
+    Count the slots for each Group and (primary and secondary)
+    Scheduler Codes in the Events of the batch (at most one week, see
+    calculate_pool_size()). Each bucket needs one track per slot, plus
+    the tracks it will skip because their artists were scheduled in
+    the last --artist-separation slots. We estimate the latter as this
+    bucket's share of those slots times the number of Carts per artist
+    in the bucket (so a bucket dominated by a few artists gets a
+    deeper pool).
 
-    return max(batch.values('schedcode1').values()) + max(batch.values('schedcode2').values())
+    The Carts with two Scheduler Codes are counted in SCHED_CODE_INDEX
+    (see load_sched_code_index()), the others in the Library.
 
-def fill_active_pool(event_sched_codes_by_group):
+    :param batch: An instance of Batch() (see schedlib.py)
+    :param event_sched_codes_by_group: All the Scheduler Codes used by
+    all the Groups in Events for this session.
+    :param db: the RDDatabase instance for this session.
+    :returns: A dict of dicts of pool sizes indexed by Group and
+    Scheduler Code.
+
+    """
+    slots = {}
+    for (group, schedcode1, schedcode2), count in batch.counts(['sched_group', 'schedcode1', 'schedcode2'],
+                                                               DAYS_PER_WEEK).items():
+        schedcode = bucket_code(schedcode1, schedcode2)
+        if group in event_sched_codes_by_group and schedcode in event_sched_codes_by_group[group]:
+            LOG.very_verbose("calculate_bucket_demand: {g}, {c1}|{c2}: {n} slots",
+                             g=group, c1=schedcode1, c2=schedcode2, n=count)
+            slots.setdefault(group, {}).setdefault(schedcode, 0)
+            slots[group][schedcode] += count
+
+    total_slots = sum(n for group in slots for n in slots[group].values())
+    recent_slots = min(ARGS.artist_separation, total_slots)
+    sizes = {}
+
+    for group in slots:
+        for schedcode in slots[group]:
+            if SCHED_CODE_SEPARATOR in schedcode:
+                sched_codes = schedcode.split(SCHED_CODE_SEPARATOR)
+                row = {'carts': SCHED_CODE_INDEX.count(group, sched_codes),
+                       'artists': SCHED_CODE_INDEX.artist_count(group, sched_codes)}
+            else:
+                if 'NoCode' in schedcode:
+                    query = ("SELECT COUNT(*) AS carts, COUNT(DISTINCT c.artist) AS artists "
+                             "FROM CART AS c "
+                             "WHERE c.group_name = %s")
+                    query_args = (group,)
+                else:
+                    query = ("SELECT COUNT(*) AS carts, COUNT(DISTINCT c.artist) AS artists "
+                             "FROM CART AS c "
+                             "LEFT JOIN CART_SCHED_CODES AS s ON (c.number = s.cart_number) "
+                             "WHERE c.group_name = %s "
+                             "AND s.sched_code = %s")
+                    query_args = (group, schedcode)
+                row = db.fetchone(query, query_args, dictionary=True, prepared=True)
+            carts_per_artist = row['carts'] / row['artists'] if row and row['artists'] else 1
+
+            blocked = recent_slots * slots[group][schedcode] / total_slots * carts_per_artist
+            sizes.setdefault(group, {})[schedcode] = slots[group][schedcode] + math.ceil(blocked) + 1
+
+    LOG.verbose("calculate_bucket_demand: {s}", s=sizes)
+
+    return sizes
+
+def fill_active_pool(event_sched_codes_by_group, db, pool_size=None):
     """Fill the "active pool" with tracks.
 
     Generate a dict (aka "pool") containing up to
@@ -194,12 +441,17 @@ def fill_active_pool(event_sched_codes_by_group):
     the Rivendell Database and in this app) to populate the Music Data
     Import file.
 
-    The data are structured as a dict of dicts of lists of dicts
-    containing the data returned from the SELECT statement in this
-    function.
+    The data are structured as a dict of dicts of lists
+    (schedlib.PoolBucket) of schedlib.Track containing the data
+    returned from the SELECT statement in fetch_pool_page().
 
     :param event_sched_codes_by_group: All the Scheduler Codes used by
     all the Groups in Events for this session.
+    :param db: the RDDatabase instance for this session. The two
+    variants of the query below are prepared once and reused for
+    each Group and Scheduler Code.
+    :param pool_size: The maximum number of tracks for each Group and
+    Scheduler Code (default: see get_bucket_pool_size()).
 
     :returns: A list of candidate tracks for this session.
 
@@ -207,73 +459,239 @@ def fill_active_pool(event_sched_codes_by_group):
     group_list = list(event_sched_codes_by_group)
 
     # A dict of dicts of lists of tracks.
-    active_pool = {g: {c: [] for c in event_sched_codes_by_group[g]} for g in group_list}
+    active_pool = {g: {c: schedlib.PoolBucket() for c in event_sched_codes_by_group[g]} for g in group_list}
 
     for group in event_sched_codes_by_group:
         for schedcode in event_sched_codes_by_group[group]:
-            # Some Events have no Scheduler Code constraint.
-            if 'NoCode' in schedcode:
-                sched_code_constraint = ""
-                query_args = (group,)
-            else:
-                sched_code_constraint = "AND s.sched_code = %s "
-                query_args = (group, schedcode)
-
-            # TODO: How does this break for multi-Cut Carts?
-            query = ("SELECT c.number AS cart_number, c.artist AS artist, c.title AS title, "
-                     "u.length AS length, "
-                     "s.sched_code AS cart_sched_code "
-                     "FROM CART AS c "
-                     "LEFT JOIN CUTS AS u ON (c.number = u.cart_number) "
-                     "LEFT JOIN CART_SCHED_CODES AS s ON (c.number = s.cart_number) "
-                     "WHERE c.group_name = %s "
-                     "AND u.length > 0 ")
-            query += sched_code_constraint
-            query += ("ORDER BY u.last_play_datetime ASC "
-                      "LIMIT %s")
-            query_args += (GLOBAL_STATS['pool_size'],)
-            DEBUG_PRINT("fill_active_pool: query: {q}".format(q=query % query_args))
-            rows = schedlib.RDDatabase(None).fetchall(query, query_args, dictionary=True)
-
-            for row in rows:
-                active_pool[group][schedcode].append(row)
+            fetch_pool_page(active_pool[group][schedcode], group, schedcode, db,
+                            pool_size if pool_size is not None else get_bucket_pool_size(group, schedcode))
 
     return active_pool
 
-def get_track_from_pool(active_pool, group, schedcode, used_pool, artist_list):
+def fetch_pool_page(bucket, group, schedcode, db, limit, exclude=None):
+    """Fetch the next page of tracks (schedlib.Track) for one Group and Scheduler Code.
+
+    Tracks are fetched in the order of their last play time (oldest
+    first) and Cart number. The page starts after the last track
+    fetched into bucket (keyset pagination), so tracks already fetched
+    are never fetched again.
+
+    For Events requiring two Scheduler Codes, the query selects the
+    Carts with the first and SCHED_CODE_INDEX those that also have the
+    second. The page is enlarged by the share of the Group's Carts
+    with the first Code that have both, so one page usually yields
+    limit tracks.
+
+    :param bucket: The schedlib.PoolBucket to which to add the tracks.
+    :param group: The Group for which to fetch tracks.
+    :param schedcode: The Scheduler Code (see bucket_code()) for which
+    to fetch tracks.
+    :param db: the RDDatabase instance for this session.
+    :param limit: The maximum number of tracks to fetch.
+    :param exclude: A set of Cart numbers not to add to the bucket.
+
+    :returns: The number of tracks added to bucket.
+
+    """
+    sched_codes = schedcode.split(SCHED_CODE_SEPARATOR)
+    mask = None
+    if len(sched_codes) > 1:
+        matching = SCHED_CODE_INDEX.count(group, sched_codes)
+        if not matching:
+            bucket.exhausted = True
+            return 0
+        mask = SCHED_CODE_INDEX.mask(sched_codes)
+        limit = math.ceil(limit * SCHED_CODE_INDEX.count(group, sched_codes[:1]) / matching)
+
+    # Some Events have no Scheduler Code constraint.
+    if 'NoCode' in schedcode:
+        sched_code_constraint = ""
+        query_args = (group,)
+    else:
+        sched_code_constraint = "AND s.sched_code = %s "
+        query_args = (group, sched_codes[0])
+
+    # One row per Cart, however many Cuts (and Scheduler Codes) it
+    # has. Rivendell rotates through the (playable) Cuts, so we use
+    # their average length, and the Cart's place in the rotation is
+    # that of its least recently played Cut. Carts that have never
+    # played sort first.
+    #
+    # That place is an aggregate, so no index orders the Carts by it,
+    # and each page still reads the Group's Carts. But the keyset
+    # condition is applied before the GROUP BY: a Cart is after the
+    # cursor unless one of its playable Cuts was played before the
+    # cursor (or at the cursor, for the Carts up to the cursor's). The
+    # NOT EXISTS looks that up in CUTS by Cart number, so the Carts
+    # already fetched are dropped without joining and aggregating all
+    # their Cuts and Scheduler Codes.
+    query = ("SELECT p.cart_number, p.artist, p.title, p.length, p.cuts, p.cart_sched_code, p.last_play "
+             "FROM (SELECT c.number AS cart_number, c.artist AS artist, c.title AS title, "
+             "ROUND(AVG(u.length)) AS length, "
+             "COUNT(DISTINCT u.cut_name) AS cuts, "
+             "MIN(s.sched_code) AS cart_sched_code, "
+             "MIN(COALESCE(u.last_play_datetime, '1000-01-01 00:00:00')) AS last_play "
+             "FROM CART AS c "
+             "LEFT JOIN CUTS AS u ON (c.number = u.cart_number) "
+             "LEFT JOIN CART_SCHED_CODES AS s ON (c.number = s.cart_number) "
+             "WHERE c.group_name = %s "
+             "AND u.length > 0 ")
+    query += sched_code_constraint
+    if bucket.cursor is not None:
+        query += ("AND NOT EXISTS (SELECT 1 FROM CUTS AS o "
+                  "WHERE o.cart_number = c.number AND o.length > 0 "
+                  "AND (COALESCE(o.last_play_datetime, '1000-01-01 00:00:00') < %s "
+                  "OR (COALESCE(o.last_play_datetime, '1000-01-01 00:00:00') = %s AND c.number <= %s))) ")
+        query_args += (bucket.cursor[0], bucket.cursor[0], bucket.cursor[1])
+    query += "GROUP BY c.number, c.artist, c.title) AS p "
+    query += ("ORDER BY p.last_play ASC, p.cart_number ASC "
+              "LIMIT %s")
+    query_args += (limit,)
+    if LOG.enabled(schedlib.DEBUG):
+        LOG.debug("fetch_pool_page: query: {q}", q=query % query_args)
+
+    tracks = [schedlib.Track(*row) for row in db.fetchall(query, query_args, prepared=True)]
+    if tracks:
+        bucket.cursor = (tracks[-1].last_play, tracks[-1].cart_number)
+    bucket.exhausted = len(tracks) < limit
+
+    added = 0
+    for track in tracks:
+        if mask is not None and not SCHED_CODE_INDEX.has_all(track.cart_number, mask):
+            continue
+        if exclude is None or track.cart_number not in exclude:
+            bucket.append(track)
+            added += 1
+
+    return added
+
+def top_up_bucket(active_pool, group, schedcode, used_pool, db):
+    """Fetch pages of tracks for a bucket until it is no longer low.
+
+    :param active_pool: The pool of candidate tracks for this session.
+    :param group: The Group of the bucket.
+    :param schedcode: The Scheduler Code of the bucket.
+    :param used_pool: The pool of tracks that we have scheduled for this session.
+    :param db: the RDDatabase instance for this session.
+
+    :returns: The number of tracks added to the bucket.
+
+    """
+    bucket = active_pool[group][schedcode]
+    page_size = get_bucket_pool_size(group, schedcode)
+    if bucket.exhausted or len(bucket) > page_size * POOL_REFILL_FRACTION:
+        # Called for every track we schedule: skip building the
+        # exclusion set unless we will fetch something.
+        return 0
+
+    exclude = {t.cart_number for t in bucket}
+    exclude.update(t.cart_number for t in used_pool[group][schedcode])
+    added = 0
+
+    while not bucket.exhausted and len(bucket) <= page_size * POOL_REFILL_FRACTION:
+        added += fetch_pool_page(bucket, group, schedcode, db, page_size, exclude)
+        exclude.update(t.cart_number for t in bucket)
+
+    if added:
+        GLOBAL_STATS['pages'] += 1
+        LOG.verbose("top_up_bucket: added {n} tracks to group '{g}', schedcode '{s}'",
+                    n=added, g=group, s=schedcode)
+
+    return added
+
+def refill_active_pool(active_pool, used_pool, event_sched_codes_by_group, db):
+    """Top up a (warm) active pool for another scheduling session.
+
+    Add buckets for Groups and Scheduler Codes we have not yet seen,
+    and refill buckets holding fewer than their pool size (see
+    get_bucket_pool_size()) tracks. Each bucket continues from where
+    its last page ended (see fetch_pool_page()), and tracks already in
+    the active pool or in the used pool are not added again, so the
+    size of each fetch does not grow with the used pool. If the
+    Library cannot fill a bucket, the tracks used longest ago in that
+    bucket go back into rotation.
+
+    :param active_pool: The pool of candidate tracks from a previous session.
+    :param used_pool: The pool of tracks scheduled in previous sessions.
+    :param event_sched_codes_by_group: All the Scheduler Codes used by
+    all the Groups in Events for this session.
+    :param db: the RDDatabase instance for this session.
+
+    :returns: Nothing. active_pool and used_pool are updated in place.
+
+    """
+    for group in event_sched_codes_by_group:
+        active_pool.setdefault(group, {})
+        used_pool.setdefault(group, {})
+        for schedcode in event_sched_codes_by_group[group]:
+            bucket = active_pool[group].setdefault(schedcode, schedlib.PoolBucket())
+            used = used_pool[group].setdefault(schedcode, [])
+            pool_size = get_bucket_pool_size(group, schedcode)
+            if len(bucket) >= pool_size:
+                continue
+
+            LOG.verbose("refill_active_pool: refilling group '{g}', schedcode '{s}' ({n} of {p} tracks)",
+                        g=group, s=schedcode, n=len(bucket), p=pool_size)
+
+            exclude = {t.cart_number for t in bucket}
+            exclude.update(t.cart_number for t in used)
+            while not bucket.exhausted and len(bucket) < pool_size:
+                fetch_pool_page(bucket, group, schedcode, db, pool_size - len(bucket), exclude)
+                exclude.update(t.cart_number for t in bucket)
+
+            recycle = min(pool_size - len(bucket), len(used))
+            if recycle > 0:
+                LOG.verbose("refill_active_pool: recycling {n} tracks in group '{g}', schedcode '{s}'",
+                            n=recycle, g=group, s=schedcode)
+                bucket.extend(used[:recycle])
+                del used[:recycle]
+
+def get_track_from_pool(active_pool, group, schedcode, used_pool, artist_list, db):
     """Intelligently get a track from the active pool.
 
     Get a track from the active pool, putting that track in the
     used pool. The "used" pool will be consulted if we run out of
     tracks in the pool (but this should *not* happen in real life).
 
+    When the bucket runs low, or none of its tracks may be scheduled,
+    fetch the next page of tracks from the Library (see
+    top_up_bucket()).
+
     :param active_pool: The pool of candidate tracks for this session.
     :param group: The Group for which to get a track from the pool.
     :param schedcode: The Scheduler Code for which to get a track from the pool.
     :param used_pool: The pool of tracks that we have scheduled for this session.
     :param artist_list: An ArtistList instance, used to keep track of
     how long ago each artist was scheduled.
+    :param db: the RDDatabase instance for this session.
     :returns: A data structure containing the details of this track
-    (see the SELECT query in fill_active_pool() for details).
+    (see the SELECT query in fetch_pool_page() for details).
 
     """
-    if active_pool[group][schedcode]:
+    top_up_bucket(active_pool, group, schedcode, used_pool, db)
+
+    track = None
+    start = 0
+    while active_pool[group][schedcode] and track is None:
         for index, track in enumerate(active_pool[group][schedcode]):
-            DEBUG_PRINT("get_track_from_pool: index: {i}, track: {c}"
-                        .format(i=index, c=track['cart_number']))
+            if index < start:
+                # Already rejected before we fetched another page.
+                continue
+            LOG.debug("get_track_from_pool: index: {i}, track: {c}",
+                      i=index, c=track.cart_number)
             # Take this track out of the pool if it is OK to schedule
             # this artist and if the track length is "sane".
-            if artist_list.ok_to_schedule(track['artist']):
+            if artist_list.ok_to_schedule(track.artist):
                 # Why are there ANY Cuts in the Library with Zero
                 # length?
-                if track['length'] <= 0:
+                if track.length <= 0:
                     print("get_track_from_pool: WARNING: Invalid Length. Removing from active_pool: selected: '{s}'"
                           .format(s=track), file=sys.stderr)
                     active_pool[group][schedcode].pop(index)
-                    if track['artist'] in GLOBAL_STATS['invalid_length']:
-                        GLOBAL_STATS['invalid_length'][track['artist']] += 1
+                    if track.artist in GLOBAL_STATS['invalid_length']:
+                        GLOBAL_STATS['invalid_length'][track.artist] += 1
                     else:
-                        GLOBAL_STATS['invalid_length'][track['artist']] = 1
+                        GLOBAL_STATS['invalid_length'][track.artist] = 1
                     continue
 
                 # Leave the track in the pool if there is no Group
@@ -284,161 +702,354 @@ def get_track_from_pool(active_pool, group, schedcode, used_pool, artist_list):
                 if 'NoCode' not in schedcode:
                     active_pool[group][schedcode].pop(index)
 
-                VERBOSE_PRINT("get_track_from_pool:Artist: '{a}', Title: '{t}', Length: {l}"
-                              .format(a=track['artist'], t=track['title'], l=track['length']))
+                LOG.verbose("get_track_from_pool:Artist: '{a}', Title: '{t}', Length: {l}",
+                            a=track.artist, t=track.title, l=track.length)
+                stats = bucket_stats(group, schedcode)
+                stats['used'] += 1
+                stats['deepest'] = max(stats['deepest'], index)
                 break
 
-            if track['artist'] in GLOBAL_STATS['skipped']:
-                GLOBAL_STATS['skipped'][track['artist']] += 1
+            bucket_stats(group, schedcode)['skipped'] += 1
+            if track.artist in GLOBAL_STATS['skipped']:
+                GLOBAL_STATS['skipped'][track.artist] += 1
             else:
-                GLOBAL_STATS['skipped'][track['artist']] = 1
-    else:
+                GLOBAL_STATS['skipped'][track.artist] = 1
+        else:
+            # Nothing in the bucket may be scheduled: look further
+            # into the Library.
+            track = None
+            start = len(active_pool[group][schedcode])
+            if active_pool[group][schedcode].exhausted:
+                break
+            page_size = get_bucket_pool_size(group, schedcode)
+            exclude = {t.cart_number for t in active_pool[group][schedcode]}
+            exclude.update(t.cart_number for t in used_pool[group][schedcode])
+            if fetch_pool_page(active_pool[group][schedcode], group, schedcode, db, page_size, exclude):
+                GLOBAL_STATS['pages'] += 1
+
+    if track is None:
         print("get_track_from_pool: NOTICE: unable to get a track from the pool in group '{g}', schedcode '{s}'"
               .format(g=group, s=schedcode), file=sys.stderr)
-        track = None
 
     if track is not None:
         used_pool[group][schedcode].append(track)
-        artist_list.bump(track['artist'])
+        artist_list.bump(track.artist)
 
     return track
 
-def generate_import_lines(active_pool, used_pool, artist_list, timing, batch):
-    """Create a list of tracks for further processing.
+def generate_import_lines(active_pool, used_pool, artist_list, batch, event_sched_codes_by_group, db,
+                          first_day=0, checkpoint_file=None, import_lines=None, run_id=None):
+    """Generate the "Import Lines" for each Day in the batch as it completes.
 
-    Generate a list of "Import Lines" to be saved in a Music Data Import
-    file.
+    The pool is topped up between Days. Once each Day has been
+    consumed (i.e., saved), the state of the session, including the
+    artist ages of the Day, is saved in checkpoint_file (see
+    save_checkpoint()). Then the artist ages are saved (see
+    checkpoint_artists()) with the number of Days done, so that a
+    resumed run can tell whether they were (see resume_artists()).
 
     :param active_pool: the list of candidate tracks for this session
     :param used_pool: the list of tracks used in this session
     :param artist_list: the list of artists and how long ago each was last scheduled for play
-    :param timing: the first hour and the last hour for this session
-    :param batch: an instance of Batch()
-    :returns: a list of tracks with timing suitable for saving to a Music Data Import file.
-
-    """
-    group_list = list(active_pool)
-    date_list = [batch.days[i].clock_date for i in range(len(batch.days))]
-    import_list = {d: [] for d in date_list}
-
-    # This gawdawful set of queries retrieves all the events (in time
-    # order) for the requested Groups and the requested day(s) from
-    # the Reference Service. Split into separate queries to properly
-    # handle the Sunday-Monday boundary.
-    query_base = ("SELECT sc.hour AS hour, cl.start_time AS starttime, "
-                  "cl.length AS length, LCASE(ev.sched_group) AS sched_group, "
-                  "ev.have_code AS schedcode1, ev.have_code2 as schedcode2 "
-                  "FROM SERVICE_CLOCKS AS sc "
-                  "LEFT JOIN CLOCK_LINES AS cl ON (sc.clock_name = cl.clock_name) "
-                  "LEFT JOIN EVENTS AS ev ON (cl.event_name = ev.name) "
-                  "WHERE sc.service_name = %s AND ")
-    if timing['first_hour'] > timing['last_hour']:
-        query = query_base + ("sc.hour BETWEEN %s AND 167 "
-                              "AND ev.sched_group IN (")
-        query += ", ".join(["%s" for _ in group_list])
-        query += ") ORDER BY sc.hour, cl.start_time; "
-        query += query_base + ("sc.hour BETWEEN 0 AND %s "
-                               "AND ev.sched_group IN (")
-        query += ", ".join(["%s" for _ in group_list])
-        query += ") ORDER BY sc.hour, cl.start_time;"
-        query_args = (ARGS.reference_service, timing['first_hour'],)
-        query_args += tuple(group_list)
-        query_args += (ARGS.reference_service, timing['last_hour'],)
-        query_args += tuple(group_list)
-    else:
-        query = query_base + ("sc.hour BETWEEN %s AND %s "
-                              "AND ev.sched_group IN (")
-        query += ", ".join(["%s" for _ in group_list])
-        query += ") ORDER BY sc.hour, cl.start_time;"
-        query_args = (ARGS.reference_service, timing['first_hour'], timing['last_hour'],)
-        query_args += tuple(group_list)
-
-    DEBUG_PRINT("generate_import_lines: query: {q}".format(q=query % query_args))
-
-    # mysql.connector.cursor.execute() returns an iterable when multi
-    # is True. This happens because I broke the request into 2 SELECT
-    # statements for the case of generating data import files for
-    # Sunday *and* Monday ; see
-    # https://dev.mysql.com/doc/connector-python/en/connector-python-api-mysqlcursor-execute.html
-    # (or equivalent) for details.
-    for result in schedlib.RDDatabase(None).execute(query, query_args, multi=True, dictionary=True):
-        VERY_VERBOSE_PRINT("generate_import_lines: NEW BATCH")
-        previous = {
-            'hour': -1,
-            'start_time': 0,
-            'length': 0,
-        }
-        rows = result.fetchall()
-
-        for row in rows:
-            # Rivendell "hours" are 0-167, so we need to coerce them
-            # into 0-23 for each day. And we need to do the
-            # calculations in milliseconds.
-            this_hour_ms = (int(row['hour']) % 24) * ONE_HOUR_MS
-            # Modulo 25 so we catch the last hour of the day.
-            next_hour_ms = (this_hour_ms + ONE_HOUR_MS) % (ONE_HOUR_MS * 25)
-
-            VERBOSE_PRINT("generate_import_lines: hour: {hr} ({ah}), next_hour_ms: {n}"
-                          .format(hr=row['hour'], ah=int(row['hour']) % 24, n=next_hour_ms))
-
-            # Use the Clock's Start Time if this is a new hour,
-            # otherwise use the length of previous track for the
-            # calulation.
-            if int(row['hour']) > previous['hour']:
-                start_time = this_hour_ms + int(row['starttime'])
-                previous['start_time'] = 0
-
-                # Similar for days.
-                if this_hour_ms == 0:
-                    batch_date = date_list.pop(0)
-
-                VERY_VERBOSE_PRINT("generate_import_lines: NEW HOUR: {h}, start_time: {sthms} ({st})"
-                                   .format(h=row['hour'], sthms=ms2HMS(start_time), st=start_time))
-            else:
-                start_time = previous['start_time'] + previous['length']
-                VERY_VERBOSE_PRINT("generate_import_lines: OLD HOUR: {h}, start_time: {sthms} ({st})"
-                                   .format(h=row['hour'], sthms=ms2HMS(start_time), st=start_time))
+    :param batch: an instance of Batch() (and its Grid)
+    :param event_sched_codes_by_group: All the Scheduler Codes used by
+    all the Groups in Events for this session.
+    :param db: the RDDatabase instance for this session.
+    :param first_day: the index of the first Day in batch to schedule
+    (the Days before it were scheduled before a --resume).
+    :param checkpoint_file: the pathname of the checkpoint file, or
+    None for no checkpoints.
+    :param import_lines: the import lines of the Days before
+    first_day, indexed by date (for the checkpoints).
+    :param run_id: the identifier of this run in the checkpoints and
+    the artist ages database.
+    :returns: a generator of dicts, one per Day, each containing a
+    list of tracks indexed by date (see generate_day_lines()).
 
-            if int(previous['start_time']) + int(previous['length']) >= next_hour_ms:
-                VERBOSE_PRINT("generate_import_lines: NOTICE: at {t}, hour {h} overfilled due to len: {l}"
-                              .format(t=ms2HMS(start_time), h=ms2HMS(this_hour_ms), l=previous['length']))
-                continue
+    """
+    import_lines = dict(import_lines) if import_lines else {}
 
-            if row['schedcode1'] == '':
-                DEBUG_PRINT("generate_import_lines: No have_code for Event at {hr}, {st}"
-                            .format(hr=row['hour'], st=row['starttime']))
-                row['schedcode1'] = 'NoCode'
-
-            track = get_track_from_pool(active_pool,
-                                        row['sched_group'],
-                                        row['schedcode1'],
-                                        used_pool,
-                                        artist_list)
-
-            if track is None:
-                VERBOSE_PRINT("generate_import_lines: NOTICE: track is 'None', using 'filler'")
-                GLOBAL_STATS['dry_pool'] += 1
-                track = {'cart_number': 0, 'title': 'MISSING', 'length': 0}
-
-            import_list[batch_date].append({
-                'day': int(row['hour'] / 24),
-                'hour': int(row['hour']),
-                'start_time': int(start_time),
-                'cart_number': track['cart_number'],
-                'title': track['title'],
-                'length': int(track['length']),
+    for index, day in enumerate(batch.days):
+        if index < first_day:
+            continue
+        if index > first_day:
+            with phase('pool_fill'):
+                refill_active_pool(active_pool, used_pool, event_sched_codes_by_group, db)
+        with phase('generate'):
+            day_lines = generate_day_lines(active_pool, used_pool, artist_list, day, batch.grid, db)
+        yield day_lines
+        if checkpoint_file:
+            import_lines.update(day_lines)
+            save_checkpoint(checkpoint_file, {
+                'run': checkpoint_run(),
+                'run_id': run_id,
+                'days_done': index + 1,
+                'active_pool': active_pool,
+                'used_pool': used_pool,
+                'artists': artists_state(artist_list),
+                'import_lines': import_lines,
+                'stats': {k: v for k, v in GLOBAL_STATS.items() if k != 'phases'},
             })
+        checkpoint_artists(artist_list, (run_id, index + 1) if checkpoint_file else None)
+
+def checkpoint_artists(artist_list, progress=None):
+    """Save the artist ages scheduled so far (except for --trial runs).
+
+    :param artist_list: the list of artists and how long ago each was last scheduled for play
+    :param progress: A tuple of the run identifier and the number of
+    Days done, to save with the ages (see Artists.commit()), or None.
+
+    """
+    if not ARGS.trial:
+        artist_list.commit(progress)
+
+def artists_state(artist_list):
+    """Return the artist ages not yet saved by checkpoint_artists().
+
+    :param artist_list: the list of artists and how long ago each was last scheduled for play
+    :returns: A dict of the 'changes' and 'ticks' of an ArtistsOverlay
+    (see artist.py), or None if artist_list saves all its changes.
+
+    """
+    if isinstance(artist_list, ArtistsOverlay):
+        return {'changes': artist_list.changes, 'ticks': artist_list.ticks}
+
+    return None
+
+def checkpoint_run():
+    """Return the command line options that identify a run for --resume."""
+    return {
+        'implementation_service': ARGS.implementation_service,
+        'reference_service': ARGS.reference_service,
+        'start_date': ARGS.start_date,
+        'days': ARGS.days,
+        'groups': ARGS.groups,
+        'trial': ARGS.trial,
+    }
+
+def save_checkpoint(checkpoint_file, state):
+    """Save the state of a scheduling session after a Day.
+
+    The file is replaced atomically, so a crash leaves the previous
+    checkpoint intact. If the checkpoint cannot be saved, the run
+    stops before the artist ages of the Day are saved, so that it can
+    still be resumed from the previous checkpoint.
 
-            previous['hour'] = row['hour']
-            previous['start_time'] = start_time
-            previous['length'] = track['length']
+    :param checkpoint_file: The pathname of the checkpoint file.
+    :param state: A dict of the run (see checkpoint_run()) and its
+    identifier, the number of Days done, the active and used pools,
+    the artist state (see artists_state()), the import lines so far
+    and GLOBAL_STATS.
+
+    """
+    temp_file = checkpoint_file + '.tmp'
+    try:
+        with open(temp_file, 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        Path(temp_file).replace(checkpoint_file)
+    except OSError as e:
+        print("save_checkpoint: ERROR: unable to save checkpoint '{f}' ({e}), stopping."
+              .format(f=checkpoint_file, e=e), file=sys.stderr)
+        sys.exit(1)
+
+    LOG.verbose("save_checkpoint: saved {n} Day(s) to '{f}'.", n=state['days_done'], f=checkpoint_file)
+
+def load_checkpoint(checkpoint_file):
+    """Read the checkpoint of an interrupted run.
+
+    :param checkpoint_file: The pathname of the checkpoint file.
+    :returns: The state saved by save_checkpoint(), or None if there is
+    no usable checkpoint for this run (same Services, dates, Groups
+    and --trial).
+
+    """
+    try:
+        with open(checkpoint_file, 'rb') as f:
+            state = pickle.load(f)
+    except FileNotFoundError:
+        LOG.verbose("load_checkpoint: no checkpoint '{f}', starting from the beginning.", f=checkpoint_file)
+        return None
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError) as e:
+        print("load_checkpoint: WARNING: ignoring checkpoint '{f}' ({e})."
+              .format(f=checkpoint_file, e=e), file=sys.stderr)
+        return None
+
+    if state.get('run') != checkpoint_run():
+        print("load_checkpoint: WARNING: ignoring checkpoint '{f}' of a different run ({r})."
+              .format(f=checkpoint_file, r=state.get('run')), file=sys.stderr)
+        return None
+    if 'run_id' not in state:
+        print("load_checkpoint: WARNING: ignoring checkpoint '{f}' saved by an older version."
+              .format(f=checkpoint_file), file=sys.stderr)
+        return None
+
+    LOG.verbose("load_checkpoint: resuming after {n} Day(s) from '{f}'.", n=state['days_done'], f=checkpoint_file)
+
+    return state
+
+def abandon_checkpoint(checkpoint_file, artist_list):
+    """Forget the run of a checkpoint that a new run will replace.
+
+    The progress of that run (see resume_artists()) is removed from
+    the artist ages database, as it can no longer be resumed.
+
+    :param checkpoint_file: The pathname of the checkpoint file.
+    :param artist_list: the list of artists and how long ago each was last scheduled for play
+
+    """
+    try:
+        with open(checkpoint_file, 'rb') as f:
+            state = pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+        return
+
+    if isinstance(state, dict) and state.get('run_id') is not None:
+        LOG.verbose("abandon_checkpoint: replacing the checkpoint of run {r}.", r=state['run_id'])
+        artist_list.artists.forget_run(state['run_id'])
+
+def resume_artists(artist_list, resume):
+    """Restore the artist ages of an interrupted run.
+
+    The checkpoint of each Day is saved before the artist ages of the
+    Day (see generate_import_lines()). If the run stopped in between,
+    the ages in the checkpoint have not been saved: restore them to
+    artist_list and save them now.
+
+    :param artist_list: the list of artists and how long ago each was last scheduled for play
+    :param resume: the state of the run (see load_checkpoint()).
+
+    """
+    if resume['artists'] is None:
+        return
+
+    if not ARGS.trial:
+        days_saved = artist_list.artists.days_saved(resume['run_id'])
+        if days_saved == resume['days_done']:
+            LOG.verbose("resume_artists: the artist ages of Day {n} were saved.", n=days_saved)
+            return
+        if days_saved != resume['days_done'] - 1:
+            print("resume_artists: ERROR: the artist ages of {s} Day(s) of this run were saved, "
+                  "but the checkpoint is of {n} Day(s); not resuming."
+                  .format(s=days_saved, n=resume['days_done']), file=sys.stderr)
+            sys.exit(1)
+
+    artist_list.changes = resume['artists']['changes']
+    artist_list.ticks = resume['artists']['ticks']
+    checkpoint_artists(artist_list, (resume['run_id'], resume['days_done']))
+
+def remove_checkpoint(checkpoint_file):
+    """Remove the checkpoint of a completed run."""
+    try:
+        Path(checkpoint_file).unlink()
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        print("remove_checkpoint: WARNING: unable to remove checkpoint '{f}' ({e})."
+              .format(f=checkpoint_file, e=e), file=sys.stderr)
+
+def generate_day_lines(active_pool, used_pool, artist_list, day, grid, db, hours=None):
+    """Create a list of tracks for further processing.
+
+    Generate a list of "Import Lines" for one Day (or some hours of
+    it) to be saved in a Music Data Import file.
+
+    :param active_pool: the list of candidate tracks for this session
+    :param used_pool: the list of tracks used in this session
+    :param artist_list: the list of artists and how long ago each was last scheduled for play
+    :param day: an instance of Day() from the Batch for this session
+    :param grid: the schedlib.Grid of the Reference Service.
+    :param db: the RDDatabase instance for this session.
+    :param hours: the first and last hour of the week to schedule
+    (default: the whole Day, see reschedule_window()).
+    :returns: a dict containing a list of schedlib.ImportLine (tracks
+    with timing suitable for saving to a Music Data Import file)
+    indexed by date.
+
+    """
+    import_list = {day.clock_date: []}
+    first_hour, last_hour = hours if hours is not None else (day.first_hour, day.last_hour)
+
+    LOG.very_verbose("generate_import_lines: NEW DAY: {d}", d=day.clock_date)
+    previous = {
+        'hour': -1,
+        'start_time': 0,
+        'length': 0,
+    }
+
+    # The Events (in time order) for the Groups in the pool. A Day
+    # never crosses the Sunday-Monday boundary.
+    for slot in grid.slots_between(first_hour, last_hour):
+        if slot.sched_group not in active_pool:
+            continue
+
+        # Rivendell "hours" are 0-167, so we need to coerce them
+        # into 0-23 for each day. And we need to do the
+        # calculations in milliseconds.
+        this_hour_ms = (slot.hour % 24) * ONE_HOUR_MS
+        # Modulo 25 so we catch the last hour of the day.
+        next_hour_ms = (this_hour_ms + ONE_HOUR_MS) % (ONE_HOUR_MS * 25)
+
+        LOG.verbose("generate_import_lines: hour: {hr} ({ah}), next_hour_ms: {n}",
+                    hr=slot.hour, ah=slot.hour % 24, n=next_hour_ms)
+
+        # Use the Clock's Start Time if this is a new hour,
+        # otherwise use the length of previous track for the
+        # calulation.
+        if slot.hour > previous['hour']:
+            start_time = this_hour_ms + slot.start_time
+            previous['start_time'] = 0
+
+            if LOG.enabled(schedlib.VERY_VERBOSE):
+                LOG.very_verbose("generate_import_lines: NEW HOUR: {h}, start_time: {sthms} ({st})",
+                                 h=slot.hour, sthms=ms2HMS(start_time), st=start_time)
+        else:
+            start_time = previous['start_time'] + previous['length']
+            if LOG.enabled(schedlib.VERY_VERBOSE):
+                LOG.very_verbose("generate_import_lines: OLD HOUR: {h}, start_time: {sthms} ({st})",
+                                 h=slot.hour, sthms=ms2HMS(start_time), st=start_time)
+
+        if int(previous['start_time']) + int(previous['length']) >= next_hour_ms:
+            if LOG.enabled(schedlib.VERBOSE):
+                LOG.verbose("generate_import_lines: NOTICE: at {t}, hour {h} overfilled due to len: {l}",
+                            t=ms2HMS(start_time), h=ms2HMS(this_hour_ms), l=previous['length'])
+            continue
+
+        schedcode = bucket_code(slot.schedcode1, slot.schedcode2)
+        if schedcode == 'NoCode':
+            LOG.debug("generate_import_lines: No have_code for Event at {hr}, {st}",
+                      hr=slot.hour, st=slot.start_time)
+
+        track = get_track_from_pool(active_pool,
+                                    slot.sched_group,
+                                    schedcode,
+                                    used_pool,
+                                    artist_list,
+                                    db)
+
+        if track is None:
+            LOG.verbose("generate_import_lines: NOTICE: track is 'None', using 'filler'")
+            GLOBAL_STATS['dry_pool'] += 1
+            bucket_stats(slot.sched_group, schedcode)['dry'] += 1
+            track = schedlib.Track(0, None, 'MISSING', 0)
+
+        import_list[day.clock_date].append(schedlib.ImportLine(int(slot.hour / 24),
+                                                               slot.hour,
+                                                               int(start_time),
+                                                               track.cart_number,
+                                                               track.title,
+                                                               track.length))
+
+        previous['hour'] = slot.hour
+        previous['start_time'] = start_time
+        previous['length'] = track.length
 
     return import_list
 
-def save_import_list(import_list):
+def save_import_list(import_days, db=None):
     """Save the import list.
 
-    Save the import list to one or more Music Data Import files. Files
+    Save the import list to one or more Music Data Import files, one
+    file for each date as it arrives from import_days. Files
     are created using the specified path template in the Music Data
     Import "Import Path" setting for the Implementation Service.
 
@@ -447,37 +1058,108 @@ def save_import_list(import_list):
     %s", and the name of the Implementation Service is substituted for
     "%s" (see the class definition in schedlib.OutputFile).
 
-    :param import_list: A list of tracks and timing values.
+    :param import_days: An iterable (e.g., generate_import_lines())
+    of dicts of lists of tracks and timing values indexed by date.
+    :param db: the RDDatabase holding the Service (see schedlib.OutputFile).
     :returns: Nothing
 
     """
-    DEBUG_PRINT("save_import_list: NEW BATCH")
+    LOG.debug("save_import_list: NEW BATCH")
+
+    for import_list in import_days:
+        with phase('save'):
+            save_import_day(import_list, db)
+
+def save_import_day(import_list, db=None):
+    """Save the import list for one or more dates.
+
+    :param import_list: A dict of lists of schedlib.ImportLine indexed
+    by date.
+    :param db: the RDDatabase holding the Service (see schedlib.OutputFile).
+    :returns: Nothing
 
+    """
     for import_date in import_list:
-        import_file = schedlib.OutputFile(ARGS.implementation_service, import_date, ARGS.verbose > 0)
+        import_file = schedlib.OutputFile(ARGS.implementation_service, import_date, ARGS.output_dir, db)
+        import_file.make_directory()
         import_file.make_pathname()
-        VERBOSE_PRINT("save_import_list: Date: '{d}' File: '{f}'."
-                      .format(d=import_date, f=import_file.fullpath))
+        LOG.verbose("save_import_list: Date: '{d}' File: '{f}'.",
+                    d=import_date, f=import_file.fullpath)
 
         with open(import_file.fullpath, 'w') as output_file:
 
             for track in import_list[import_date]:
 
-                VERY_VERBOSE_PRINT("save_import_list: Date: {d}, Hour: {h}."
-                                   .format(d=import_date, h=track['hour']))
-
-                # The spacing in this print statement must match the values
-                # set in RDAdmin->Manage Services->[IMPLEMENTATION SERVICE]
-                # See module docstring for details.
-                #              |         |       | 2         3         4         5 |       6         7         8
-                #              012345678901234567890123456789012345678901234567890123456789012345678901234567890
-                output_line = "{start:8}  {track:6}  {title:<34}  {length:8}\n".format(start=ms2HMS(track['start_time']),
-                                                                                       track=track['cart_number'],
-                                                                                       title=track['title'][:34],
-                                                                                       length=ms2HMS(track['length']))
-                VERBOSE_PRINT(output_line, end='')
+                LOG.very_verbose("save_import_list: Date: {d}, Hour: {h}.",
+                                 d=import_date, h=track.hour)
+
+                output_line = format_import_line(track)
+                LOG.verbose("{l}", l=output_line.rstrip('\n'))
                 output_file.write(output_line)
 
+def format_import_line(track):
+    """Format one line of a Music Data Import file.
+
+    :param track: A schedlib.ImportLine.
+    :returns: The line (with a trailing newline).
+
+    """
+    # The spacing in this print statement must match the values
+    # set in RDAdmin->Manage Services->[IMPLEMENTATION SERVICE]
+    # See module docstring for details.
+    #       |         |       | 2         3         4         5 |       6         7         8
+    #       012345678901234567890123456789012345678901234567890123456789012345678901234567890
+    return "{start:8}  {track:6}  {title:<34}  {length:8}\n".format(start=ms2HMS(track.start_time),
+                                                                    track=track.cart_number,
+                                                                    title=track.title[:34],
+                                                                    length=ms2HMS(track.length))
+
+def read_import_file(import_date, first_hour=0, output_dir=None, db=None):
+    """Read a Music Data Import file written by save_import_day().
+
+    :param import_date: The date (as 'YYYY-MM-DD') of the file.
+    :param first_hour: The first hour of the week of the date (see
+    get_first_hour_from_date()).
+    :param output_dir: The directory of the file (default: that of
+    the Music Data Import Path of the Implementation Service).
+    :param db: the RDDatabase holding the Service (see schedlib.OutputFile).
+    :returns: A list of schedlib.ImportLine (in the order of the
+    file), or None if there is no file for the date or it is not a
+    Music Data Import file.
+
+    """
+    import_file = schedlib.OutputFile(ARGS.implementation_service, import_date, output_dir, db)
+    import_file.make_pathname()
+    try:
+        with open(import_file.fullpath) as input_file:
+            lines = input_file.read().splitlines()
+    except FileNotFoundError:
+        LOG.verbose("read_import_file: no import file '{f}'.", f=import_file.fullpath)
+        return None
+    except OSError as e:
+        print("read_import_file: WARNING: unable to read '{f}' ({e})."
+              .format(f=import_file.fullpath, e=e), file=sys.stderr)
+        return None
+
+    import_list = []
+    for number, line in enumerate(lines, 1):
+        match = IMPORT_LINE_RE.match(line)
+        if match is None:
+            print("read_import_file: WARNING: '{f}' line {n} is not an import line: '{l}'."
+                  .format(f=import_file.fullpath, n=number, l=line), file=sys.stderr)
+            return None
+
+        start_time = HMS2ms(match['start'])
+        hour = first_hour + start_time // ONE_HOUR_MS
+        import_list.append(schedlib.ImportLine(int(hour / 24),
+                                               hour,
+                                               start_time,
+                                               int(match['cart']),
+                                               match['title'].rstrip(),
+                                               HMS2ms(match['length'])))
+
+    return import_list
+
 def get_first_hour_from_date(start_date):
     """Get the first hour of a day of the week for a scheduling session.
 
@@ -535,6 +1217,26 @@ def get_last_hour_from_date(start_date, days=1):
 
     return (first_hour + ((days - 1) * 24) + 23) % 168
 
+def get_hour_ranges(start_date, days=1):
+    """Get the hours of the week used in a scheduling session.
+
+    :param start_date: The start date for this session as 'YYYY-MM-DD'
+    :param days: The number of days to pick tracks for this session.
+    :returns: A list of (first hour, last hour) tuples of week-hours
+    (Zero-based). Sessions crossing the Sunday-Monday boundary have
+    two ranges, sessions of a week or more use the whole week.
+
+    """
+    if days >= DAYS_PER_WEEK:
+        return [(0, 167)]
+
+    first_hour = get_first_hour_from_date(start_date)
+    last_hour = get_last_hour_from_date(start_date, days)
+    if first_hour > last_hour:
+        return [(first_hour, 167), (0, last_hour)]
+
+    return [(first_hour, last_hour)]
+
 def ms2HMS(ms):
     """Convert "ms" milliseconds into a human-readable string.
 
@@ -551,45 +1253,670 @@ def ms2HMS(ms):
     hms = "{hh:02d}:{mm:02d}:{ss:02d}".format(hh=hours, mm=minutes, ss=seconds)
     return hms
 
-def main():
-    """Keep the main thing the main thing.
+def HMS2ms(hms):
+    """Convert a string from ms2HMS() back into milliseconds.
 
-    Prepare a data import file for merging with a Log using Rivendell's
-    RDLogManager.
+    :param hms: A string formatted as 'HH:MM:SS'
+    :returns: The (integer) number of milliseconds
 
     """
-    # Seed the list of artists and when they were last scheduled from storage.
-    artist_list = Artists('sqlite', '//usr/local/etc/btd/artist_age.db', ARGS.artist_separation)
+    hours, minutes, seconds = (int(part) for part in hms.split(':'))
 
-    # Use the counter in Batch() to get the number of each Scheduler
-    # Code for this session.
-    batch = schedlib.Batch(ARGS.reference_service, ARGS.start_date, ARGS.days)
+    return ((hours * 60 + minutes) * 60 + seconds) * 1000
 
-    timing = {
-        'first_hour': get_first_hour_from_date(ARGS.start_date),
-        'last_hour' : get_last_hour_from_date(ARGS.start_date, ARGS.days),
-    }
+def hour_window(spec):
+    """Parse a --window setting.
+
+    :param spec: A string 'FIRST[-LAST]' of hours of the day (0 to 23).
+    :returns: A tuple of the first and last hour (inclusive).
+
+    """
+    first, _, last = spec.partition('-')
+    if not first.isdigit() or not (last or first).isdigit() or not int(first) <= int(last or first) <= 23:
+        raise ValueError("expected FIRST[-LAST] hours of the day (0 to 23), not '{s}'".format(s=spec))
+
+    return int(first), int(last or first)
+
+def use_trial_output_dir():
+    """Keep --trial runs from replacing the Music Data Import files.
+
+    Unless --output-dir names a directory, a trial run writes its
+    import files in a new temporary directory.
+
+    """
+    if ARGS.trial and not ARGS.output_dir:
+        ARGS.output_dir = tempfile.mkdtemp(prefix='btd_sched-trial-')
+        print("btd_sched: NOTICE: trial run: saving the import files in '{d}'."
+              .format(d=ARGS.output_dir), file=sys.stderr)
+
+def open_library():
+    """Open the Library snapshot named by --library.
+
+    :returns: A LibrarySnapshot (see library.py), or None to read the
+    Library from the Rivendell database.
+
+    """
+    if not ARGS.library:
+        return None
+
+    # Do not let LibrarySnapshot() create an empty snapshot.
+    try:
+        library = LibrarySnapshot(ARGS.library) if Path(ARGS.library).is_file() else None
+    except ValueError:
+        library = None
+    age = library.age() if library is not None else None
+    if age is None:
+        print("open_library: ERROR: '{f}' is not a Library snapshot (see library.py)."
+              .format(f=ARGS.library), file=sys.stderr)
+        sys.exit(1)
+    LOG.verbose("open_library: reading the Library from '{f}' (refreshed {h:.1f} hours ago).",
+                f=ARGS.library, h=age / 3600)
+
+    return library
+
+def artist_db_location():
+    """Return the location of the artist ages database, with its password.
+
+    The password is never given on the command line, where ps(1) and
+    the shell history would show it. It comes from the
+    BTD_ARTIST_DB_PASSWORD environment variable or from the Password
+    in the [ArtistDB] section of --artist-db-config (in the manner of
+    /etc/rd.conf for the Rivendell database).
+
+    :returns: --artist-db-location, with the password (if any) added
+    to its user name.
+
+    """
+    user, at, host = ARGS.artist_db_location.rpartition('@')
+    if not at:
+        # E.g., an sqlite file.
+        return ARGS.artist_db_location
+
+    if ':' in user:
+        print("btd_sched: ERROR: do not put the password in --artist-db-location, set it in '{f}' or in ${v}."
+              .format(f=ARGS.artist_db_config, v=ARTIST_DB_PASSWORD_VARIABLE), file=sys.stderr)
+        sys.exit(2)
+
+    password = os.environ.get(ARTIST_DB_PASSWORD_VARIABLE)
+    if password is None:
+        config = configparser.ConfigParser(interpolation=None)
+        try:
+            with open(ARGS.artist_db_config) as config_file:
+                config.read_file(config_file)
+        except FileNotFoundError:
+            pass
+        except (OSError, configparser.Error) as e:
+            print("btd_sched: ERROR: unable to read '{f}' ({e})."
+                  .format(f=ARGS.artist_db_config, e=e), file=sys.stderr)
+            sys.exit(1)
+        password = config.get('ArtistDB', 'Password', fallback=None)
+
+    if not password:
+        return ARGS.artist_db_location
+
+    return "{u}:{p}@{h}".format(u=user, p=quote(password, safe=''), h=host)
+
+def open_artist_list(checkpoint=False):
+    """Seed the list of artists and when they were last scheduled from storage.
+
+    :param checkpoint: Whether the run saves checkpoints (see
+    save_checkpoint()), which hold the artist ages of each Day until
+    they are saved.
+    :returns: An Artists instance, or an in-memory overlay of one for
+    --trial runs, checkpointed runs and shared (networked) databases,
+    where each checkpoint is saved with batched upserts.
 
-    event_sched_codes_by_group, event_count = get_event_sched_codes(timing)
-    GLOBAL_STATS['pool_size'] = calculate_pool_size(batch, event_count)
-    active_pool = fill_active_pool(event_sched_codes_by_group)
+    """
+    artist_list = Artists(ARGS.artist_db_method, artist_db_location(), ARGS.artist_separation, ARGS.station)
+    if ARGS.trial or checkpoint or ARGS.artist_db_method != 'sqlite':
+        # Work on an in-memory copy: the stored ages stay untouched
+        # until (and unless) we commit.
+        artist_list = artist_list.overlay()
 
-    # A dict of dicts of lists matching the dict in active_pool.
-    used_pool = {g: {c: [] for c in event_sched_codes_by_group[g]} for g in list(active_pool)}
+    return artist_list
 
-    import_list = generate_import_lines(active_pool, used_pool, artist_list, timing, batch)
+def run_session(db, artist_list, batch, active_pool=None, used_pool=None, library=None,
+                checkpoint_file=None, resume=None):
+    """Schedule tracks for the days in batch and save the import files.
 
-    # Save all changes to the artist age data. Is this actually needed? Prolly.
-    artist_list.session.commit()
+    :param db: the RDDatabase instance for this session.
+    :param artist_list: the list of artists and how long ago each was last scheduled for play
+    :param batch: an instance of Batch() covering ARGS.start_date and ARGS.days
+    :param active_pool: the pool of candidate tracks left from a
+    previous session, or None to fill a new one.
+    :param used_pool: the pool of tracks used in previous sessions
+    (ignored if active_pool is None).
+    :param library: where to read the Library (Carts, Cuts and
+    Scheduler Codes): a LibrarySnapshot (see open_library()), or None
+    to read it from db.
+    :param checkpoint_file: the pathname of the file in which to save
+    a checkpoint after each Day, or None for no checkpoints.
+    :param resume: the state of an interrupted run (see
+    load_checkpoint()) from which to continue, or None.
+    :returns: The active pool and the used pool, for use in a subsequent session.
 
-    save_import_list(import_list)
+    """
+    if library is None:
+        library = db
+
+    use_trial_output_dir()
+
+    first_day = 0
+    import_lines = None
+    run_id = None
+    if checkpoint_file:
+        run_id = uuid.uuid4().hex
+        if resume is None:
+            abandon_checkpoint(checkpoint_file, artist_list)
+    if resume is not None:
+        GLOBAL_STATS.update(resume['stats'])
+        active_pool = resume['active_pool']
+        used_pool = resume['used_pool']
+        resume_artists(artist_list, resume)
+        run_id = resume['run_id']
+        first_day = resume['days_done']
+        import_lines = resume['import_lines']
+        # In case the crash took any of them with it.
+        for import_date, lines in import_lines.items():
+            with phase('save'):
+                save_import_day({import_date: lines}, db)
+
+    timing = {
+        'hour_ranges': get_hour_ranges(ARGS.start_date, ARGS.days),
+    }
+
+    with phase('grid_load'):
+        event_sched_codes_by_group, event_count = get_event_sched_codes(timing, batch.grid)
+
+    with phase('pool_fill'):
+        GLOBAL_STATS['pool_size'] = calculate_pool_size(batch, event_count)
+        pool_history = load_pool_history(ARGS.pool_history)
+        load_sched_code_index(event_sched_codes_by_group, library)
+        GLOBAL_STATS['bucket_pool_size'] = calculate_bucket_demand(batch, event_sched_codes_by_group, library)
+        for group, sizes in calculate_bucket_pool_sizes(event_sched_codes_by_group, pool_history).items():
+            GLOBAL_STATS['bucket_pool_size'].setdefault(group, {}).update(sizes)
+        if active_pool is None:
+            active_pool = fill_active_pool(event_sched_codes_by_group, library)
+            # A dict of dicts of lists matching the dict in active_pool.
+            used_pool = {g: {c: [] for c in event_sched_codes_by_group[g]} for g in list(active_pool)}
+        else:
+            refill_active_pool(active_pool, used_pool, event_sched_codes_by_group, library)
+
+    # Schedule and save one Day at a time so that memory use does not
+    # grow with the number of days, and each file appears as soon as
+    # its Day is complete.
+    save_import_list(generate_import_lines(active_pool, used_pool, artist_list,
+                                           batch, event_sched_codes_by_group, library,
+                                           first_day, checkpoint_file, import_lines, run_id),
+                     db)
+
+    # The artist ages were saved after each Day; throw away the
+    # changes from a trial run.
+    if ARGS.trial:
+        artist_list.discard()
+
+    # Trial runs do not count towards the demand for real runs.
+    if not ARGS.trial:
+        save_pool_history(ARGS.pool_history, pool_history)
 
     if ARGS.verbose > 3:
         pprint.pprint(used_pool, stream=sys.stderr)
 
     if ARGS.stats:
+        GLOBAL_STATS['statement_cache'] = db.statement_stats()
+        GLOBAL_STATS['replica'] = db.replica_stats()
         pprint.pprint(GLOBAL_STATS, stream=sys.stderr)
 
+    if ARGS.metrics:
+        save_metrics(run_metrics(db, artist_list))
+
+    if checkpoint_file:
+        remove_checkpoint(checkpoint_file)
+        if not ARGS.trial:
+            artist_list.artists.forget_run(run_id)
+
+    return active_pool, used_pool
+
+def calculate_window_demand(slots, event_sched_codes_by_group):
+    """Size the fetch for each Group and Scheduler Code for a --window.
+
+    Like calculate_bucket_demand(), without querying the Library: each
+    bucket needs one track per slot, plus its share of the artists of
+    the --artist-separation tracks before and after the window.
+
+    :param slots: The slots (see schedlib.Grid) in the window.
+    :param event_sched_codes_by_group: All the Scheduler Codes used by
+    all the Groups in Events in the window.
+    :returns: A dict of dicts of pool sizes indexed by Group and
+    Scheduler Code.
+
+    """
+    slot_counts = {}
+    for slot in slots:
+        schedcode = bucket_code(slot.schedcode1, slot.schedcode2)
+        if slot.sched_group in event_sched_codes_by_group and schedcode in event_sched_codes_by_group[slot.sched_group]:
+            slot_counts.setdefault(slot.sched_group, {}).setdefault(schedcode, 0)
+            slot_counts[slot.sched_group][schedcode] += 1
+
+    total_slots = sum(n for group in slot_counts for n in slot_counts[group].values())
+    sizes = {}
+    for group in slot_counts:
+        for schedcode, count in slot_counts[group].items():
+            blocked = 2 * ARGS.artist_separation * count / total_slots
+            sizes.setdefault(group, {})[schedcode] = count + math.ceil(blocked) + 1
+
+    LOG.verbose("calculate_window_demand: {s}", s=sizes)
+
+    return sizes
+
+def get_cart_artists(cart_numbers, db):
+    """Look up the artists of some Carts.
+
+    :param cart_numbers: An iterable of Cart numbers.
+    :param db: the RDDatabase (or LibrarySnapshot) of the Library.
+    :returns: A dict of artists indexed by Cart number. Carts that are
+    no longer in the Library are left out.
+
+    """
+    cart_numbers = sorted(set(cart_numbers))
+    artists = {}
+    for start in range(0, len(cart_numbers), CART_LOOKUP_BATCH_SIZE):
+        numbers = tuple(cart_numbers[start:start + CART_LOOKUP_BATCH_SIZE])
+        query = ("SELECT c.number, c.artist FROM CART AS c "
+                 "WHERE c.number IN ({p})".format(p=', '.join(['%s'] * len(numbers))))
+        artists.update(db.fetchall(query, numbers))
+
+    return artists
+
+def reschedule_window(db, batch, library=None):
+    """Reschedule the --window hours of existing import files.
+
+    For each Day in batch, read its Music Data Import file, schedule
+    new tracks for the hours in the window and put them in place of
+    the tracks in those hours. The rest of the file is left as it
+    is.
+
+    The artist separation at the start of the window is rebuilt from
+    the tracks before it (in this file and the end of the previous
+    day's file, if any). The artists of the first --artist-separation
+    tracks after the window are not scheduled in it, and neither are
+    the Carts elsewhere in the file. The stored artist ages and the
+    pool history are neither used nor updated.
+
+    :param db: the RDDatabase instance for this session.
+    :param batch: an instance of Batch() covering ARGS.start_date and ARGS.days
+    :param library: where to read the Library (see run_session()).
+    :returns: Nothing.
+
+    """
+    if library is None:
+        library = db
+
+    first, last = ARGS.window
+    # Read the import files from here, even if a trial run saves them
+    # elsewhere.
+    source_dir = ARGS.output_dir
+    use_trial_output_dir()
+
+    for day in batch.days:
+        import_list = read_import_file(day.clock_date, day.first_hour, source_dir, db)
+        if import_list is None:
+            print("reschedule_window: ERROR: no import file to reschedule for {d}, skipping it."
+                  .format(d=day.clock_date), file=sys.stderr)
+            continue
+
+        hours = (day.first_hour + first, day.first_hour + last)
+        before = [line for line in import_list if line.hour < hours[0]]
+        after = [line for line in import_list if line.hour > hours[1]]
+
+        # The artist separation as of the start of the window.
+        previous_date = (datetime.strptime(day.clock_date, '%Y-%m-%d') - timedelta(days=1)).strftime('%Y-%m-%d')
+        recent = before[-ARGS.artist_separation:] if ARGS.artist_separation > 0 else []
+        if len(recent) < ARGS.artist_separation:
+            previous_list = read_import_file(previous_date, output_dir=source_dir, db=db) or []
+            recent = previous_list[len(recent) - ARGS.artist_separation:] + recent
+        following = after[:ARGS.artist_separation]
+
+        with phase('pool_fill'):
+            artists = get_cart_artists((line.cart_number for line in import_list + recent), library)
+            slots = batch.grid.slots_between(*hours)
+            artist_list = ArtistsOverlay(None, ARGS.artist_separation, base={})
+            for line in recent:
+                if line.cart_number in artists:
+                    artist_list.bump(artists[line.cart_number])
+            # No artist in the window may come back before the
+            # separation is over.
+            for line in following:
+                if line.cart_number in artists:
+                    artist = artists[line.cart_number] or 'xx-missing-artist-xx'
+                    artist_list.changes[artist.lower()] = artist_list.ticks + len(slots)
+
+            event_sched_codes_by_group, event_count = get_event_sched_codes({'hour_ranges': [hours]}, batch.grid)
+            GLOBAL_STATS['pool_size'] = event_count + 1
+            GLOBAL_STATS['bucket_pool_size'] = calculate_window_demand(slots, event_sched_codes_by_group)
+            load_sched_code_index(event_sched_codes_by_group, library)
+            active_pool = fill_active_pool(event_sched_codes_by_group, library)
+
+            # Keep the Carts elsewhere in this Day out of the window.
+            kept = [schedlib.Track(line.cart_number, artists.get(line.cart_number), line.title, line.length)
+                    for line in before + after]
+            kept_carts = {track.cart_number for track in kept}
+            for group in active_pool:
+                for bucket in active_pool[group].values():
+                    bucket[:] = [track for track in bucket if track.cart_number not in kept_carts]
+            used_pool = {g: {c: list(kept) for c in event_sched_codes_by_group[g]} for g in list(active_pool)}
+
+        with phase('generate'):
+            day_lines = generate_day_lines(active_pool, used_pool, artist_list, day, batch.grid, library, hours)
+
+        LOG.verbose("reschedule_window: {d}: replacing {o} tracks in hours {f}-{l} with {n} tracks.",
+                    d=day.clock_date, o=len(import_list) - len(before) - len(after),
+                    f=first, l=last, n=len(day_lines[day.clock_date]))
+
+        with phase('save'):
+            save_import_day({day.clock_date: before + day_lines[day.clock_date] + after}, db)
+
+    if ARGS.stats:
+        GLOBAL_STATS['statement_cache'] = db.statement_stats()
+        GLOBAL_STATS['replica'] = db.replica_stats()
+        pprint.pprint(GLOBAL_STATS, stream=sys.stderr)
+
+def run_metrics(db, artist_list):
+    """Collect the metrics for this run.
+
+    The 'queries', 'statement_cache' and 'replica' counts are those of
+    db, which (in --daemon mode) go on counting across requests; the
+    rest are for this run only.
+
+    :param db: the RDDatabase instance for this session.
+    :param artist_list: the list of artists and how long ago each was last scheduled for play
+    :returns: A dict of metrics (see save_metrics()).
+
+    """
+    return {
+        'time': int(time.time()),
+        'reference_service': ARGS.reference_service,
+        'implementation_service': ARGS.implementation_service,
+        'start_date': ARGS.start_date,
+        'days': ARGS.days,
+        'phases': dict(GLOBAL_STATS['phases']),
+        'queries': db.query_count,
+        'statement_cache': db.statement_stats(),
+        'replica': db.replica_stats(),
+        'pool_size': {'{g}|{s}'.format(g=group, s=schedcode): size
+                      for group in GLOBAL_STATS['bucket_pool_size']
+                      for schedcode, size in GLOBAL_STATS['bucket_pool_size'][group].items()},
+        'pages': GLOBAL_STATS['pages'],
+        'dry_pool': GLOBAL_STATS['dry_pool'],
+        'skipped': sum(GLOBAL_STATS['skipped'].values()),
+        'invalid_length': sum(GLOBAL_STATS['invalid_length'].values()),
+        'artists': len(artist_list),
+    }
+
+def prometheus_metrics(metrics):
+    """Format run metrics for the Prometheus node_exporter textfile collector.
+
+    :param metrics: A dict of metrics from run_metrics().
+    :returns: A string in the Prometheus text exposition format.
+
+    """
+    def labels(**extra):
+        values = {'service': metrics['implementation_service']}
+        values.update(extra)
+        return ','.join('{k}="{v}"'.format(k=k, v=str(v).replace('\\', '\\\\').replace('"', '\\"')
+                                           .replace('\n', '\\n'))
+                        for k, v in values.items())
+
+    lines = []
+    def metric(metric_type, name, description, samples):
+        lines.append("# HELP btd_sched_{n} {d}".format(n=name, d=description))
+        lines.append("# TYPE btd_sched_{n} {t}".format(n=name, t=metric_type))
+        for sample_labels, value in samples:
+            lines.append("btd_sched_{n}{{{l}}} {v}".format(n=name, l=sample_labels, v=value))
+
+    def gauge(name, description, samples):
+        metric('gauge', name, description, samples)
+
+    # For the database counts, which outlive a run in --daemon mode.
+    def counter(name, description, samples):
+        metric('counter', name + '_total', description, samples)
+
+    gauge('last_run_timestamp_seconds', 'When the last run finished.', [(labels(), metrics['time'])])
+    gauge('days', 'The number of days scheduled.', [(labels(), metrics['days'])])
+    gauge('phase_seconds', 'Time spent in each phase of the run.',
+          [(labels(phase=p), s) for p, s in metrics['phases'].items()])
+    counter('queries', 'The number of database statements executed.', [(labels(), metrics['queries'])])
+    counter('statement_cache_hits', 'Prepared statements found in the cache.',
+            [(labels(), metrics['statement_cache']['hits'])])
+    counter('statement_cache_misses', 'Prepared statements not found in the cache.',
+            [(labels(), metrics['statement_cache']['misses'])])
+    gauge('statement_cache_size', 'The number of prepared statements in the cache.',
+          [(labels(), metrics['statement_cache']['cached'])])
+    counter('replica_queries', 'Statements executed on the read replica.',
+            [(labels(), metrics['replica']['queries'])])
+    counter('replica_fallbacks', 'Statements sent to the primary because the replica failed.',
+            [(labels(), metrics['replica']['fallbacks'])])
+    gauge('replica_configured', 'Whether a read replica is configured (1) or not (0).',
+          [(labels(), metrics['replica']['configured'])])
+    gauge('pool_size', 'The pool size of each Group and Scheduler Code.',
+          [(labels(bucket=b), n) for b, n in metrics['pool_size'].items()])
+    gauge('pool_pages', 'The number of extra pool pages fetched.', [(labels(), metrics['pages'])])
+    gauge('dry_pool', 'The number of slots filled with MISSING.', [(labels(), metrics['dry_pool'])])
+    gauge('skipped', 'The number of tracks skipped for artist separation.', [(labels(), metrics['skipped'])])
+    gauge('invalid_length', 'The number of tracks with invalid lengths.', [(labels(), metrics['invalid_length'])])
+    gauge('artists', 'The number of artists in the artist age table.', [(labels(), metrics['artists'])])
+
+    return '\n'.join(lines) + '\n'
+
+def save_metrics(metrics):
+    """Save the metrics for this run to --metrics.
+
+    In 'json' format, append the metrics as one line (JSON lines).
+    In 'prometheus' format, replace the file (atomically, as the
+    textfile collector requires).
+
+    :param metrics: A dict of metrics from run_metrics().
+
+    """
+    try:
+        if ARGS.metrics_format == 'prometheus':
+            temp_file = ARGS.metrics + '.tmp'
+            with open(temp_file, 'w') as f:
+                f.write(prometheus_metrics(metrics))
+            Path(temp_file).replace(ARGS.metrics)
+        else:
+            with open(ARGS.metrics, 'a') as f:
+                f.write(json.dumps(metrics, default=str) + '\n')
+    except OSError as e:
+        print("save_metrics: WARNING: unable to save metrics to '{f}' ({e})."
+              .format(f=ARGS.metrics, e=e), file=sys.stderr)
+
+def read_request(request_file):
+    """Read a scheduling request from the spool directory.
+
+    A request is a JSON object with any of the keys
+    "implementation_service", "start_date" (YYYY-MM-DD) and "days".
+    Missing keys take their values from the command line. The other
+    options (e.g., the Reference Service and Groups) are those of the
+    command line for all requests, as the daemon keeps the grid and
+    the pools built from them; a request with any other key is
+    invalid.
+
+    :param request_file: A Path to the request file.
+    :returns: An argparse.Namespace like ARGS for this request, or
+    None if the request is invalid.
+
+    """
+    try:
+        with open(request_file) as f:
+            request = json.load(f)
+        unknown = set(request) - {'implementation_service', 'start_date', 'days'}
+        if unknown:
+            raise ValueError("unsupported keys: {k}".format(k=', '.join(sorted(unknown))))
+        request_args = argparse.Namespace(**vars(DAEMON_ARGS))
+        request_args.implementation_service = str(request.get('implementation_service',
+                                                              DAEMON_ARGS.implementation_service))
+        request_args.start_date = str(request.get('start_date', DAEMON_ARGS.start_date))
+        request_args.days = int(request.get('days', DAEMON_ARGS.days))
+    except (OSError, ValueError, TypeError, AttributeError) as e:
+        print("read_request: ERROR: invalid request in '{f}' ({e})."
+              .format(f=request_file, e=e), file=sys.stderr)
+        return None
+
+    return request_args
+
+def daemon():
+    """Serve scheduling requests from a spool directory.
+
+    Keep the database connection, the Batch (Days, Hours and Events
+    for the Reference Service), the candidate pools and the artist
+    ages in memory between requests. Each "*.req" file in the spool
+    directory (see read_request()) is scheduled in turn and then
+    renamed to "*.done" (or "*.failed"). Changes to the grid are
+    picked up before each request (see Batch.refresh()), the pools
+    are refilled from the Library at most every --refresh-interval
+    seconds.
+
+    The Batch is for the Reference Service on the command line
+    (requests cannot change it, see read_request()). A failed request
+    leaves nothing behind: its Batch and pools are dropped (to be
+    built again for the next request) and its uncommitted artist ages
+    discarded.
+
+    """
+    global ARGS
+
+    spool_dir = Path(ARGS.spool_dir)
+    artist_list = open_artist_list()
+    db = schedlib.RDDatabase(None, replica=ARGS.replica)
+    library = open_library()
+    batch = None
+    active_pool = None
+    used_pool = None
+    last_refresh = time.time()
+
+    LOG.verbose("daemon: watching '{d}' for requests.", d=spool_dir)
+
+    while True:
+        for request_file in sorted(spool_dir.glob('*.req')):
+            ARGS = read_request(request_file)
+            if ARGS is None:
+                request_file.rename(request_file.with_suffix('.failed'))
+                continue
+
+            LOG.verbose("daemon: request '{f}': {s} from {d} for {n} day(s).",
+                        f=request_file.name, s=ARGS.implementation_service,
+                        d=ARGS.start_date, n=ARGS.days)
+            GLOBAL_STATS.clear()
+            GLOBAL_STATS.update(initial_stats())
+
+            try:
+                if batch is None:
+                    with phase('grid_load'):
+                        batch = schedlib.Batch(ARGS.reference_service, ARGS.start_date, ARGS.days, db)
+                else:
+                    with phase('grid_load'):
+                        batch.reschedule(ARGS.start_date, ARGS.days)
+                        LOG.verbose("daemon: refreshed {n} Days, Hours and Events.",
+                                    n=batch.refresh())
+                    if time.time() - last_refresh > ARGS.refresh_interval:
+                        active_pool = None
+                        last_refresh = time.time()
+
+                active_pool, used_pool = run_session(db, artist_list, batch, active_pool, used_pool, library)
+            except (Exception, SystemExit) as e:
+                # SystemExit from the functions that stop a command
+                # line run (having said why) fails just this request.
+                print("daemon: ERROR: request '{f}' failed ({e})."
+                      .format(f=request_file, e=e), file=sys.stderr)
+                batch = None
+                active_pool = None
+                used_pool = None
+                artist_list.discard()
+                request_file.rename(request_file.with_suffix('.failed'))
+                continue
+
+            request_file.rename(request_file.with_suffix('.done'))
+
+        time.sleep(DAEMON_POLL_SECONDS)
+
+def main():
+    """Keep the main thing the main thing.
+
+    Prepare a data import file for merging with a Log using Rivendell's
+    RDLogManager.
+
+    """
+    if ARGS.spool_dir:
+        daemon()
+        return
+
+    # One connection (and its prepared statement cache) for the
+    # repeated queries in this session.
+    db = schedlib.RDDatabase(None, replica=ARGS.replica)
+
+    # Load the grid once (see schedlib.Grid): the Scheduler Codes, the
+    # pool sizes and the slots of each Day all come from it.
+    with phase('grid_load'):
+        batch = schedlib.Batch(ARGS.reference_service, ARGS.start_date, ARGS.days, db)
+
+    if ARGS.window:
+        reschedule_window(db, batch, library=open_library())
+        return
+
+    artist_list = open_artist_list(checkpoint=bool(ARGS.checkpoint))
+    resume = load_checkpoint(ARGS.checkpoint) if ARGS.resume else None
+    run_session(db, artist_list, batch, library=open_library(),
+                checkpoint_file=ARGS.checkpoint, resume=resume)
+
+def profile_main():
+    """Run main() under a profiler and save its results.
+
+    The profilers run separately (see --profile-mode), so that neither
+    records the other: cProfile would record the sampler's signal
+    handler, and its own overhead would distort the sampled stacks.
+    Writes these files named after --profile:
+     - PREFIX.txt: the time in each pipeline phase (see phase()),
+       then (for 'cprofile') the per-function cumulative times and
+       call counts
+     - PREFIX.pstats: the cProfile data (for pstats, snakeviz, etc.),
+       for 'cprofile'
+     - PREFIX.collapsed: sampled call stacks for flame graph tools
+       (see schedlib.StackSampler), for 'sample'
+
+    """
+    if ARGS.profile_mode == 'sample':
+        profiler = schedlib.StackSampler()
+        profiler.start()
+        try:
+            main()
+        finally:
+            profiler.stop()
+            profiler.save(ARGS.profile + '.collapsed')
+            with open(ARGS.profile + '.txt', 'w') as f:
+                write_profile_phases(f)
+            LOG.verbose("profile_main: saved profile to '{p}.{{txt,collapsed}}'.", p=ARGS.profile)
+        return
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        main()
+    finally:
+        profiler.disable()
+        profiler.dump_stats(ARGS.profile + '.pstats')
+        with open(ARGS.profile + '.txt', 'w') as f:
+            write_profile_phases(f)
+            pstats.Stats(profiler, stream=f).sort_stats('cumulative').print_stats()
+        LOG.verbose("profile_main: saved profile to '{p}.{{txt,pstats}}'.", p=ARGS.profile)
+
+def write_profile_phases(f):
+    """Write the time in each pipeline phase (see phase()) to the open file f."""
+    f.write("Phases (seconds):\n")
+    for name, seconds in GLOBAL_STATS['phases'].items():
+        f.write("  {n:<10} {s:10.3f}\n".format(n=name, s=seconds))
+    f.write("\n")
+
 if __name__ == '__main__':
 
     PARSER = argparse.ArgumentParser(prog='btd_sched',
@@ -602,6 +1929,32 @@ if __name__ == '__main__':
                         help='Specify the number of tracks before and artist can be scheduled again.',
                         default=DEFAULT_ARTIST_SEPARATION,
                         action='store')
+    PARSER.add_argument('-b', '--artist-db-method',
+                        help='The sqlalchemy database backend for artist ages, e.g., mysql+mysqlconnector (default: {d}).'
+                        .format(d=DEFAULT_ARTIST_DB_METHOD),
+                        default=DEFAULT_ARTIST_DB_METHOD,
+                        action='store')
+    PARSER.add_argument('-B', '--artist-db-location',
+                        help="The location of the artist ages database, e.g., 'user@host/database' (default: {d}). The password goes in --artist-db-config or in ${v}."
+                        .format(d=DEFAULT_ARTIST_DB_LOCATION, v=ARTIST_DB_PASSWORD_VARIABLE),
+                        default=DEFAULT_ARTIST_DB_LOCATION,
+                        action='store')
+    PARSER.add_argument('--artist-db-config',
+                        help="Read the password for --artist-db-location from the [ArtistDB] section ('Password = ...') of this file (default: {d})."
+                        .format(d=DEFAULT_ARTIST_DB_CONFIG),
+                        metavar='FILE',
+                        default=DEFAULT_ARTIST_DB_CONFIG,
+                        action='store')
+    PARSER.add_argument('-C', '--checkpoint',
+                        help='Save the state of the run in this file (default: {d}) after each day, for --resume (default: no checkpoints).'
+                        .format(d=DEFAULT_CHECKPOINT),
+                        nargs='?',
+                        const=DEFAULT_CHECKPOINT,
+                        default=None,
+                        action='store')
+    PARSER.add_argument('-D', '--spool-dir',
+                        help='Run as a daemon, scheduling the requests that appear in this directory (see read_request()).',
+                        action='store')
     PARSER.add_argument('-d', '--days',
                         type=int,
                         help='Specify the number of days to schedule tracks (default is one day).',
@@ -611,13 +1964,65 @@ if __name__ == '__main__':
                         help='Specify a comma-separated list of Rivendell Groups to schedule.',
                         default='music',
                         action='store')
+    PARSER.add_argument('-L', '--log-level',
+                        type=schedlib.log_level,
+                        help="Set the level of one logger (btd_sched, schedlib), e.g. 'schedlib=debug'. LEVEL is one of debug, very_verbose, verbose, warning or error. May be repeated.",
+                        metavar='LOGGER=LEVEL',
+                        default=[],
+                        action='append')
+    PARSER.add_argument('-l', '--library',
+                        help='Read the Library (Carts, Cuts and Scheduler Codes) from this snapshot instead of the Rivendell database (see library.py). The Grid and the Service are still read from the database.',
+                        metavar='SNAPSHOT',
+                        action='store')
+    PARSER.add_argument('-m', '--metrics',
+                        help='Save the metrics for each run to this file (see --metrics-format).',
+                        action='store')
+    PARSER.add_argument('-M', '--metrics-format',
+                        help="Save metrics as JSON lines (appended) or as a Prometheus textfile (replaced) (default: json).",
+                        choices=METRICS_FORMATS,
+                        default='json',
+                        action='store')
     PARSER.add_argument('-o', '--output-dir',
-                        help='Name the output directory for the import data file. This overrides the Music Data Import Path set in RDAdmin.',
+                        help='Name the output directory for the import data files. This overrides the directory of the Music Data Import Path set in RDAdmin.',
+                        action='store')
+    PARSER.add_argument('-p', '--pool-history',
+                        help='Keep the pool usage statistics used to size the pool in this file (default: {d}).'
+                        .format(d=DEFAULT_POOL_HISTORY),
+                        default=DEFAULT_POOL_HISTORY,
+                        action='store')
+    PARSER.add_argument('-P', '--pool-margin',
+                        type=float,
+                        help='Add this fraction to the pool sizes calculated from the pool history (default: {d}).'
+                        .format(d=DEFAULT_POOL_MARGIN),
+                        default=DEFAULT_POOL_MARGIN,
+                        action='store')
+    PARSER.add_argument('--profile',
+                        help='Profile the run and save the results in files named PROFILE.txt and PROFILE.pstats (or PROFILE.collapsed, see --profile-mode).',
+                        metavar='PROFILE',
+                        action='store')
+    PARSER.add_argument('--profile-mode',
+                        help="With --profile, trace every call with cProfile, or sample the call stacks for flame graphs (default: cprofile).",
+                        choices=PROFILE_MODES,
+                        default='cprofile',
                         action='store')
     PARSER.add_argument('-r', '--reference-service',
                         help='Specify a Rivendell Service name to use as "reference" for Clocks and Events.',
                         default=DEFAULT_REFERENCE_SERVICE,
                         action='store')
+    PARSER.add_argument('--replica',
+                        help="Send the read-only queries to this replica of the Rivendell database, as 'user:password:host:database'. Empty fields default to those in /etc/rd.conf (default: the [mySQLReplica] section of /etc/rd.conf, if any).",
+                        metavar='CREDENTIALS',
+                        action='store')
+    PARSER.add_argument('-R', '--refresh-interval',
+                        type=int,
+                        help='In daemon mode, refill the pools from the Library at most this often (in seconds, default: {d}).'
+                        .format(d=DEFAULT_REFRESH_INTERVAL),
+                        default=DEFAULT_REFRESH_INTERVAL,
+                        action='store')
+    PARSER.add_argument('--resume',
+                        help='Continue an interrupted run (with the same options) from its last checkpoint (see --checkpoint, implied).',
+                        default=False,
+                        action='store_true')
     PARSER.add_argument('-s', '--start-date',
                         help='Specify the starting date (as YYYY-MM-DD) for scheduling tracks (default is "tomorrow").',
                         default=time.strftime("%F", time.localtime(time.time() + (3600 * 24))),
@@ -626,32 +2031,44 @@ if __name__ == '__main__':
                         help='Output global statistics at the end of the scheduling session.',
                         default=False,
                         action='store_true')
+    PARSER.add_argument('-T', '--station',
+                        help='Keep artist ages in this namespace of a database shared by several stations (default: not shared).',
+                        action='store')
+    PARSER.add_argument('-t', '--trial',
+                        help='Do a trial run: keep artist ages in memory and do not save them, and save the import files in --output-dir (default: a new temporary directory).',
+                        default=False,
+                        action='store_true')
     PARSER.add_argument('-V', '--version',
                         help='Display this app version string.',
                         action='version',
                         version='%(prog)s: ' + __version__)
     PARSER.add_argument('-v', '--verbose',
-                        help='Be chatty about progress. Use up to 3 times for more chattiness.',
+                        help='Be chatty about progress. Use up to 3 times for more chattiness (see also --log-level).',
                         default=0,
                         action='count')
+    PARSER.add_argument('-w', '--window',
+                        type=hour_window,
+                        help="Reschedule only these hours of the day (e.g., '14' or '6-9') in the existing import files, leaving the rest of each file (and the artist ages) as they are.",
+                        metavar='FIRST[-LAST]',
+                        action='store')
 
     ARGS = PARSER.parse_args()
+    if ARGS.resume and ARGS.checkpoint is None:
+        ARGS.checkpoint = DEFAULT_CHECKPOINT
+    # The command line, used for the defaults of daemon requests.
+    DAEMON_ARGS = ARGS
 
-    VERBOSE_PRINT = schedlib.my_print if ARGS.verbose > 0 else lambda *a, **k: None
-    VERY_VERBOSE_PRINT = schedlib.my_print if ARGS.verbose > 1 else lambda *a, **k: None
-    DEBUG_PRINT = schedlib.my_print if ARGS.verbose > 2 else lambda *a, **k: None
+    schedlib.configure_logging(ARGS.verbose, ARGS.log_level)
 
-    GLOBAL_STATS = {
-        'pool_size': 0,
-        'invalid_length': {},
-        'skipped': {},
-        'dry_pool': 0,
-    }
+    GLOBAL_STATS = initial_stats()
 
     if ARGS.groups:
-        VERY_VERBOSE_PRINT("btd_sched.py: Filling pool with Carts from Group '{group}'."
-                           .format(group=ARGS.groups))
+        LOG.very_verbose("btd_sched.py: Filling pool with Carts from Group '{group}'.",
+                         group=ARGS.groups)
 
-    main()
+    if ARGS.profile:
+        profile_main()
+    else:
+        main()
 
     sys.exit()
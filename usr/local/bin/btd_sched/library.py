@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+"""library.py: keep a local snapshot of the Rivendell Library.
+
+The snapshot is an SQLite database holding the columns of CART, CUTS
+and CART_SCHED_CODES that btd_sched and btd-library-duplicates use,
+under the same table and column names, with indexes for their
+queries. Run this to create a snapshot, and again to refresh it:
+
+  python3 library.py /var/cache/btd/library.db
+
+A refresh compares a checksum of each Cart (and its Cuts and
+Scheduler Codes) with the checksums saved in the snapshot, and
+fetches only the Carts that have been added or changed (playing a Cut
+changes its Cart). Carts deleted from the Library are deleted from
+the snapshot.
+
+Then pass the snapshot to btd_sched (--library) or
+btd-library-duplicates.py (--library) to read the Library from local
+disk instead of the Rivendell database. Note that a snapshot does not
+see Cuts played since it was last refreshed, and that btd_sched still
+reads the Grid and the Service (for the Music Data Import Path) from
+the database.
+
+The tables are created only in a new (or empty) file: an existing file
+that is not a snapshot is refused rather than modified.
+
+"""
+
+import sys
+import argparse
+import sqlite3
+import time
+from rivendell_lib import RDDatabase
+
+__version__ = '0.1.0'
+
+# The number of Carts fetched (and written) in each statement.
+REFRESH_BATCH_SIZE = 1000
+SNAPSHOT_FORMAT = '1'
+
+# Group names, Scheduler Codes, etc. compare without regard to case, as
+# they do in MariaDB.
+SNAPSHOT_SCHEMA = """
+CREATE TABLE IF NOT EXISTS CART (
+    NUMBER INTEGER PRIMARY KEY,
+    TYPE INTEGER,
+    GROUP_NAME TEXT COLLATE NOCASE,
+    ARTIST TEXT COLLATE NOCASE,
+    ALBUM TEXT COLLATE NOCASE,
+    TITLE TEXT COLLATE NOCASE
+);
+CREATE INDEX IF NOT EXISTS CART_GROUP_IDX ON CART (GROUP_NAME, NUMBER);
+CREATE INDEX IF NOT EXISTS CART_METADATA_IDX ON CART (ARTIST, ALBUM, TITLE);
+CREATE TABLE IF NOT EXISTS CUTS (
+    CUT_NAME TEXT PRIMARY KEY,
+    CART_NUMBER INTEGER,
+    LENGTH INTEGER,
+    LAST_PLAY_DATETIME TEXT
+);
+CREATE INDEX IF NOT EXISTS CUTS_CART_IDX ON CUTS (CART_NUMBER);
+CREATE TABLE IF NOT EXISTS CART_SCHED_CODES (
+    CART_NUMBER INTEGER,
+    SCHED_CODE TEXT COLLATE NOCASE
+);
+CREATE INDEX IF NOT EXISTS CART_SCHED_CODES_CART_IDX ON CART_SCHED_CODES (CART_NUMBER);
+CREATE INDEX IF NOT EXISTS CART_SCHED_CODES_CODE_IDX ON CART_SCHED_CODES (SCHED_CODE, CART_NUMBER);
+CREATE TABLE IF NOT EXISTS CART_FINGERPRINTS (
+    CART_NUMBER INTEGER PRIMARY KEY,
+    FINGERPRINT TEXT
+);
+CREATE TABLE IF NOT EXISTS SNAPSHOT_INFO (
+    NAME TEXT PRIMARY KEY,
+    VALUE TEXT
+);
+"""
+
+class LibrarySnapshot():
+    """A local (SQLite) snapshot of the Rivendell Library.
+
+    For reading, an instance stands in for RDDatabase: fetchall() and
+    fetchone() take the same (MariaDB-flavoured) queries and
+    arguments, as long as the queries use only the snapshot tables.
+
+    """
+
+    def __init__(self, path):
+        """Open (or create) a snapshot.
+
+        The tables are created only in a new (or empty) database, so
+        that a mistyped path cannot add them to some other database.
+
+        :param path: The file name of the snapshot.
+        :raises ValueError: if path is some other file (or a snapshot
+        of another format).
+
+        """
+        self.path = path
+        self.cnx = sqlite3.connect(path)
+        try:
+            tables = [name for (name,) in self.cnx.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+        except sqlite3.DatabaseError as e:
+            self.cnx.close()
+            raise ValueError("'{f}' is not a Library snapshot ({e})".format(f=path, e=e)) from e
+        if not tables:
+            self.cnx.executescript(SNAPSHOT_SCHEMA)
+            with self.cnx:
+                self.cnx.execute("INSERT INTO SNAPSHOT_INFO (name, value) VALUES ('format', ?)", (SNAPSHOT_FORMAT,))
+        elif 'SNAPSHOT_INFO' not in tables or self.info().get('format') != SNAPSHOT_FORMAT:
+            self.cnx.close()
+            raise ValueError("'{f}' is not a Library snapshot".format(f=path))
+        # The number of statements executed through this instance.
+        self.query_count = 0
+
+    def info(self):
+        """Return the snapshot information ('format', 'refreshed', 'source') as a dict."""
+        return dict(self.cnx.execute("SELECT name, value FROM SNAPSHOT_INFO").fetchall())
+
+    def age(self):
+        """Return the time since the last refresh (in seconds), or None if it has never been refreshed."""
+        refreshed = self.info().get('refreshed')
+        return time.time() - float(refreshed) if refreshed is not None else None
+
+    def fetchall(self, query, query_args=None, dictionary=False, multi=False, prepared=False, primary=False):
+        """Execute the query on the snapshot and return all results.
+
+        :param query: A string containing a single SQL statement,
+        possibly containing '%s' wildcards to be substituted with
+        query_args.
+        :param query_args: A tuple containing values to substitute
+        wildcards in the query.
+        :param dictionary: A boolean indicating whether to return the
+        query results as a dict. Default: False
+        :param multi: Ignored (see RDDatabase.fetchall()).
+        :param prepared: Ignored: SQLite caches its prepared statements.
+        :param primary: Ignored: the snapshot is read-only.
+
+        :returns: All the rows that satisfy the statement in query.
+
+        """
+        if not query:
+            return None
+
+        self.query_count += 1
+        cursor = self.cnx.execute(query.replace('%s', '?'), query_args or ())
+        rows = cursor.fetchall()
+        if dictionary:
+            names = [column[0] for column in cursor.description]
+            rows = [dict(zip(names, row)) for row in rows]
+
+        return rows
+
+    def fetchone(self, query, query_args=None, dictionary=False, multi=False, prepared=False, primary=False):
+        """Execute the query on the snapshot and return the first result.
+
+        See fetchall() for the parameters.
+
+        """
+        rows = self.fetchall(query, query_args, dictionary=dictionary)
+        return rows[0] if rows else None
+
+    def get_fingerprints(self, db):
+        """Get cheap fingerprints of each Cart in the Library.
+
+        :param db: The RDDatabase of the Library. The rows (one or
+        more per Cart) are streamed (see RDDatabase.iterate()) rather
+        than buffered.
+
+        :returns: A dict of fingerprints indexed by Cart number. Each
+        fingerprint combines checksums of the Cart's metadata, of its
+        Cuts and of its Scheduler Codes.
+
+        """
+        query = ("SELECT c.number AS number, "
+                 "CRC32(CONCAT_WS('|', c.type, c.group_name, c.artist, c.album, c.title)) AS fingerprint "
+                 "FROM CART AS c")
+        carts = {row['number']: str(row['fingerprint']) for row in db.iterate(query, dictionary=True)}
+
+        # BIT_XOR() of per-row checksums is independent of row order
+        # and, unlike GROUP_CONCAT(), is never truncated.
+        query = ("SELECT u.cart_number AS number, "
+                 "CONCAT(COUNT(*), ':', "
+                 "BIT_XOR(CRC32(CONCAT_WS('|', u.cut_name, u.length, u.last_play_datetime)))) AS fingerprint "
+                 "FROM CUTS AS u "
+                 "GROUP BY u.cart_number")
+        cuts = {row['number']: row['fingerprint'] for row in db.iterate(query, dictionary=True)}
+
+        query = ("SELECT s.cart_number AS number, "
+                 "CONCAT(COUNT(*), ':', BIT_XOR(CRC32(s.sched_code))) AS fingerprint "
+                 "FROM CART_SCHED_CODES AS s "
+                 "GROUP BY s.cart_number")
+        codes = {row['number']: row['fingerprint'] for row in db.iterate(query, dictionary=True)}
+
+        return {number: '{c}/{u}/{s}'.format(c=fingerprint, u=cuts.get(number, ''), s=codes.get(number, ''))
+                for number, fingerprint in carts.items()}
+
+    def refresh(self, db):
+        """Bring the snapshot up to date with the Library.
+
+        Fetch only the Carts whose fingerprints (see
+        get_fingerprints()) have changed, and delete the Carts that
+        are no longer in the Library, all in one transaction.
+
+        :param db: The RDDatabase of the Library.
+
+        :returns: A dict with the number of Carts 'added', 'changed'
+        and 'deleted'.
+
+        """
+        fingerprints = self.get_fingerprints(db)
+        saved = dict(self.cnx.execute("SELECT cart_number, fingerprint FROM CART_FINGERPRINTS").fetchall())
+
+        added = [number for number in fingerprints if number not in saved]
+        changed = [number for number in fingerprints if number in saved and saved[number] != fingerprints[number]]
+        deleted = [number for number in saved if number not in fingerprints]
+
+        with self.cnx:
+            stale = changed + deleted
+            for start in range(0, len(stale), REFRESH_BATCH_SIZE):
+                self.delete_carts(stale[start:start + REFRESH_BATCH_SIZE])
+
+            fresh = added + changed
+            for start in range(0, len(fresh), REFRESH_BATCH_SIZE):
+                self.copy_carts(db, fresh[start:start + REFRESH_BATCH_SIZE])
+
+            self.cnx.executemany("INSERT INTO CART_FINGERPRINTS (cart_number, fingerprint) VALUES (?, ?)",
+                                 [(number, fingerprints[number]) for number in fresh])
+            self.cnx.executemany("REPLACE INTO SNAPSHOT_INFO (name, value) VALUES (?, ?)",
+                                 [('format', SNAPSHOT_FORMAT),
+                                  ('refreshed', str(time.time())),
+                                  ('source', db.config.credentials['host'])])
+
+        return {'added': len(added), 'changed': len(changed), 'deleted': len(deleted)}
+
+    def delete_carts(self, numbers):
+        """Delete the Carts (and their Cuts, etc.) in the list of Cart numbers from the snapshot."""
+        placeholders = ','.join(['?'] * len(numbers))
+        self.cnx.execute("DELETE FROM CART WHERE number IN ({p})".format(p=placeholders), numbers)
+        for table in ('CUTS', 'CART_SCHED_CODES', 'CART_FINGERPRINTS'):
+            self.cnx.execute("DELETE FROM {t} WHERE cart_number IN ({p})".format(t=table, p=placeholders), numbers)
+
+    def copy_carts(self, db, numbers):
+        """Copy the Carts (and their Cuts, etc.) in the list of Cart numbers from the Library to the snapshot."""
+        placeholders = ','.join(['%s'] * len(numbers))
+
+        query = ("SELECT c.number, c.type, c.group_name, c.artist, c.album, c.title "
+                 "FROM CART AS c WHERE c.number IN ({p})").format(p=placeholders)
+        self.cnx.executemany("INSERT INTO CART (number, type, group_name, artist, album, title) "
+                             "VALUES (?, ?, ?, ?, ?, ?)", db.fetchall(query, tuple(numbers)))
+
+        # Datetimes are saved as text that sorts (and compares with
+        # '1000-01-01 00:00:00') as it does in MariaDB.
+        query = ("SELECT u.cut_name, u.cart_number, u.length, u.last_play_datetime "
+                 "FROM CUTS AS u WHERE u.cart_number IN ({p})").format(p=placeholders)
+        self.cnx.executemany("INSERT INTO CUTS (cut_name, cart_number, length, last_play_datetime) "
+                             "VALUES (?, ?, ?, ?)",
+                             [(cut_name, cart_number, length,
+                               last_play.strftime('%Y-%m-%d %H:%M:%S') if last_play is not None else None)
+                              for cut_name, cart_number, length, last_play in db.fetchall(query, tuple(numbers))])
+
+        query = ("SELECT s.cart_number, s.sched_code "
+                 "FROM CART_SCHED_CODES AS s WHERE s.cart_number IN ({p})").format(p=placeholders)
+        self.cnx.executemany("INSERT INTO CART_SCHED_CODES (cart_number, sched_code) VALUES (?, ?)",
+                             db.fetchall(query, tuple(numbers)))
+
+    def close(self):
+        """Close the snapshot."""
+        self.cnx.close()
+
+def main():
+    """Create or refresh the snapshot named on the command line."""
+    try:
+        snapshot = LibrarySnapshot(ARGS.snapshot)
+    except ValueError as e:
+        print("library: ERROR: {e}.".format(e=e), file=sys.stderr)
+        sys.exit(1)
+    db = RDDatabase(ARGS.credentials, replica=ARGS.replica)
+
+    start = time.time()
+    counts = snapshot.refresh(db)
+    snapshot.close()
+
+    if ARGS.verbose:
+        print("library: refreshed '{f}' in {s:.1f} seconds: {a} Carts added, {c} changed, {d} deleted."
+              .format(f=ARGS.snapshot, s=time.time() - start,
+                      a=counts['added'], c=counts['changed'], d=counts['deleted']), file=sys.stderr)
+
+if __name__ == '__main__':
+
+    PARSER = argparse.ArgumentParser(prog='library',
+                                     description='Create or refresh a local snapshot of the Rivendell Library.')
+    PARSER.add_argument('snapshot',
+                        help='The file name of the (SQLite) snapshot.',
+                        action='store')
+    PARSER.add_argument('-c', '--credentials',
+                        help="Read the Library from this database, as 'user:password:host:database' (default: see /etc/rd.conf).",
+                        action='store')
+    PARSER.add_argument('--replica',
+                        help="Read the Library from this replica of the database (see btd_sched --replica).",
+                        metavar='CREDENTIALS',
+                        action='store')
+    PARSER.add_argument('-V', '--version',
+                        help='Display this app version string.',
+                        action='version',
+                        version='%(prog)s: ' + __version__)
+    PARSER.add_argument('-v', '--verbose',
+                        help='Report what was refreshed.',
+                        default=0,
+                        action='count')
+
+    ARGS = PARSER.parse_args()
+
+    main()
+
+    sys.exit()
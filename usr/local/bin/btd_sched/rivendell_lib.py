@@ -6,7 +6,9 @@ Aand functions for interacting with a Rivendell database and web API.
 
 import sys
 import re
+import time
 import configparser
+from collections import OrderedDict
 import mysql.connector
 
 class RDDBConfig():
@@ -15,9 +17,14 @@ class RDDBConfig():
     We look the credentials up in the standard location if they are not
     passed to the constructor.
 
+    The configuration may also name a read-only endpoint (for example
+    another node of a Galera cluster) in replica_credentials or in a
+    [mySQLReplica] section of /etc/rd.conf. Its Loginname, Password
+    and Database default to those in the [mySQL] section.
+
     """
 
-    def __init__(self, db_credentials=None):
+    def __init__(self, db_credentials=None, replica_credentials=None):
         """Construct an instance.
 
         Make a (possibly empty) database access configuration. Uses the
@@ -26,6 +33,10 @@ class RDDBConfig():
 
         :param db_credentials: A string containing colon-separated (:)
         database credentials.
+        :param replica_credentials: A string containing colon-separated
+        (:) credentials for a read-only replica of the database. Empty
+        fields default to the primary credentials. Default: the
+        [mySQLReplica] section of /etc/rd.conf, if any.
 
         """
         self.db_credentials = db_credentials
@@ -34,10 +45,12 @@ class RDDBConfig():
         self.db_credential_pattern = '^(?P<user>.*?):(?P<password>.*?):(?P<host>.*?):(?P<database>.*)$'
         self.db_credential_re = re.compile(self.db_credential_pattern)
         self.credentials = {}
+        self.replica_credentials = None
 
         if self.db_credentials is not None:
             matches = self.db_credential_re.search(self.db_credentials)
             self.credentials = matches.groupdict()
+            self.set_replica(replica_credentials)
             return
 
         self.__config = configparser.ConfigParser()
@@ -54,8 +67,40 @@ class RDDBConfig():
             'host': self.__config.get('mySQL', 'Hostname'),
             'database': self.__config.get('mySQL', 'Database'),
         }
+
+        if replica_credentials is None and self.__config.has_section('mySQLReplica'):
+            replica_credentials = ':'.join([
+                self.__config.get('mySQLReplica', 'Loginname', fallback=''),
+                self.__config.get('mySQLReplica', 'Password', fallback=''),
+                self.__config.get('mySQLReplica', 'Hostname', fallback=''),
+                self.__config.get('mySQLReplica', 'Database', fallback=''),
+            ])
+        self.set_replica(replica_credentials)
         return
 
+    def set_replica(self, replica_credentials):
+        """Set the credentials of the read-only replica.
+
+        :param replica_credentials: A string containing colon-separated
+        (:) database credentials, or None for no replica. Empty fields
+        default to the primary credentials.
+
+        """
+        if not replica_credentials:
+            return
+
+        matches = self.db_credential_re.search(replica_credentials)
+        if matches is None:
+            print("RDDBConfig: ERROR: ignoring malformed replica credentials (expected 'user:password:host:database').",
+                  file=sys.stderr)
+            return
+
+        self.replica_credentials = {key: value if value else self.credentials[key]
+                                    for key, value in matches.groupdict().items()}
+        # The primary itself is not a replica.
+        if self.replica_credentials['host'] == self.credentials['host']:
+            self.replica_credentials = None
+
     def get_config_pattern(self):
         """Get the config RE pattern.
 
@@ -68,14 +113,55 @@ class RDDBConfig():
         """Return the credentials for this instance of the object."""
         return self.credentials
 
+    def get_replica_credentials(self):
+        """Return the credentials of the read-only replica (None if there is no replica)."""
+        return self.replica_credentials
+
     def get_config(self):
         """Return the configuration from /etc/rd.conf as a configparser object."""
         return self.__config
 
+DEFAULT_STATEMENT_CACHE_SIZE = 32
+
+# How long to keep reading from the primary after the replica fails
+# before trying the replica again (in seconds).
+REPLICA_RETRY_SECONDS = 60
+
+# The errors that mean "the replica is unavailable" rather than "the
+# statement is wrong". A Galera node that has left the cluster answers
+# queries with an OperationalError (WSREP has not yet prepared node
+# for application use).
+REPLICA_ERRORS = (mysql.connector.errors.InterfaceError, mysql.connector.errors.OperationalError)
+
+READ_ONLY_RE = re.compile(r'^\s*SELECT\b', re.IGNORECASE)
+LOCKING_READ_RE = re.compile(r'\bFOR\s+UPDATE\b|\bLOCK\s+IN\s+SHARE\s+MODE\b|\bINTO\b', re.IGNORECASE)
+
+def is_read_only(query):
+    """Whether query is a plain SELECT that may be sent to a read-only replica.
+
+    Locking reads (SELECT ... FOR UPDATE, LOCK IN SHARE MODE) and
+    SELECT ... INTO are not read-only.
+
+    :param query: A string containing a MariaDB statement.
+
+    """
+    return READ_ONLY_RE.match(query) is not None and LOCKING_READ_RE.search(query) is None
+
 class RDDatabase():
-    """An authenticated database connection."""
+    """An authenticated database connection.
+
+    If the configuration names a read-only replica (see RDDBConfig),
+    read-only SELECT statements are sent to the replica on a second
+    connection, opened the first time it is needed. Everything else
+    goes to the primary, as do reads the caller marks primary=True
+    (for example reads that must see our own writes). If the replica
+    is unreachable (or, as a Galera node, not Synced with the
+    cluster), or fails during a statement, the statement is run on the
+    primary and we stay there for REPLICA_RETRY_SECONDS.
 
-    def __init__(self, config):
+    """
+
+    def __init__(self, config, statement_cache_size=DEFAULT_STATEMENT_CACHE_SIZE, replica=None):
         """Instantiate an RDDatabase.
 
         Connect to the database specified in config (or in
@@ -83,35 +169,263 @@ class RDDatabase():
 
         :param config: A string containing colon-separated (:)
         database credentials.
+        :param statement_cache_size: The maximum number of server-side
+        prepared statements to keep open on each connection (see
+        prepared()). Default: DEFAULT_STATEMENT_CACHE_SIZE
+        :param replica: A string containing colon-separated (:)
+        credentials for a read-only replica (see RDDBConfig). Default:
+        the replica in /etc/rd.conf, if any.
 
         """
-        self.config = RDDBConfig(config)
+        self.config = RDDBConfig(config, replica)
         self.saved_cursor = None
-        self.cnx = mysql.connector.connect(
-            user=self.config.credentials['user'],
-            password=self.config.credentials['password'],
-            host=self.config.credentials['host'],
-            database=self.config.credentials['database'])
+        self.statement_cache_size = statement_cache_size
+        # Prepared statement cursors indexed by (connection role,
+        # query text), least recently used first.
+        self.statements = OrderedDict()
+        self.statement_hits = 0
+        self.statement_misses = 0
+        # The number of statements executed through this instance.
+        self.query_count = 0
+        # The read-only replica connection (see route()).
+        self.replica_cnx = None
+        self.replica_retry_at = 0
+        self.replica_query_count = 0
+        self.replica_fallbacks = 0
+        # Idle connections for iterate() indexed by connection role.
+        self.stream_cnx = {}
+        self.cnx = self.connect()
+
+    def connect(self, credentials=None):
+        """Open a new connection to the database in our configuration.
+
+        :param credentials: A dict of credentials (see
+        RDDBConfig.get_credentials()). Default: the primary database.
+
+        :returns: A new connection, independent of self.cnx.
+
+        """
+        if credentials is None:
+            credentials = self.config.credentials
+
+        return mysql.connector.connect(
+            user=credentials['user'],
+            password=credentials['password'],
+            host=credentials['host'],
+            database=credentials['database'])
+
+    def connect_replica(self):
+        """Open a new read-only connection to the replica.
+
+        :returns: A new connection to the replica. Raises
+        mysql.connector.Error if the replica is unreachable, or is a
+        Galera node that is not Synced with the cluster.
+
+        """
+        cnx = self.connect(self.config.replica_credentials)
+        try:
+            cursor = cnx.cursor()
+            cursor.execute("SHOW GLOBAL STATUS LIKE 'wsrep_local_state_comment'")
+            row = cursor.fetchone()
+            if row is not None:
+                state = row[1].decode() if isinstance(row[1], (bytes, bytearray)) else row[1]
+                if state != 'Synced':
+                    raise mysql.connector.errors.OperationalError(
+                        msg="replica state is '{s}', not 'Synced'".format(s=state))
+            cursor.execute("SET SESSION TRANSACTION READ ONLY")
+            cursor.close()
+        except mysql.connector.Error:
+            cnx.close()
+            raise
+
+        return cnx
+
+    def route(self, query, primary=False):
+        """Choose the connection on which to run query.
+
+        :param query: A string containing a MariaDB statement.
+        :param primary: A boolean indicating whether query must run on
+        the primary. Default: False
+
+        :returns: 'replica' for a read-only SELECT when the replica is
+        available, otherwise 'primary'.
+
+        """
+        if primary or self.config.replica_credentials is None or not is_read_only(query):
+            return 'primary'
+
+        if self.replica_cnx is None:
+            if time.time() < self.replica_retry_at:
+                return 'primary'
+            try:
+                self.replica_cnx = self.connect_replica()
+            except mysql.connector.Error as e:
+                self.replica_failed(e)
+                return 'primary'
+
+        return 'replica'
+
+    def connection(self, role):
+        """Return the connection for role ('primary' or 'replica')."""
+        return self.replica_cnx if role == 'replica' else self.cnx
+
+    def replica_failed(self, error):
+        """Stop using the replica for REPLICA_RETRY_SECONDS.
+
+        :param error: The exception that made the replica unavailable.
+
+        """
+        print("RDDatabase.replica_failed(): WARNING: read replica '{h}' is unavailable, using the primary ({e})."
+              .format(h=self.config.replica_credentials['host'], e=error), file=sys.stderr)
+
+        for key in [key for key in self.statements if key[0] == 'replica']:
+            del self.statements[key]
+        for cnx in (self.replica_cnx, self.stream_cnx.pop('replica', None)):
+            if cnx is not None:
+                try:
+                    cnx.close()
+                except mysql.connector.Error:
+                    pass
+
+        self.replica_cnx = None
+        self.replica_retry_at = time.time() + REPLICA_RETRY_SECONDS
+        self.replica_fallbacks += 1
+
+    def read(self, query, primary, work):
+        """Run a read on the connection chosen by route().
+
+        If the replica fails, run it again on the primary.
+
+        :param query: A string containing a MariaDB statement.
+        :param primary: A boolean indicating whether query must run on
+        the primary.
+        :param work: A function of the connection role ('primary' or
+        'replica') that runs query on that connection.
+
+        :returns: The result of work.
+
+        """
+        role = self.route(query, primary)
+        if role == 'primary':
+            return work(role)
+
+        try:
+            result = work(role)
+        except REPLICA_ERRORS as e:
+            self.replica_failed(e)
+            return work('primary')
+
+        self.replica_query_count += 1
+        return result
+
+    def replica_stats(self):
+        """Return the replica routing counters as a dict."""
+        return {
+            'configured': int(self.config.replica_credentials is not None),
+            'queries': self.replica_query_count,
+            'fallbacks': self.replica_fallbacks,
+        }
 
     def close(self):
         """Close a previously opened cursor."""
-        self.saved_cursor.close()
+        if self.saved_cursor:
+            self.saved_cursor.close()
 
-    def cursor(self, dictionary=False):
+    def prepared(self, query, role='primary'):
+        """Get a prepared statement for query from the statement cache.
+
+        Prepare the statement on the server the first time we see
+        query, and reuse it (with new parameters) after that. The
+        least recently used statement is closed (deallocated on the
+        server) when the cache grows beyond statement_cache_size.
+
+        :param query: A string containing a valid MariaDB statement,
+        possibly containing wildcards to be substituted with
+        query_args.
+        :param role: The connection on which to prepare the statement
+        ('primary' or 'replica'). Default: 'primary'
+
+        :returns: A tuple containing the query string used to prepare
+        the statement and the prepared cursor. Pass that same string
+        to the cursor's execute() so the connector recognizes it and
+        does not prepare the statement again.
+
+        """
+        key = (role, query)
+        entry = self.statements.get(key)
+        if entry is not None:
+            self.statements.move_to_end(key)
+            self.statement_hits += 1
+            return entry
+
+        self.statement_misses += 1
+        entry = (query, self.connection(role).cursor(prepared=True))
+        self.statements[key] = entry
+        if len(self.statements) > self.statement_cache_size:
+            _, (_, evicted) = self.statements.popitem(last=False)
+            evicted.close()
+
+        return entry
+
+    def statement_stats(self):
+        """Return the prepared statement cache counters as a dict."""
+        return {
+            'hits': self.statement_hits,
+            'misses': self.statement_misses,
+            'cached': len(self.statements),
+        }
+
+    def fetchprepared(self, query, query_args=None, dictionary=False, primary=False):
+        """Execute query as a cached prepared statement and return all results.
+
+        :param query: A string containing a single valid MariaDB
+        statement, possibly containing wildcards to be substituted
+        with query_args.
+        :param query_args: A tuple containing values to substitute
+        wildcards in the query.
+        :param dictionary: A boolean indicating whether to return the
+        query results as a dict. Default: False
+        :param primary: A boolean indicating whether to read from the
+        primary even if there is a replica. Default: False
+
+        :returns: All the rows that satisfy the statement in
+        query. The prepared statement remains open for reuse.
+
+        """
+        if not query:
+            return None
+
+        def work(role):
+            statement, cursor = self.prepared(query, role)
+            self.query_count += 1
+            cursor.execute(statement, query_args)
+            rows = cursor.fetchall()
+            if dictionary:
+                rows = [dict(zip(cursor.column_names, row)) for row in rows]
+            return rows
+
+        return self.read(query, primary, work)
+
+    def cursor(self, dictionary=False, role='primary'):
         """Set a cursor on the database.
 
         :param dictionary: A boolean indicating whether to return the
         query results as a dict. Default: False
+        :param role: The connection on which to set the cursor
+        ('primary' or 'replica'). Default: 'primary'
 
         :returns: The cursor.
 
         """
-        self.saved_cursor = self.cnx.cursor(dictionary=dictionary)
+        self.saved_cursor = self.connection(role).cursor(dictionary=dictionary)
         return self.saved_cursor
 
     def execute(self, query, query_args=None, dictionary=False, multi=False):
         """Set a cursor on the database and execute the given query.
 
+        The query may change the database, so it always runs on the
+        primary.
+
         :param query: A string containing a valid MariaDB statement,
         possibly containing wildcards to be substituted with
         query_args.
@@ -131,9 +445,10 @@ class RDDatabase():
             return None
 
         self.cursor(dictionary=dictionary)
+        self.query_count += 1
         return self.saved_cursor.execute(query, query_args, multi=multi)
 
-    def fetchone(self, query, query_args=None, dictionary=False, multi=False):
+    def fetchone(self, query, query_args=None, dictionary=False, multi=False, prepared=False, primary=False):
         """Set a cursor on the database, execute the query and return the first result.
 
         :param query: A string containing a valid MariaDB statement,
@@ -144,7 +459,12 @@ class RDDatabase():
         :param dictionary: A boolean indicating whether to return the
         query results as a dict. Default: False
         :param multi: A boolean indicating whether to accept multiple
-        statements in a single query. Default False.
+        statements in a single query (these always run on the
+        primary). Default False.
+        :param prepared: A boolean indicating whether to use a cached
+        prepared statement (see fetchprepared()). Default False.
+        :param primary: A boolean indicating whether to read from the
+        primary even if there is a replica. Default: False
 
         :returns: The result of the statement (see
         https://dev.mysql.com/doc/connector-python/en/connector-python-api-mysqlcursor-fetchone.html
@@ -154,13 +474,24 @@ class RDDatabase():
         if not query:
             return None
 
-        self.cursor(dictionary=dictionary)
-        self.saved_cursor.execute(query, query_args, multi=multi)
-        return self.saved_cursor.fetchone()
+        if prepared:
+            rows = self.fetchprepared(query, query_args, dictionary=dictionary, primary=primary)
+            return rows[0] if rows else None
+
+        def work(role):
+            self.cursor(dictionary=dictionary, role=role)
+            self.query_count += 1
+            self.saved_cursor.execute(query, query_args, multi=multi)
+            return self.saved_cursor.fetchone()
+
+        return self.read(query, primary or multi, work)
 
     def fetchnext(self):
         """Fetch the next result of a query.
 
+        Deprecated: use iterate(), which does not depend on the cursor
+        of the last execute().
+
         :returns: The result of the statement (see
         https://dev.mysql.com/doc/connector-python/en/connector-python-api-mysqlcursor-fetchone.html
         for details).
@@ -177,6 +508,8 @@ class RDDatabase():
         Ostensibly from a previous query, but also from a previously
         execute()'d query. Then close() the database cursor.
 
+        Deprecated: use iterate() or fetchall().
+
         :returns: Any remaining rows from a previously requested
         execute(). Also close()s the database. See
         https://dev.mysql.com/doc/connector-python/en/connector-python-api-mysqlcursor-close.html
@@ -197,7 +530,7 @@ class RDDatabase():
 
         return rows
 
-    def fetchall(self, query, query_args=None, dictionary=False, multi=False):
+    def fetchall(self, query, query_args=None, dictionary=False, multi=False, prepared=False, primary=False):
         """Set a cursor on the database, execute the query and return all results.
 
         :param query: A string containing a valid MariaDB statement,
@@ -208,7 +541,12 @@ class RDDatabase():
         :param dictionary: A boolean indicating whether to return the
         query results as a dict. Default: False
         :param multi: A boolean indicating whether to accept multiple
-        statements in a single query. Default False.
+        statements in a single query (these always run on the
+        primary). Default False.
+        :param prepared: A boolean indicating whether to use a cached
+        prepared statement (see fetchprepared()). Default False.
+        :param primary: A boolean indicating whether to read from the
+        primary even if there is a replica. Default: False
 
         :returns: All the rows that satisfy the statement in
         query. Also close()s the database. See
@@ -219,9 +557,104 @@ class RDDatabase():
         if not query:
             return None
 
-        cursor = self.cursor(dictionary=dictionary)
-        cursor.execute(query, query_args, multi=multi)
-        rows = cursor.fetchall()
-        self.close()
+        if prepared:
+            return self.fetchprepared(query, query_args, dictionary=dictionary, primary=primary)
 
-        return rows
+        def work(role):
+            cursor = self.cursor(dictionary=dictionary, role=role)
+            self.query_count += 1
+            cursor.execute(query, query_args, multi=multi)
+            rows = cursor.fetchall()
+            self.close()
+            return rows
+
+        return self.read(query, primary or multi, work)
+
+    def iterate(self, query, query_args=None, dictionary=False, batch_size=1000, primary=False):
+        """Execute the query and yield the results one row at a time.
+
+        Rows are read from an unbuffered (server-side) cursor
+        batch_size rows at a time, so memory use is bounded regardless
+        of the size of the result. The rows are read on a connection of
+        their own (not self.cnx, and not touching self.saved_cursor), so
+        fetchone(), fetchall(), etc. may be used while an iterator is
+        open. That connection is kept for the next call once all the
+        rows have been read; an iterator opened while another is open
+        gets a new connection, and one closed early closes its
+        connection (discarding the unread rows).
+
+        :param query: A string containing a valid MariaDB statement,
+        possibly containing wildcards to be substituted with
+        query_args.
+        :param query_args: A tuple containing values to substitute
+        wildcards in the query.
+        :param dictionary: A boolean indicating whether to return the
+        query results as a dict. Default: False
+        :param batch_size: The number of rows to fetch from the server
+        at a time. Default: 1000
+        :param primary: A boolean indicating whether to read from the
+        primary even if there is a replica. Default: False
+
+        :returns: A generator of the rows that satisfy the statement in
+        query.
+
+        """
+        if not query:
+            return
+
+        # Fall back to the primary only before the first row: the
+        # rows already yielded cannot be taken back.
+        cnx = None
+        cursor = None
+        role = self.route(query, primary)
+        if role == 'replica':
+            try:
+                cnx = self.stream_connection(role)
+                cursor = cnx.cursor(dictionary=dictionary, buffered=False)
+                cursor.execute(query, query_args)
+                self.replica_query_count += 1
+            except mysql.connector.Error as e:
+                if cnx is not None:
+                    cnx.close()
+                cnx = None
+                cursor = None
+                self.replica_failed(e)
+                role = 'primary'
+
+        if cnx is None:
+            cnx = self.stream_connection(role)
+
+        self.query_count += 1
+        finished = False
+        try:
+            if cursor is None:
+                cursor = cnx.cursor(dictionary=dictionary, buffered=False)
+                cursor.execute(query, query_args)
+            while True:
+                rows = cursor.fetchmany(size=batch_size)
+                if not rows:
+                    break
+                yield from rows
+            cursor.close()
+            finished = True
+        finally:
+            # Closing the connection (rather than the cursor) discards
+            # any unread rows if the caller stops iterating early.
+            if finished and role not in self.stream_cnx:
+                self.stream_cnx[role] = cnx
+            else:
+                cnx.close()
+
+    def stream_connection(self, role):
+        """Return the idle connection for iterate() on role ('primary' or 'replica').
+
+        :returns: The connection kept by the last iterate() on role (see
+        iterate()), or a new one. The connection belongs to the caller
+        until it is given back.
+
+        """
+        cnx = self.stream_cnx.pop(role, None)
+        if cnx is not None and cnx.is_connected():
+            return cnx
+
+        return self.connect_replica() if role == 'replica' else self.connect()
@@ -1,26 +1,428 @@
 """A set of classes and functions for btd_sched.py (and others?)."""
 
 import sys
+import copy
+import logging
+import signal
 import time
 from datetime import datetime, timedelta
 from pathlib import Path
 import re
+from bisect import bisect_left
+from collections import Counter
 from iteration_utilities import deepflatten
 from rivendell_lib import RDDatabase
 
-def my_print(*p_args, **p_kwargs):
-    """My print function that always goes to STDERR."""
-    print(*p_args, **p_kwargs, file=sys.stderr)
+# Logging levels for the -v options: -v, -vv and -vvv.
+VERBOSE = logging.INFO
+VERY_VERBOSE = 15
+DEBUG = logging.DEBUG
+VERBOSITY = [logging.WARNING, VERBOSE, VERY_VERBOSE, DEBUG]
+logging.addLevelName(VERY_VERBOSE, 'VERY_VERBOSE')
+
+class Log():
+    """A logger whose messages use str.format() placeholders.
+
+    A message is formatted only if the logger is enabled for its
+    level, so a disabled call costs a method call and a level check.
+    Arguments are still evaluated, so guard expensive ones with
+    enabled(), e.g.:
+
+      if LOG.enabled(DEBUG):
+          LOG.debug("query: {q}", q=query % query_args)
+
+    """
+
+    __slots__ = ('logger',)
+
+    def __init__(self, name):
+        """Make a logger.
+
+        :param name: The name of the logger (see configure_logging()).
+
+        """
+        self.logger = logging.getLogger(name)
+
+    def enabled(self, level):
+        """Whether messages at level will be emitted."""
+        return self.logger.isEnabledFor(level)
+
+    def log(self, level, message, *args, **kwargs):
+        """Emit message at level, formatted with args and kwargs (if any)."""
+        if self.logger.isEnabledFor(level):
+            self.logger.log(level, message.format(*args, **kwargs) if args or kwargs else message)
+
+    def verbose(self, message, *args, **kwargs):
+        """Emit message for -v."""
+        if self.logger.isEnabledFor(VERBOSE):
+            self.logger.log(VERBOSE, message.format(*args, **kwargs) if args or kwargs else message)
+
+    def very_verbose(self, message, *args, **kwargs):
+        """Emit message for -vv."""
+        if self.logger.isEnabledFor(VERY_VERBOSE):
+            self.logger.log(VERY_VERBOSE, message.format(*args, **kwargs) if args or kwargs else message)
+
+    def debug(self, message, *args, **kwargs):
+        """Emit message for -vvv."""
+        if self.logger.isEnabledFor(DEBUG):
+            self.logger.log(DEBUG, message.format(*args, **kwargs) if args or kwargs else message)
+
+def log_level(spec):
+    """Parse a logger level setting.
+
+    :param spec: A string 'LOGGER=LEVEL', where LEVEL is a logging
+    level name (e.g., 'debug', 'very_verbose', 'verbose', 'info',
+    'warning'). 'verbose' is the same as 'info', the level of -v.
+    :returns: A tuple of the logger name and the (numeric) level.
+
+    """
+    name, _, level_name = spec.partition('=')
+    if level_name.lower() == 'verbose':
+        level = VERBOSE
+    else:
+        level = logging.getLevelName(level_name.upper())
+    if not name or not isinstance(level, int):
+        raise ValueError("expected LOGGER=LEVEL, not '{s}'".format(s=spec))
+
+    return name, level
+
+def configure_logging(verbose=0, levels=()):
+    """Send log messages to STDERR.
+
+    :param verbose: The number of -v options, setting the level of
+    all loggers.
+    :param levels: A list of (logger name, level) tuples (see
+    log_level()) overriding the level of individual loggers.
+
+    """
+    logging.basicConfig(stream=sys.stderr, format='%(message)s',
+                        level=VERBOSITY[min(verbose, len(VERBOSITY) - 1)])
+    for name, level in levels:
+        logging.getLogger(name).setLevel(level)
+
+LOG = Log('schedlib')
+
+def first_hour_of_day(clock_date):
+    """Return the first Rivendell hour of the week for clock_date.
+
+    :param clock_date: A date in the form YYYY-MM-DD (Zero-filled).
+    :returns: The hour of the week (0 [Midnight Monday], 24, ..., 144
+    [Midnight Sunday]).
+
+    """
+    return (int(time.strftime("%u", time.strptime(clock_date, "%Y-%m-%d"))) - 1) * 24
+
+class Slot():
+    """A Clock Line in one hour of the week: a slot to fill with a Cart."""
+
+    __slots__ = ('hour', 'start_time', 'length', 'event_name', 'sched_group', 'schedcode1', 'schedcode2')
+
+    def __init__(self, hour, start_time, length, event_name, sched_group, schedcode1, schedcode2):
+        """Make a slot.
+
+        :param hour: The Rivendell hour of the week (0 to 167).
+        :param start_time: The start time of the Clock Line
+        (milliseconds after the top of the hour).
+        :param length: The length of the Clock Line in milliseconds.
+        :param event_name: The name of the Clock Line's Event.
+        :param sched_group: The (lowercase) Group of the Event.
+        :param schedcode1: The Event's "Must have code" Scheduler Code.
+        :param schedcode2: The Event's "and code" Scheduler Code.
+
+        """
+        self.hour = hour
+        self.start_time = start_time
+        self.length = length
+        self.event_name = event_name
+        self.sched_group = sched_group
+        self.schedcode1 = schedcode1
+        self.schedcode2 = schedcode2
+
+    def __repr__(self):
+        """Represent ourself to the world."""
+        return "Slot({h}, {s}, {l}, '{e}')".format(h=self.hour, s=self.start_time, l=self.length, e=self.event_name)
+
+class Grid():
+    """A snapshot of the grid of a Service.
+
+    Every Clock Line in every hour of the week, with its Event, read
+    with one query. Batch builds its Days, Hours and Events from a
+    Grid, and btd_sched takes the Scheduler Codes, the Event counts
+    and the ordered slots of each Day from it.
+
+    """
+
+    def __init__(self, service_name, db=None):
+        """Load the grid.
+
+        :param service_name: The name of (typically) the Rivendell
+        Reference Service.
+        :param db: An RDDatabase instance to use for the queries
+        (default: make a new connection).
+
+        """
+        self.service_name = service_name
+        self.db = db if db is not None else RDDatabase(None)
+        self.query = ("SELECT sc.hour AS hour, sc.clock_name AS clock_name, "
+                      "cl.start_time AS start_time, cl.length AS length, cl.event_name AS event_name, "
+                      "LCASE(ev.sched_group) AS sched_group, "
+                      "ev.have_code AS schedcode1, ev.have_code2 AS schedcode2, "
+                      "ev.artist_sep AS artist_sep, ev.title_sep AS title_sep "
+                      "FROM SERVICE_CLOCKS AS sc "
+                      "LEFT JOIN CLOCK_LINES AS cl ON (sc.clock_name = cl.clock_name) "
+                      "LEFT JOIN EVENTS AS ev ON (cl.event_name = ev.name) "
+                      "WHERE sc.service_name = %s "
+                      "ORDER BY sc.hour, cl.start_time")
+        self.query_args = (service_name,)
+        # The Clock name for each hour of the week.
+        self.hours = {}
+        # All the slots (Slot) in the week, in time order.
+        self.slots = []
+        # The scheduling fields (see Event) of each Event, by name.
+        self.events = {}
+        # The index in self.slots of the first slot of each hour (and
+        # the end of the week).
+        self.offsets = []
+        # The (start time, length, Event name) of the Clock Lines of
+        # each Clock in the grid, in time order (see refresh()).
+        self.clock_lines = {}
+        self.checksum = self.get_checksum()
+        self.fingerprints = self.get_fingerprints()
+        self.load()
+
+    def load(self):
+        """Read the grid from the database."""
+        self.hours = {}
+        self.slots = []
+        self.events = {}
+        hour_lines = {}
+        for row in self.db.fetchall(self.query, self.query_args, dictionary=True, prepared=True):
+            self.hours[row['hour']] = row['clock_name']
+            if row['start_time'] is None:
+                # An hour without a Clock, or an empty Clock.
+                continue
+            self.slots.append(Slot(row['hour'], row['start_time'], row['length'], row['event_name'],
+                                   row['sched_group'], row['schedcode1'], row['schedcode2']))
+            hour_lines.setdefault(row['hour'], []).append((row['start_time'], row['length'], row['event_name']))
+            if row['event_name'] not in self.events:
+                self.events[row['event_name']] = self.event_fields(row)
+
+        self.clock_lines = {clock_name: hour_lines.get(hour, [])
+                            for hour, clock_name in self.hours.items() if clock_name is not None}
+        slot_hours = [slot.hour for slot in self.slots]
+        self.offsets = [bisect_left(slot_hours, hour) for hour in range(169)]
+
+    @staticmethod
+    def event_fields(row):
+        """Return the scheduling fields of an Event from a row of a grid query."""
+        return {
+            'sched_group': row['sched_group'],
+            'schedcode1': row['schedcode1'],
+            'schedcode2': row['schedcode2'],
+            'artist_sep': row['artist_sep'],
+            'title_sep': row['title_sep'],
+        }
+
+    def load_clocks(self, clock_names):
+        """Read the Clock Lines of some Clocks into self.clock_lines.
+
+        :param clock_names: A set of Clock names.
+
+        """
+        query = ("SELECT cl.clock_name AS clock_name, cl.start_time AS start_time, "
+                 "cl.length AS length, cl.event_name AS event_name "
+                 "FROM CLOCK_LINES AS cl "
+                 "WHERE cl.clock_name IN ({p}) "
+                 "ORDER BY cl.clock_name, cl.start_time").format(p=', '.join(['%s'] * len(clock_names)))
+        for clock_name in clock_names:
+            self.clock_lines[clock_name] = []
+        for row in self.db.fetchall(query, tuple(sorted(clock_names)), dictionary=True):
+            self.clock_lines[row['clock_name']].append((row['start_time'], row['length'], row['event_name']))
+
+    def load_events(self, event_names):
+        """Read the scheduling fields of some Events into self.events.
+
+        Events missing from EVENTS get empty fields, as in load().
+
+        :param event_names: A set of Event names.
+
+        """
+        query = ("SELECT ev.name AS event_name, LCASE(ev.sched_group) AS sched_group, "
+                 "ev.have_code AS schedcode1, ev.have_code2 AS schedcode2, "
+                 "ev.artist_sep AS artist_sep, ev.title_sep AS title_sep "
+                 "FROM EVENTS AS ev "
+                 "WHERE ev.name IN ({p})")
+        missing = {'sched_group': None, 'schedcode1': None, 'schedcode2': None, 'artist_sep': None, 'title_sep': None}
+        for event_name in event_names:
+            self.events[event_name] = dict(missing)
+        # Clock Lines without an Event have no row to read.
+        query_args = tuple(sorted(event_name for event_name in event_names if event_name is not None))
+        if query_args:
+            query = query.format(p=', '.join(['%s'] * len(query_args)))
+            for row in self.db.fetchall(query, query_args, dictionary=True):
+                self.events[row['event_name']] = self.event_fields(row)
+
+    def hour_slots(self, hour):
+        """Return the slots of hour from its Clock's lines and their Events."""
+        slots = []
+        for start_time, length, event_name in self.clock_lines.get(self.hours.get(hour), ()):
+            event = self.events[event_name]
+            slots.append(Slot(hour, start_time, length, event_name,
+                              event['sched_group'], event['schedcode1'], event['schedcode2']))
+        return slots
+
+    def slots_between(self, first_hour, last_hour):
+        """Return the slots from first_hour to last_hour (inclusive), in time order.
+
+        :param first_hour: The first Rivendell hour of the week (0 to 167).
+        :param last_hour: The last Rivendell hour of the week (0 to
+        167, not less than first_hour).
+
+        """
+        return self.slots[self.offsets[first_hour]:self.offsets[last_hour + 1]]
+
+    def get_query(self):
+        """Return a string containing the formatted query with query_args for a Grid."""
+        return self.query % self.query_args
+
+    def get_checksum(self):
+        """Get one checksum of the whole grid, its Clocks and Events.
+
+        One row, so that refresh() can tell cheaply that nothing has
+        changed before it asks which parts have (see
+        get_fingerprints()).
+
+        """
+        query = ("SELECT "
+                 "(SELECT CONCAT(COUNT(*), ':', BIT_XOR(CRC32(CONCAT_WS('|', sc.hour, sc.clock_name)))) "
+                 "FROM SERVICE_CLOCKS AS sc WHERE sc.service_name = %s) AS hours, "
+                 "(SELECT CONCAT(COUNT(*), ':', "
+                 "BIT_XOR(CRC32(CONCAT_WS('|', cl.clock_name, cl.start_time, cl.length, cl.event_name)))) "
+                 "FROM CLOCK_LINES AS cl WHERE cl.clock_name IN "
+                 "(SELECT clock_name FROM SERVICE_CLOCKS WHERE service_name = %s)) AS clocks, "
+                 "(SELECT CONCAT(COUNT(*), ':', BIT_XOR(CRC32(CONCAT_WS('|', ev.name, ev.sched_group, "
+                 "ev.have_code, ev.have_code2, ev.artist_sep, ev.title_sep)))) "
+                 "FROM EVENTS AS ev WHERE ev.name IN "
+                 "(SELECT cl.event_name FROM CLOCK_LINES AS cl "
+                 "LEFT JOIN SERVICE_CLOCKS AS sc ON (sc.clock_name = cl.clock_name) "
+                 "WHERE sc.service_name = %s)) AS events")
+        rows = self.db.fetchall(query, (self.service_name,) * 3, dictionary=True, prepared=True)
+        return rows[0] if rows else None
+
+    def get_fingerprints(self):
+        """Get cheap fingerprints of the grid, Clocks and Events.
+
+        :returns: A dict containing 'hours' (the Clock name for each
+        hour of the week in SERVICE_CLOCKS), 'clocks' (a checksum of
+        the CLOCK_LINES for each Clock in the grid) and 'events' (a
+        checksum of the scheduling fields for each Event in those
+        Clocks).
+
+        """
+        query = ("SELECT hour, clock_name FROM SERVICE_CLOCKS "
+                 "WHERE service_name = %s")
+        hours = {row['hour']: row['clock_name']
+                 for row in self.db.fetchall(query, (self.service_name,), dictionary=True, prepared=True)}
+
+        # BIT_XOR() of per-line checksums is independent of row order
+        # and, unlike GROUP_CONCAT(), is never truncated.
+        query = ("SELECT cl.clock_name AS clock_name, "
+                 "CONCAT(COUNT(*), ':', "
+                 "BIT_XOR(CRC32(CONCAT_WS('|', cl.start_time, cl.length, cl.event_name)))) AS fingerprint "
+                 "FROM CLOCK_LINES AS cl "
+                 "WHERE cl.clock_name IN "
+                 "(SELECT clock_name FROM SERVICE_CLOCKS WHERE service_name = %s) "
+                 "GROUP BY cl.clock_name")
+        clocks = {row['clock_name']: row['fingerprint']
+                  for row in self.db.fetchall(query, (self.service_name,), dictionary=True, prepared=True)}
+
+        query = ("SELECT ev.name AS event_name, "
+                 "CRC32(CONCAT_WS('|', ev.sched_group, ev.have_code, ev.have_code2, "
+                 "ev.artist_sep, ev.title_sep)) AS fingerprint "
+                 "FROM EVENTS AS ev "
+                 "WHERE ev.name IN "
+                 "(SELECT cl.event_name FROM CLOCK_LINES AS cl "
+                 "LEFT JOIN SERVICE_CLOCKS AS sc ON (sc.clock_name = cl.clock_name) "
+                 "WHERE sc.service_name = %s)")
+        events = {row['event_name']: row['fingerprint']
+                  for row in self.db.fetchall(query, (self.service_name,), dictionary=True, prepared=True)}
+
+        return {'hours': hours, 'clocks': clocks, 'events': events}
+
+    def refresh(self):
+        """Reload the parts of the grid that have changed since it was loaded.
+
+        If the checksum of the grid (see get_checksum()) is unchanged,
+        that is all. Otherwise the fingerprints (see get_fingerprints())
+        are one row for each hour, Clock and Event. Then only the
+        CLOCK_LINES of the changed (or newly assigned) Clocks and the
+        EVENTS of the changed (or newly used) Events are read, and only
+        the slots of the hours using them are rebuilt.
+
+        :returns: A dict of the sets of changed 'hours', 'clocks' and
+        'events' (see get_fingerprints()), all empty if nothing has
+        changed.
+
+        """
+        checksum = self.get_checksum()
+        if checksum == self.checksum:
+            return {kind: set() for kind in self.fingerprints}
+        self.checksum = checksum
+
+        fingerprints = self.get_fingerprints()
+        changes = {kind: {k for k in self.fingerprints[kind].keys() | fingerprints[kind].keys()
+                          if self.fingerprints[kind].get(k) != fingerprints[kind].get(k)}
+                   for kind in fingerprints}
+        self.fingerprints = fingerprints
+        if not any(changes.values()):
+            return changes
+
+        self.hours = dict(fingerprints['hours'])
+        clock_names = {clock_name for clock_name in self.hours.values() if clock_name is not None}
+        for clock_name in self.clock_lines.keys() - clock_names:
+            del self.clock_lines[clock_name]
+        new_clocks = (changes['clocks'] & clock_names) | (clock_names - self.clock_lines.keys())
+        if new_clocks:
+            self.load_clocks(new_clocks)
+
+        event_names = {line[2] for lines in self.clock_lines.values() for line in lines}
+        for event_name in self.events.keys() - event_names:
+            del self.events[event_name]
+        new_events = (changes['events'] & event_names) | (event_names - self.events.keys())
+        if new_events:
+            self.load_events(new_events)
+
+        # Splice the new slots of the changed hours into the others.
+        changed_hours = {hour for hour, clock_name in self.hours.items()
+                         if hour in changes['hours'] or clock_name in new_clocks or
+                         any(line[2] in new_events for line in self.clock_lines.get(clock_name, ()))}
+        slots = []
+        offsets = []
+        for hour in range(168):
+            offsets.append(len(slots))
+            if hour in changed_hours:
+                slots.extend(self.hour_slots(hour))
+            elif hour in self.hours:
+                slots.extend(self.slots_between(hour, hour))
+        offsets.append(len(slots))
+        self.slots = slots
+        self.offsets = offsets
+
+        return changes
 
 class Event():
     """An Event is an atomic element containing rules for scheduling Carts."""
 
-    def __init__(self, service_name, event_name):
+    def __init__(self, service_name, event_name, db=None, grid=None):
         """Instantiate an Event with the associated fields.
 
         :param service_name: The name of (typically) the Rivendell
         Reference Service.
         :param event_name: The name of a Rivendell Event to retrieve.
+        :param db: An RDDatabase instance to use for the query
+        (default: make a new connection).
+        :param grid: A Grid of service_name to take the Event from
+        instead of querying the database.
 
         """
         self.attributes = {}
@@ -35,15 +437,18 @@ class Event():
                       "WHERE sc.service_name = %s AND "
                       "ev.name = %s")
         self.query_args = (service_name, event_name,)
-        db = RDDatabase(None)
-        event = db.fetchone(self.query, self.query_args, dictionary=True)
+        if grid is not None:
+            event = grid.events[event_name]
+        else:
+            if db is None:
+                db = RDDatabase(None)
+            event = db.fetchone(self.query, self.query_args, dictionary=True, prepared=True)
         self.attributes['sched_group'] = event['sched_group']
         self.attributes['schedcode1'] = event['schedcode1']
         self.attributes['schedcode2'] = event['schedcode2']
         self.attributes['artist_sep'] = event['artist_sep']
         self.attributes['title_sep'] = event['title_sep']
         self.attributes['codes'] = event['schedcode1'] + '|' + event['schedcode2']
-        db.close()
 
     def list_attributes(self):
         """Return the list of Event attributes."""
@@ -56,13 +461,17 @@ class Event():
 class Hour():
     """An Hour is a list of Events each with a start time and a duration."""
 
-    def __init__(self, service_name, hour):
+    def __init__(self, service_name, hour, db=None, grid=None):
         """Instantiate an Hour, getting all the hour's Events.
 
         :param service_name: The name of (typically) the Rivendell
         Reference Service.
         :param hour: A "Rivendell hour of the week" to retrieve (from
         0 [Midnight Monday] to 167 [11pm Sunday]).
+        :param db: An RDDatabase instance to use for the queries
+        (default: make a new connection).
+        :param grid: A Grid of service_name to take the hour from
+        instead of querying the database.
 
         """
         self.service_name = service_name
@@ -74,13 +483,18 @@ class Hour():
                       "LEFT JOIN SERVICE_CLOCKS AS sc ON (sc.clock_name = cl.clock_name) "
                       "WHERE sc.service_name = %s AND hour = %s")
         self.query_args = (self.service_name, self.hour,)
-        db = RDDatabase(None)
-        rows = db.fetchall(self.query, self.query_args, dictionary=True)
+        if grid is not None:
+            rows = [{'start_time': slot.start_time, 'length': slot.length, 'event_name': slot.event_name}
+                    for slot in grid.slots_between(hour, hour)]
+        else:
+            if db is None:
+                db = RDDatabase(None)
+            rows = db.fetchall(self.query, self.query_args, dictionary=True, prepared=True)
         for row in rows:
             self.events.append({
                 'start_time': row['start_time'],
                 'length': row['length'],
-                'event': Event(service_name, row['event_name'])
+                'event': Event(service_name, row['event_name'], db, grid)
             })
 
     def values(self, attribute):
@@ -94,7 +508,6 @@ class Hour():
         to retrieve values.
 
         """
-        values = {}
         # If the first one has this attribute, they will all have it.
         if not attribute in self.events[0]['event'].attributes:
             print("Hour::attributes(): ERROR: no such attribute: {attr}. Try one of '{l}'."
@@ -105,11 +518,9 @@ class Hour():
                            for x, _ in enumerate(self.events)]
 
         # Get the counts of values for each instance of the specified
-        # Event attribute for this Hour.
-        for v in list(dict.fromkeys(values_for_hour)):
-            values[v] = values_for_hour.count(v)
-
-        return values
+        # Event attribute for this Hour (in one pass, in order of
+        # first appearance).
+        return dict(Counter(values_for_hour))
 
     def get_query(self):
         """Return a string containing the formatted query with query_args for an Hour."""
@@ -118,7 +529,7 @@ class Hour():
 class Day():
     """A Day is a list of 24 Hours."""
 
-    def __init__(self, service_name, clock_date):
+    def __init__(self, service_name, clock_date, db=None, grid=None):
         """Instantiate a Day, getting all 24 Hours.
 
         :param service_name: The name of (typically) the Rivendell
@@ -128,25 +539,34 @@ class Day():
         Rivendell Log. This date is simply used to calculate the
         starting hour of the week (from 0 [Midnight Monday] to 167
         [11pm Sunday]).
+        :param db: An RDDatabase instance to use for the queries
+        (default: make a new connection).
+        :param grid: A Grid of service_name to take the Hours from
+        instead of querying the database.
 
         """
         self.hours = []
         self.service_name = service_name
         self.clock_date = clock_date
         # These "hours" are Rivendell hours of the week (0 - 167).
-        self.first_hour = (int(time.strftime("%u", time.strptime(clock_date, "%Y-%m-%d"))) - 1) * 24
+        self.first_hour = first_hour_of_day(clock_date)
         self.last_hour = self.first_hour + 23
         self.query = ("SELECT hour, clock_name FROM SERVICE_CLOCKS "
                       "WHERE service_name = %s AND "
                       "hour BETWEEN %s AND %s")
         self.query_args = (service_name, self.first_hour, self.last_hour)
-        db = RDDatabase(None)
-        rows = db.fetchall(self.query, self.query_args, dictionary=True)
+        if grid is not None:
+            rows = [{'hour': hour, 'clock_name': grid.hours[hour]}
+                    for hour in range(self.first_hour, self.last_hour + 1) if hour in grid.hours]
+        else:
+            if db is None:
+                db = RDDatabase(None)
+            rows = db.fetchall(self.query, self.query_args, dictionary=True, prepared=True)
         for row in rows:
             self.hours.append({
                 'hour': row['hour'],
                 'clock_name': row['clock_name'],
-                'clock': Hour(service_name, row['hour'])
+                'clock': Hour(service_name, row['hour'], db, grid)
             })
 
     def values(self, attribute):
@@ -156,16 +576,12 @@ class Day():
         https://stackoverflow.com/questions/952914/how-to-make-a-flat-list-out-of-list-of-lists
 
         """
-        values = {}
         values_by_hour = [[self.hours[h]['clock'].events[e]['event'].attributes[attribute]
                            for e, _ in enumerate(self.hours[h]['clock'].events)]
                           for h, _ in enumerate(self.hours)]
         # Get the counts of values for each instance of the specified
         # Event attribute for this Day.
-        for v in list(dict.fromkeys([item for sublist in values_by_hour for item in sublist])):
-            values[v] = [item for sublist in values_by_hour for item in sublist].count(v)
-
-        return values
+        return dict(Counter(item for sublist in values_by_hour for item in sublist))
 
     def get_query(self):
         """Return a string containing the formatted query with query_args for a Day."""
@@ -174,7 +590,7 @@ class Day():
 class Batch():
     """A Batch is a collection of Days in a scheduling session."""
 
-    def __init__(self, service_name, start_date, day_count=1):
+    def __init__(self, service_name, start_date, day_count=1, db=None, grid=None):
         """Instantiate a Batch getting all the Days, Hours and Events.
 
         :param service_name: The name of (typically) the Rivendell
@@ -182,6 +598,11 @@ class Batch():
         :param start_date: The batch start date (in the form
         YYYY-MM-DD, Zero-filled).
         :param day_count: The number of days in this batch.
+        :param db: An RDDatabase instance for the queries of this
+        batch (default: make a new connection).
+        :param grid: A Grid of service_name (default: load one). The
+        Days, Hours and Events are built from it without further
+        queries.
 
         A specific Event in a Batch is referenced with, e.g.,
         Batch('service-name',
@@ -192,12 +613,56 @@ class Batch():
         self.service_name = service_name
         self.start_date = start_date
         self.day_count = day_count
-        self.days = [Day(service_name,
-                         (datetime.strptime(start_date, '%Y-%m-%d') +
-                          timedelta(days=count)).strftime("%F"))
+        self.db = db if db is not None else RDDatabase(None)
+        self.grid = grid if grid is not None else Grid(service_name, self.db)
+        # Days already built, indexed by their first hour of the week.
+        self.day_cache = {}
+        self.days = [self.get_day((datetime.strptime(start_date, '%Y-%m-%d') +
+                                   timedelta(days=count)).strftime("%F"))
                      for count in range(day_count)]
 
-    def values(self, attribute):
+    def get_day(self, clock_date):
+        """Return the Day for clock_date, loading it only if necessary.
+
+        A Day depends only on the day of the week, so a Day already
+        loaded for the same day of the week is reused (as a copy
+        carrying the new date, with its own list of Hours, see
+        refresh()).
+
+        :param clock_date: The date (in the form YYYY-MM-DD,
+        Zero-filled) of the Day.
+
+        """
+        first_hour = first_hour_of_day(clock_date)
+        day = self.day_cache.get(first_hour)
+        if day is None:
+            day = Day(self.service_name, clock_date, grid=self.grid)
+            self.day_cache[first_hour] = day
+        elif day.clock_date != clock_date:
+            day = copy.copy(day)
+            day.hours = list(day.hours)
+            day.clock_date = clock_date
+
+        return day
+
+    def reschedule(self, start_date, day_count=1):
+        """Point this Batch at a new range of dates.
+
+        Days for days of the week that we have already built are
+        reused.
+
+        :param start_date: The batch start date (in the form
+        YYYY-MM-DD, Zero-filled).
+        :param day_count: The number of days in this batch.
+
+        """
+        self.start_date = start_date
+        self.day_count = day_count
+        self.days = [self.get_day((datetime.strptime(start_date, '%Y-%m-%d') +
+                                   timedelta(days=count)).strftime("%F"))
+                     for count in range(day_count)]
+
+    def values(self, attribute, day_count=None):
         """Return the values for an entire Batch.
 
         This returns a dict of occurances indexed by "attribute"
@@ -206,36 +671,334 @@ class Batch():
         See above for the details.
 
         :param attribute: An Event attribute to summarize.
+        :param day_count: Summarize only the first day_count Days
+        (default: all the Days in the Batch).
 
         :returns: A dict indexed by attribute values, the dict values
         being the number of occurances of that attribute value.
 
         """
-        values = {}
-        values_by_day_by_hour = [[[self.days[d].hours[h]['clock'].events[e]['event'].attributes[attribute]
-                                   for e, _ in enumerate(self.days[d].hours[h]['clock'].events)]
-                                  for h, _ in enumerate(self.days[d].hours)]
-                                 for d, _ in enumerate(self.days)]
+        days = self.days[:day_count]
+        values_by_day_by_hour = [[[days[d].hours[h]['clock'].events[e]['event'].attributes[attribute]
+                                   for e, _ in enumerate(days[d].hours[h]['clock'].events)]
+                                  for h, _ in enumerate(days[d].hours)]
+                                 for d, _ in enumerate(days)]
         # Get the counts of values for each instance of the specified
         # Event attribute for this whole Batch.
-        for v in list(dict.fromkeys(list(deepflatten(values_by_day_by_hour, depth=2)))):
-            values[v] = list(deepflatten(values_by_day_by_hour, depth=2)).count(v)
+        return dict(Counter(deepflatten(values_by_day_by_hour, depth=2)))
 
-        return values
+    def counts(self, attributes, day_count=None):
+        """Count the Events in this Batch by a combination of attributes.
+
+        :param attributes: A list of Event attributes (see Event()).
+        :param day_count: Count only the first day_count Days
+        (default: all the Days in the Batch).
+
+        :returns: A Counter indexed by tuples of the values of the
+        attributes, the counts being the number of Events with those
+        values.
+
+        """
+        return Counter(tuple(event['event'].attributes[a] for a in attributes)
+                       for day in self.days[:day_count]
+                       for hour in day.hours
+                       for event in hour['clock'].events)
 
     def refresh(self):
-        """Reload the entire configuration.
+        """Reload the parts of the configuration that have changed.
 
-        The reload uses the original instantiation values.
+        Refresh the Grid (see Grid.refresh()), then rebuild only the
+        Hours whose Clock assignment or Clock Lines changed and the
+        Events whose scheduling fields changed. A Day is rebuilt only
+        if hours were added to or removed from its part of the grid.
 
         This might be used in a long-running process during
-        which the database may have changed.
+        which the database may have changed. The Days, Hours and
+        Events already handed out are not changed: changed Hours are
+        replaced in new lists, and Hours with changed Events are
+        copied.
+
+        :returns: The number of Days, Hours and Events rebuilt.
+
+        """
+        changes = self.grid.refresh()
+        changed_hours = changes['hours']
+        changed_clocks = changes['clocks']
+        changed_events = changes['events']
+        rebuilt = 0
+
+        if not (changed_hours or changed_clocks or changed_events):
+            return rebuilt
+
+        events = {}
+        for first_hour, day in list(self.day_cache.items()):
+            grid_hours = {h for h in self.grid.hours if first_hour <= h <= first_hour + 23}
+            if grid_hours != {entry['hour'] for entry in day.hours}:
+                self.day_cache[first_hour] = Day(self.service_name, day.clock_date, grid=self.grid)
+                rebuilt += 1
+                continue
+
+            hours = list(day.hours)
+            for index, entry in enumerate(hours):
+                if entry['hour'] in changed_hours or entry['clock_name'] in changed_clocks:
+                    hours[index] = {
+                        'hour': entry['hour'],
+                        'clock_name': self.grid.hours[entry['hour']],
+                        'clock': Hour(self.service_name, entry['hour'], grid=self.grid)
+                    }
+                    rebuilt += 1
+                    continue
+
+                if not any(event['event'].event_name in changed_events for event in entry['clock'].events):
+                    continue
+
+                clock = copy.copy(entry['clock'])
+                clock.events = [dict(event) for event in clock.events]
+                for event in clock.events:
+                    event_name = event['event'].event_name
+                    if event_name in changed_events:
+                        if event_name not in events:
+                            events[event_name] = Event(self.service_name, event_name, grid=self.grid)
+                        event['event'] = events[event_name]
+                        rebuilt += 1
+                hours[index] = dict(entry, clock=clock)
+            day.hours = hours
+
+        self.reschedule(self.start_date, self.day_count)
+
+        return rebuilt
+
+class Track():
+    """A track: a simplified view of a Cart.
+
+    Pools hold many thousands of these, so we use __slots__ rather
+    than a dict per track.
+
+    """
+
+    __slots__ = ('cart_number', 'artist', 'title', 'length', 'cuts', 'sched_code', 'last_play')
+
+    def __init__(self, cart_number, artist, title, length, cuts=1, sched_code=None, last_play=None):
+        """Make a track.
+
+        The parameters are in the order of the columns of the pool
+        query in btd_sched.fetch_pool_page().
+
+        :param cart_number: The Cart number.
+        :param artist: The Cart's artist.
+        :param title: The Cart's title.
+        :param length: The length of the track in milliseconds.
+        :param cuts: The number of (playable) Cuts in the Cart.
+        :param sched_code: A Scheduler Code of the Cart.
+        :param last_play: The time the Cart was last played.
+
+        """
+        self.cart_number = cart_number
+        self.artist = artist
+        self.title = title
+        self.length = int(length)
+        self.cuts = cuts
+        self.sched_code = sched_code
+        self.last_play = last_play
+
+    def __repr__(self):
+        """Represent ourself to the world."""
+        return "Track({c}, '{a}', '{t}', {l})".format(c=self.cart_number, a=self.artist,
+                                                      t=self.title, l=self.length)
+
+class ImportLine():
+    """A line in a Music Data Import file: a track and its start time."""
+
+    __slots__ = ('day', 'hour', 'start_time', 'cart_number', 'title', 'length')
+
+    def __init__(self, day, hour, start_time, cart_number, title, length):
+        """Make an import line.
+
+        :param day: The day of the week (0 [Monday] to 6 [Sunday]).
+        :param hour: The Rivendell hour of the week (0 to 167).
+        :param start_time: The start time (milliseconds after midnight).
+        :param cart_number: The Cart number.
+        :param title: The Cart's title.
+        :param length: The length of the track in milliseconds.
+
+        """
+        self.day = day
+        self.hour = hour
+        self.start_time = start_time
+        self.cart_number = cart_number
+        self.title = title
+        self.length = length
+
+    def __repr__(self):
+        """Represent ourself to the world."""
+        return "ImportLine({h}, {s}, {c}, '{t}', {l})".format(h=self.hour, s=self.start_time, c=self.cart_number,
+                                                              t=self.title, l=self.length)
+
+class PoolBucket(list):
+    """The candidate tracks for one Group and Scheduler Code.
+
+    A list of tracks that also remembers where the last page of tracks
+    fetched from the Library ended, so that the next page may be
+    fetched with keyset pagination.
+
+    """
+
+    def __init__(self, tracks=()):
+        """Make a bucket.
+
+        :param tracks: The initial tracks in the bucket.
 
         """
-        self.days = [Day(self.service_name,
-                         (datetime.strptime(self.start_date, '%Y-%m-%d') +
-                          timedelta(days=count)).strftime("%F"))
-                     for count in range(self.day_count)]
+        super().__init__(tracks)
+        # The sort key (last play time, Cart number) of the last track
+        # fetched, or None if nothing has been fetched.
+        self.cursor = None
+        # Whether the Library has no more tracks for this bucket.
+        self.exhausted = False
+
+class SchedCodeIndex():
+    """The Scheduler Codes of the Carts in the Library.
+
+    Read once per run from CART_SCHED_CODES (and CART, for the Group
+    and artist of each Cart). Each Scheduler Code gets a bit and each
+    Cart the mask of the bits of its Codes, so whether a Cart has all
+    of several Codes is one dict lookup and an AND. The inverted lists
+    (the Carts of each Group with each Code) give the number of Carts
+    in a Group having all of several Codes.
+
+    Groups and Scheduler Codes are compared without regard to case, as
+    they are in the Library queries.
+
+    """
+
+    def __init__(self, db, sched_codes=None, groups=None):
+        """Read the index.
+
+        :param db: The RDDatabase (or LibrarySnapshot) of the Library.
+        :param sched_codes: Index only these Scheduler Codes (default:
+        all of them).
+        :param groups: Index only the Carts in these Groups (default:
+        all of them).
+
+        """
+        query = ("SELECT c.group_name, s.cart_number, s.sched_code, c.artist "
+                 "FROM CART_SCHED_CODES AS s "
+                 "JOIN CART AS c ON (c.number = s.cart_number)")
+        constraints = []
+        query_args = ()
+        for column, values in (('s.sched_code', sched_codes), ('c.group_name', groups)):
+            if values is not None:
+                values = tuple(sorted({value.lower() for value in values}))
+                constraints.append("{c} IN ({p})".format(c=column, p=', '.join(['%s'] * len(values))))
+                query_args += values
+        if constraints:
+            query += " WHERE " + " AND ".join(constraints)
+
+        # The bit of each Scheduler Code.
+        self.bits = {}
+        # The mask of the Scheduler Codes of each Cart.
+        self.masks = {}
+        # The set of Carts with each Scheduler Code, indexed by
+        # (Group, Scheduler Code).
+        self.carts = {}
+        # The artist of each Cart.
+        self.artists = {}
+        # An empty list of Scheduler Codes or Groups needs no query.
+        empty = any(values is not None and not values for values in (sched_codes, groups))
+        rows = db.fetchall(query, query_args) if not empty else []
+        for group, cart_number, sched_code, artist in rows:
+            bit = self.bit(sched_code)
+            self.masks[cart_number] = self.masks.get(cart_number, 0) | bit
+            self.carts.setdefault(self.key(group, sched_code), set()).add(cart_number)
+            self.artists[cart_number] = artist
+
+        LOG.verbose("SchedCodeIndex: {c} Carts with {n} Scheduler Codes.", c=len(self.masks), n=len(self.bits))
+
+    def __len__(self):
+        """Return the number of Carts in the index."""
+        return len(self.masks)
+
+    @staticmethod
+    def key(group, sched_code):
+        """Return the key of the inverted list of a Group and Scheduler Code."""
+        return ((group or '').strip().lower(), sched_code.strip().lower())
+
+    def bit(self, sched_code):
+        """Return the bit of a Scheduler Code (a new one if we have not seen it)."""
+        return self.bits.setdefault(sched_code.strip().lower(), 1 << len(self.bits))
+
+    def mask(self, sched_codes):
+        """Return the mask of several Scheduler Codes."""
+        mask = 0
+        for sched_code in sched_codes:
+            mask |= self.bit(sched_code)
+        return mask
+
+    def has_all(self, cart_number, mask):
+        """Whether the Cart has all the Scheduler Codes in mask (see mask())."""
+        return self.masks.get(cart_number, 0) & mask == mask
+
+    def carts_with_all(self, group, sched_codes):
+        """Return the set of Carts in group having all of the Scheduler Codes."""
+        carts = sorted((self.carts.get(self.key(group, code), set()) for code in sched_codes), key=len)
+        if not carts:
+            return set()
+        return carts[0].intersection(*carts[1:])
+
+    def count(self, group, sched_codes):
+        """Return the number of Carts in group having all of the Scheduler Codes."""
+        return len(self.carts_with_all(group, sched_codes))
+
+    def artist_count(self, group, sched_codes):
+        """Return the number of artists of the Carts in group having all of the Scheduler Codes."""
+        return len({self.artists[cart_number].lower()
+                    for cart_number in self.carts_with_all(group, sched_codes)
+                    if self.artists[cart_number] is not None})
+
+class StackSampler():
+    """A sampling CPU profiler.
+
+    Records the Python call stack every "interval" seconds of CPU time
+    and saves the counts as "collapsed" stacks (one line per unique
+    stack, "outermost;...;innermost count"), the input format of
+    flame graph tools such as flamegraph.pl and speedscope.
+
+    """
+
+    def __init__(self, interval=0.005):
+        """Make a sampler.
+
+        :param interval: The sampling interval in seconds of CPU time.
+
+        """
+        self.interval = interval
+        self.stacks = Counter()
+
+    def sample(self, signum, frame):
+        """Record the stack of the interrupted frame (a SIGPROF handler)."""
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append("{f} ({m}:{l})".format(f=code.co_name, m=Path(code.co_filename).name,
+                                               l=code.co_firstlineno))
+            frame = frame.f_back
+        self.stacks[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        """Start sampling."""
+        signal.signal(signal.SIGPROF, self.sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        """Stop sampling."""
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_DFL)
+
+    def save(self, filename):
+        """Save the collapsed stacks to filename."""
+        with open(filename, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write("{s} {c}\n".format(s=stack, c=count))
 
 class OutputFile():
     """An output file.
@@ -245,24 +1008,30 @@ class OutputFile():
 
     """
 
-    def __init__(self, service_name, import_date, debug):
+    def __init__(self, service_name, import_date, output_dir=None, db=None):
         """Construct the object and set the directory name for the file.
 
         :param service_name: The (case-insensitive) Implementation Service name.
         :param import_date: the date (in YYYY-MM-DD format) for the output file.
-        :param debug: Debug mode (boolean)
+        :param output_dir: The directory for the output file (default:
+        the directory of the Service's Music Data Import Path).
+        :param db: The RDDatabase holding the Service (default: a new
+        connection to the Rivendell database). The file name comes from
+        the Service's Music Data Import Path even with output_dir, so
+        this is needed even when the Library is read from a snapshot.
 
         """
         self.service_name = service_name
         self.import_date = import_date
-        self.debug = debug
         self.fullpath = None
 
         self.query = "SELECT mus_path FROM SERVICES WHERE name = %s"
         self.query_args = (self.service_name,)
-        rows = RDDatabase(None).fetchall(self.query, self.query_args, dictionary=True)
+        db = db if db is not None else RDDatabase(None)
+        rows = db.fetchall(self.query, self.query_args, dictionary=True)
 
         self.mus_path = Path(rows[0]['mus_path'])
+        self.directory = Path(output_dir) if output_dir else self.mus_path.parent
 
     def get_query(self):
         """Return a string containing the formatted query with query_args for a Day.
@@ -279,15 +1048,14 @@ class OutputFile():
         creating the directory
 
         """
-        if not self.mus_path.parent.is_dir():
+        if not self.directory.is_dir():
             try:
-                if self.debug:
-                    my_print("make_directory: '{dir}' is missing, attempting to create it."
-                             .format(dir=str(self.mus_path.parent.name)))
-                self.mus_path.parent.mkdir(parents=True, exist_ok=True)
+                LOG.verbose("make_directory: '{dir}' is missing, attempting to create it.",
+                            dir=str(self.directory.name))
+                self.directory.mkdir(parents=True, exist_ok=True)
             except OSError as e:
                 print("schedlib.OutputFile: ERROR: Unable to create directory '{d}' ('{e}')."
-                      .format(d=self.mus_path.parent.name, e=e), file=sys.stderr)
+                      .format(d=self.directory.name, e=e), file=sys.stderr)
                 return False
 
         return True
@@ -327,9 +1095,7 @@ class OutputFile():
         self.import_date = "{yyyy}-{mm}-{dd}.txt".format(yyyy=d_parts['year'],
                                                          mm=d_parts['month'],
                                                          dd=d_parts['day'])
-        if self.debug:
-            print("make_name: set self.filename to '{f}'."
-                  .format(f=self.import_date), file=sys.stderr)
+        LOG.verbose("make_name: set self.filename to '{f}'.", f=self.import_date)
 
         return self.import_date
 
@@ -348,10 +1114,8 @@ class OutputFile():
                                              time.strptime(self.import_date,
                                                            '%Y-%m-%d')))
         except ValueError as e:
-            if self.debug:
-                print("schedlib.OutputFile: unknown directive in Music Data Import Path: {e}"
-                      .format(e=e), file=sys.stderr)
+            LOG.verbose("schedlib.OutputFile: unknown directive in Music Data Import Path: {e}", e=e)
             import_date = self.make_name()
 
-        self.fullpath = self.mus_path.parent / import_date
+        self.fullpath = self.directory / import_date
         return self.fullpath
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""audio_library.py: make a small Library for testing btd-library-duplicates.py --audio.
+
+  python3 audio_library.py DIRECTORY
+
+writes a Library snapshot (see btd_sched/library.py) to
+DIRECTORY/library.db and the audio of its Cuts to DIRECTORY/snd. Each
+"recording" is noise shaped by a random loudness envelope. Carts 2,
+3, 4 and 7 are copies of Carts 1 and 5: quieter, starting part way
+through, with added noise, and in mono. Carts 5 and 6 are different
+recordings.
+
+"""
+
+import os
+import sys
+import random
+import wave
+from array import array
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'btd_sched'))
+from library import LibrarySnapshot
+
+RATE = 22050
+SECONDS = 30
+# The number of loudness changes per second.
+ENVELOPE_RATE = 20
+
+def envelope(seed):
+    """Return a random loudness envelope (a list of levels from 0.05 to 1)."""
+    r = random.Random(seed)
+    levels = []
+    level = 0.5
+    for _ in range(SECONDS * ENVELOPE_RATE):
+        level = min(1.0, max(0.05, level + r.uniform(-0.2, 0.2)))
+        levels.append(level)
+    return levels
+
+def write_wav(path, levels, gain=1.0, shift=0.0, noise=0.0, channels=2):
+    """Write the recording with the loudness envelope levels to path.
+
+    :param gain: Scale the recording by this much.
+    :param shift: Start this many seconds into the recording.
+    :param noise: Add this much (unshaped) noise.
+    :param channels: The number of (identical) channels.
+
+    """
+    r = random.Random(path)
+    samples = array('h')
+    for i in range(int(shift * RATE), SECONDS * RATE):
+        value = levels[i * ENVELOPE_RATE // RATE] * gain * 12000 * r.uniform(-1, 1) + noise * 12000 * r.uniform(-1, 1)
+        samples.extend([int(max(-32767, min(32767, value)))] * channels)
+    with wave.open(path, 'wb') as w:
+        w.setnchannels(channels)
+        w.setsampwidth(2)
+        w.setframerate(RATE)
+        w.writeframes(samples.tobytes())
+
+def main():
+    directory = sys.argv[1]
+    audio_dir = os.path.join(directory, 'snd')
+    os.makedirs(audio_dir, exist_ok=True)
+
+    first, second, third = envelope(1), envelope(2), envelope(3)
+    carts = {
+        1: (first, {}),
+        2: (first, {'gain': 0.5}),
+        3: (first, {'shift': 1.37}),
+        4: (first, {'noise': 0.15}),
+        5: (second, {}),
+        6: (third, {}),
+        7: (second, {'gain': 1.3, 'channels': 1}),
+    }
+
+    snapshot = LibrarySnapshot(os.path.join(directory, 'library.db')).cnx
+    for number, (levels, options) in carts.items():
+        cut_name = '{n:06d}_001'.format(n=number)
+        write_wav(os.path.join(audio_dir, cut_name + '.wav'), levels, **options)
+        snapshot.execute("INSERT INTO CART (NUMBER, TYPE, GROUP_NAME, ARTIST, ALBUM, TITLE) VALUES (?, 1, 'MUSIC', ?, ?, ?)",
+                         (number, 'Artist {n}'.format(n=number), 'Album', 'Title {n}'.format(n=number)))
+        snapshot.execute("INSERT INTO CUTS (CUT_NAME, CART_NUMBER, LENGTH) VALUES (?, ?, ?)",
+                         (cut_name, number, SECONDS * 1000))
+    snapshot.commit()
+    snapshot.close()
+
+if __name__ == '__main__':
+    main()